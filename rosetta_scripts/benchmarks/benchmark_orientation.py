@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Benchmark the array geometry functions of orientation.py against the
+functions that work on one ground point at a time.
+
+For each size, random ground points around a body the size of 67P are
+generated and their NADIR rotations and observer positions are computed
+with compute_rotations and compute_positions, and with compute_rotation and
+compute_position in a loop. The loop is only timed on the first
+--scalar-limit points and scaled up to the full size, since it takes minutes
+for a million points. The largest difference between the two is reported,
+and the script exits with status 1 if it is larger than --tolerance.
+
+Example:
+    python benchmark_orientation.py --sizes 1000 10000 100000 1000000
+"""
+
+import os, sys, time, argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import quaternion, orientation
+
+parser = argparse.ArgumentParser(description='''Time the array orientation
+    functions against the single point functions.''')
+parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                    help='The numbers of ground points to time. Defaults to 10^3 to 10^6.')
+parser.add_argument('--scalar-limit', type=int, default=10000,
+                    help="""The number of points to time the single point
+                            functions on, scaled up to the full size.
+                            Defaults to 10000.""")
+parser.add_argument('--distance', type=float, default=110,
+                    help='The observer distance in km. Defaults to 110.')
+parser.add_argument('--tolerance', type=float, default=1e-9,
+                    help="""The largest difference allowed between the array
+                            and single point results. Defaults to 1e-9.""")
+args = parser.parse_args()
+
+rng = np.random.default_rng(67)
+failed = False
+print('{:>10} {:>12} {:>12} {:>10} {:>12}'.format('Points', 'Array (s)', 'Loop (s)', 'Speedup', 'Difference'))
+for size in args.sizes:
+    # points a few km from the center, like the surface of 67P
+    ground_points = rng.normal(size=(size, 3)) * rng.uniform(1, 3, (size, 1))
+
+    start = time.perf_counter()
+    rotations = orientation.compute_rotations(ground_points)
+    positions = orientation.compute_positions(ground_points, args.distance)
+    array_time = time.perf_counter() - start
+
+    count = min(size, args.scalar_limit)
+    start = time.perf_counter()
+    scalar_rotations = [orientation.compute_rotation(point) for point in ground_points[:count]]
+    scalar_positions = [orientation.compute_position(point, args.distance) for point in ground_points[:count]]
+    loop_time = (time.perf_counter() - start) * size / count
+
+    difference = max(np.abs(rotations[:count] - quaternion.as_float_array(scalar_rotations)).max(),
+                     np.abs(positions[:count] - np.array(scalar_positions)).max())
+    failed |= not difference <= args.tolerance
+    print('{:>10} {:>12.4f} {:>12.4f}{} {:>9.0f}x {:>12.2e}'.format(size, array_time, loop_time,
+                                                                  '*' if count < size else ' ',
+                                                                  loop_time / array_time, difference))
+
+if any(size > args.scalar_limit for size in args.sizes):
+    print('* scaled up from {} points'.format(args.scalar_limit))
+sys.exit(1 if failed else 0)
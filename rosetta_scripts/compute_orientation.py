@@ -8,127 +8,113 @@ image so that the ground point is in the center of the image and North is up
 in the image. By default, the viewing positon is set to a reasonable distance
 from the body, but this can be adjusted by the distance argument.
 
+With --batch, the ground points and output names are read from a CSV file
+instead, with a header row naming the X, Y, Z and Output columns, and an
+optional Distance column. The template is read once, the orientations of all
+of the points are computed together and the output cubes are written by a
+pool of workers.
+
+With --detached, each output is a small detached label that points at the
+pixels of the template, with the new SPICE tables in files next to it, instead
+of a copy of the whole template. The template must then be kept.
+
 This script does not use a hash bang so it must be called via
 `python compute_orientation.py <args>`.
 """
 
 from __future__ import print_function, division
 import numpy as np
-import pandas as pd
-import quaternion, argparse, os, subprocess, orientation
+import os, csv, sys, argparse, orientation
+from concurrent.futures import ThreadPoolExecutor
 
 
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('Template',
                     help='The filename for the template cube to adjust the perspective of.')
-parser.add_argument('Output', help='The filename of the output cube')
-parser.add_argument('X', help='The X coordinate of the ground point', type=float)
-parser.add_argument('Y', help='The Y coordinate of the ground point', type=float)
-parser.add_argument('Z', help='The Z coordinate of the ground point', type=float)
+parser.add_argument('Output', nargs='?', help='The filename of the output cube')
+parser.add_argument('X', nargs='?', help='The X coordinate of the ground point', type=float)
+parser.add_argument('Y', nargs='?', help='The Y coordinate of the ground point', type=float)
+parser.add_argument('Z', nargs='?', help='The Z coordinate of the ground point', type=float)
 parser.add_argument('-d', '--distance',
                     help='The distance from observer to the center of the body in km',
                     type=float, default=110)
 parser.add_argument('-c', '--clean',
-                    help='Remove temporary files on successful execution.',
+                    help='Deprecated, does nothing since no temporary files are written.',
                     action='store_true')
+parser.add_argument('-b', '--batch',
+                    help='''A CSV file of ground points and output cubes to make
+                            instead of the single output, see above.''')
+parser.add_argument('--detached', action='store_true',
+                    help='''Write detached labels that share the pixels of the
+                            template instead of copying it.''')
+parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                    help='''The number of output cubes to write at the same time
+                            with --batch. Defaults to the number of CPUs.''')
 
 args = parser.parse_args()
 
-template_image = args.Template
-output_image = args.Output
-ground_point = np.array([args.X, args.Y, args.Z])
-image_basename = os.path.splitext(os.path.basename(output_image))[0]
+if args.clean:
+    print('Warning: --clean is deprecated and does nothing, no temporary files are written.',
+          file=sys.stderr)
+
+if args.batch:
+    if args.Output is not None:
+        parser.error('the output and ground point cannot be used with --batch')
+    with open(args.batch, newline='') as f:
+        rows = list(csv.DictReader(f))
+    try:
+        output_images = [row['Output'] for row in rows]
+        ground_points = np.array([[float(row['X']), float(row['Y']), float(row['Z'])] for row in rows])
+        distances = np.array([float(row.get('Distance') or args.distance) for row in rows])
+    except (KeyError, ValueError) as error:
+        parser.error('bad ground point table [{}]: {}'.format(args.batch, error))
+else:
+    if args.Z is None:
+        parser.error('the output and the X, Y and Z of the ground point are required')
+    output_images = [args.Output]
+    ground_points = np.array([[args.X, args.Y, args.Z]])
+    distances = np.array([args.distance])
 
-body_rotation_csv = image_basename + '_body_rotation.csv'
-inst_rotation_csv = image_basename + '_instrument_rotation.csv'
-inst_position_csv = image_basename + '_instrument_position.csv'
-temp_files = [body_rotation_csv, inst_rotation_csv, inst_position_csv]
+template_image = args.Template
 
 print('Getting viewing geometry tables from {}'.format(template_image))
 
-orientation.get_table(template_image, 'BodyRotation', body_rotation_csv)
-orientation.get_table(template_image, 'InstrumentPointing', inst_rotation_csv)
-orientation.get_table(template_image, 'InstrumentPosition', inst_position_csv)
+template = orientation.read_template(template_image)
 
 print('Computing new viewing geometry')
 
-position = orientation.compute_position(ground_point, args.distance)
-rotation = orientation.compute_rotation(ground_point)
-
-print('Creating output image: {}'.format(output_image))
-
-subprocess.run(['cp', template_image, output_image])
-
-print('Prepping viewing geometry to be attached to {}'.format(output_image))
-
-# We don't want any velocities so just take the quaternions and position
-rotation_fields = ['J2000Q0', 'J2000Q1', 'J2000Q2', 'J2000Q3', 'ET']
-position_fields = ['J2000X', 'J2000Y', 'J2000Z', 'ET']
-
-out_rotation = pd.read_csv(inst_rotation_csv)
-row = out_rotation.iloc[0]
-quat_array = quaternion.as_float_array(rotation)
-quat_array = quat_array/np.linalg.norm(quat_array)
-row['J2000Q0'] = quat_array[0]
-row['J2000Q1'] = -quat_array[1]
-row['J2000Q2'] = -quat_array[2]
-row['J2000Q3'] = -quat_array[3]
-out_rotation[rotation_fields].to_csv(inst_rotation_csv, index=False)
-
-out_position = pd.read_csv(inst_position_csv)
-row = out_position.iloc[0]
-row['J2000X'] = position[0]
-row['J2000Y'] = position[1]
-row['J2000Z'] = position[2]
-out_position[position_fields].to_csv(inst_position_csv, index=False)
-
-# Write the identity rotation out to the body rotation table so that body_fixed=J2000.
-# This saves a little bit of work because attached spice data is in J2000
-body_rotation = pd.read_csv(body_rotation_csv)
-row = body_rotation.iloc[0]
-row['J2000Q0'] = 1
-row['J2000Q1'] = 0
-row['J2000Q2'] = 0
-row['J2000Q3'] = 0
-body_rotation[rotation_fields].to_csv(body_rotation_csv, index=False)
-
-# TODO write these out using an actual pvl library
-body_frame = orientation.get_key(
-        template_image, 'BODY_FRAME_CODE', object='NaifKeywords')
-camera_frame = orientation.get_key(
-        template_image, 'NaifFrameCode', group='Kernels')
-body_rotation_label = image_basename + '_body_rotation.pvl'
-inst_rotation_label = image_basename + '_instrument_rotation.pvl'
-inst_position_label = image_basename + '_instrument_position.pvl'
-temp_files += [inst_rotation_label, body_rotation_label, inst_position_label]
-orientation.create_rotation_label(
-        body_rotation_label, body_frame,
-        body_rotation.iloc[0]['ET'],
-        description='created by compute_orientation.py')
-orientation.create_rotation_label(
-        inst_rotation_label, camera_frame,
-        out_rotation.iloc[0]['ET'],
-        description='created by compute_orientation.py')
-orientation.create_position_label(
-        inst_position_label,
-        out_position.iloc[0]['ET'],
-        description='created by compute_orientation.py')
-
-print('Attaching new viewing geometry to {}'.format(output_image))
-
-orientation.attach_table(
-        output_image, body_rotation_csv,
-        'BodyRotation', label=body_rotation_label)
-orientation.attach_table(
-        output_image, inst_rotation_csv,
-        'InstrumentPointing', label=inst_rotation_label)
-orientation.attach_table(
-        output_image, inst_position_csv,
-        'InstrumentPosition', label=inst_position_label)
+positions = orientation.compute_positions(ground_points, distances)
+rotations = orientation.compute_rotations(ground_points)
 
-if args.clean:
-    print('Cleaning up')
-    for file in temp_files:
-        print('Removing temp file: {}'.format(file))
-        os.remove(file)
+if not args.batch:
+    print('Creating output image: {}'.format(output_images[0]))
+    orientation.write_perspective(template_image, template, output_images[0],
+                                  rotations[0], positions[0],
+                                  description='created by compute_orientation.py',
+                                  detached=args.detached)
+    print('----Complete!----')
+    sys.exit(0)
+
+print('Creating {} output images'.format(len(output_images)))
+
+
+def write(index):
+    try:
+        orientation.write_perspective(template_image, template, output_images[index],
+                                      rotations[index], positions[index],
+                                      description='created by compute_orientation.py',
+                                      detached=args.detached)
+    except (OSError, ValueError) as error:
+        print('Failed to create output image {}: {}'.format(output_images[index], error))
+        return False
+    return True
+
+
+with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+    written = list(executor.map(write, range(len(output_images))))
+
+failures = written.count(False)
+if failures:
+    print('Failed to create {} of {} output images'.format(failures, len(output_images)))
+    sys.exit(1)
 print('----Complete!----')
@@ -3,9 +3,16 @@ Module for adjusting viewing geometry using ISIS3. This module requires that
 the ISIS3 executables are in your PATH.
 """
 
+import os, sys, shutil
 import numpy as np
-import pandas as pd
-import quaternion, argparse, os, subprocess
+import quaternion
+
+# the ISIS label and cube modules are shared with the TGO CaSSIS scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'tgo_scripts', 'python_scripts'))
+import isis_label, isis_cube
+from functools import lru_cache
+from numpy.lib.recfunctions import repack_fields
 
 
 """
@@ -121,9 +128,173 @@ def compute_rotation(ground_point):
     return north_rotation * look_rotation
 
 
-# TODO replace getkey calls with PVL library
 """
-Get a key from the label of an ISIS3 cube file.
+Compute the observer positions for many ground points at once, like
+compute_position.
+
+parameters
+----------
+ground_points : array
+                The ground points that will be viewed in body fixed X, Y, Z
+                as an (N, 3) numpy array.
+
+distance : float or array
+           The distance from the center of the body to the observer in
+           kilometers, for all of the points or as an (N,) array.
+
+returns
+-------
+positions : array
+            The observer positions in body fixed X, Y, Z as an (N, 3) numpy
+            array.
+"""
+def compute_positions(ground_points, distance):
+    ground_points = np.asarray(ground_points, dtype=float)
+    scale = np.asarray(distance, dtype=float) / np.linalg.norm(ground_points, axis=-1)
+    return scale[..., np.newaxis] * ground_points
+
+
+"""
+Multiply arrays of quaternions stored as W, X, Y, Z.
+
+parameters
+----------
+p : array
+    The left quaternions as an (N, 4) numpy array.
+
+q : array
+    The right quaternions as an (N, 4) numpy array.
+
+returns
+-------
+product : array
+          The products p * q as an (N, 4) numpy array.
+"""
+def multiply_quaternions(p, q):
+    pw, px, py, pz = np.moveaxis(p, -1, 0)
+    qw, qx, qy, qz = np.moveaxis(q, -1, 0)
+    return np.stack([pw*qw - px*qx - py*qy - pz*qz,
+                     pw*qx + px*qw + py*qz - pz*qy,
+                     pw*qy - px*qz + py*qw + pz*qx,
+                     pw*qz + px*qy - py*qx + pz*qw], axis=-1)
+
+
+"""
+Rotate vectors by arrays of quaternions stored as W, X, Y, Z. Like
+quaternion.as_rotation_matrix, the quaternions do not need to be normalized.
+
+parameters
+----------
+q : array
+    The rotations as an (N, 4) numpy array.
+
+v : array
+    The vectors to rotate as an (N, 3) or (3,) numpy array.
+
+returns
+-------
+rotated : array
+          The rotated vectors as an (N, 3) numpy array.
+"""
+def rotate_vectors(q, v):
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    w = q[..., :1]
+    axis = q[..., 1:]
+    t = 2 * np.cross(axis, v)
+    return v + w * t + np.cross(axis, t)
+
+
+"""
+Compute the shortest rotations between many pairs of vectors at once, like
+rotation_between. The parallel and opposite cases are handled with masks
+instead of branches.
+
+parameters
+----------
+
+u : array
+    The first vectors, as an (N, 3) or (3,) numpy array, that the rotations
+    will rotate to v.
+
+v : array
+    The second vectors, as an (N, 3) or (3,) numpy array.
+
+fallback : array
+           The axes of rotation, as an (N, 3) or (3,) numpy array, for the
+           vectors that are exactly opposite. See rotation_between.
+
+returns
+-------
+rotations : array
+            The rotations from u to v as W, X, Y, Z quaternions in an (N, 4)
+            numpy array. Like rotation_between they are not normalized.
+"""
+def rotations_between(u, v, fallback=None):
+    tolerance = 1e-10
+    u, v = np.broadcast_arrays(np.asarray(u, dtype=float), np.asarray(v, dtype=float))
+    norm_u = np.linalg.norm(u, axis=-1, keepdims=True)
+    norm_v = np.linalg.norm(v, axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        unit_u = u / norm_u
+        unit_v = v / norm_v
+    dot = np.sum(unit_u * unit_v, axis=-1)
+
+    rotations = np.concatenate([(1 + dot)[..., np.newaxis], np.cross(unit_u, unit_v)], axis=-1)
+
+    # a 180 degree rotation about the fallback axis, or the cross product of
+    # u and the x-axis, or the y-axis if they are co-linear
+    opposite = dot < -1.0 + tolerance
+    if fallback is not None:
+        axis = np.broadcast_to(fallback, u.shape)
+    else:
+        axis = np.cross(unit_u, np.array([1, 0, 0]))
+        y_axis = np.cross(unit_u, np.array([0, 1, 0]))
+        colinear = np.linalg.norm(axis, axis=-1) < tolerance
+        axis = np.where(colinear[..., np.newaxis], y_axis, axis)
+    rotations = np.where(opposite[..., np.newaxis],
+                         np.concatenate([np.zeros(dot.shape + (1,)), axis], axis=-1),
+                         rotations)
+
+    # the identity for parallel and zero length vectors
+    identity = (dot > 1.0 - tolerance) | (norm_u[..., 0] < tolerance) | (norm_v[..., 0] < tolerance)
+    rotations[identity] = [1, 0, 0, 0]
+    return rotations
+
+
+"""
+Compute the rotations from the body fixed reference frame to NADIR views of
+many ground points at once, like compute_rotation.
+
+Parameters
+----------
+ground_points : array
+                The ground points that will be viewed in body fixed X, Y, Z
+                coordinates as an (N, 3) numpy array.
+
+returns
+-------
+rotations : array
+            The rotations from body fixed to a NADIR view of each ground
+            point, as W, X, Y, Z quaternions in an (N, 4) numpy array. Like
+            compute_rotation they are not normalized.
+"""
+def compute_rotations(ground_points):
+    x_plus = np.array([1, 0, 0])
+    z_plus = np.array([0, 0, 1])
+    ground_points = np.asarray(ground_points, dtype=float)
+    look_vectors = -ground_points / np.linalg.norm(ground_points, axis=-1, keepdims=True)
+
+    look_rotations = rotations_between(z_plus, look_vectors)
+    rotated_x = rotate_vectors(look_rotations, x_plus)
+    north_up = z_plus - look_vectors[..., 2:] * look_vectors
+    north_rotations = rotations_between(rotated_x, north_up, look_vectors)
+    return multiply_quaternions(north_rotations, look_rotations)
+
+
+"""
+Get a key from the label of an ISIS3 cube file. The label is read directly
+from the file and cached, so repeated lookups on the same cube do not run
+getkey or re-parse the label.
 
 parameters
 ----------
@@ -147,20 +318,12 @@ value : str
         The value of the key.
 """
 def get_key(cube, name, object=None, group=None):
-    command = [
-            'getkey',
-            'from={}'.format(cube),
-            'keyword={}'.format(name)]
-    if object:
-        command.append('objname={}'.format(object))
-    if group:
-        command.append('grpname={}'.format(group))
-    result = subprocess.run(command, stdout=subprocess.PIPE, check=True)
-    return result.stdout.strip().decode()
+    return isis_label.get_key(cube, name, object=object, group=group)
 
 
 """
-Write a table from an ISIS3 cube file to a CSV file.
+Read a table from an ISIS3 cube file. The table is read directly from the
+cube using the record layout in its label, without running tabledump.
 
 parameters
 ----------
@@ -170,96 +333,208 @@ cube : str
 table_name : str
              The name of the table to get from the cube.
 
-csv : str
-      The filename of the CSV file to write to.
+returns
+-------
+records : array
+          The records of the table as a numpy structured array, with a field
+          for each field in the table.
 """
-def get_table(cube, table_name, csv):
-    command = [
-            'tabledump',
-            'from={}'.format(cube),
-            'name={}'.format(table_name),
-            'to={}'.format(csv)]
-    subprocess.run(command, check=True)
+def get_table(cube, table_name):
+    return isis_cube.read_table(cube, table_name)
 
 
 """
-Write a table from a CSV file to an ISIS3 cube file.
+Write a table to an ISIS3 cube file, replacing any table with the same name.
+The table is written directly into the cube, without running csv2table.
 
 parameters
 ----------
 cube : str
        The filename of the cube to write the table to.
 
-csv : str
-      The filename of the CSV file to get the data from.
-
 table_name : str
              The name of the table to write to the cube.
 
-label : str
-        Optional flat PVL file whose keywords will be added to the table label.
+records : array
+          The records to write as a numpy structured array. Each field
+          becomes a field in the table.
+
+keywords : list
+           Optional (name, value) pairs that will be added to the table label.
 """
-def attach_table(cube, csv, table_name, label=None):
-    command = [
-            'csv2table',
-            'to={}'.format(cube),
-            'csv={}'.format(csv),
-            'tablename={}'.format(table_name)]
-    if label:
-        command.append('label={}'.format(label))
-    subprocess.run(command, check=True)
+def attach_table(cube, table_name, records, keywords=None):
+    isis_cube.write_table(cube, table_name, records, keywords or [])
 
 
 """
-Create a flat PVL lable file for a rotation quaternion table.
+Create the table label keywords for a rotation quaternion table.
 
 parameters
 ----------
-file : str
-       The filename of the PVL file to write out.
-
 frame : str
         The NAIF frame code that the quaternion rotates to.
 
-time : str
+time : float
        The ephemeris time for the rotation.
 
 description : str
               Optional description that will be added to the label.
+
+returns
+-------
+keywords : list
+           The (name, value) pairs for the table label.
 """
-def create_rotation_label(file, frame, time, description=None):
-    label =    'TimeDependentFrames = ({}, 1)'.format(frame)
-    label += '\nCkTableStartTime    = {}'.format(time)
-    label += '\nCkTableEndTime      = {}'.format(time)
-    label += '\nCkTableOriginalSize = 1'
-    label += '\nFrameTypeCode       = 3'
+def rotation_table_keywords(frame, time, description=None):
+    keywords = [('TimeDependentFrames', [str(frame), '1']),
+                ('CkTableStartTime', str(float(time))),
+                ('CkTableEndTime', str(float(time))),
+                ('CkTableOriginalSize', '1'),
+                ('FrameTypeCode', '3')]
     if description:
-        label += '\nDescription         = "{}"'.format(description)
-    label += '\n\nEnd'
-    with open(file, 'w') as out:
-        out.write(label)
+        keywords.append(('Description', description))
+    return keywords
 
 
 """
-Create a flat PVL lable file for a position table.
+Create the table label keywords for a position table.
 
 parameters
 ----------
-file : str
-       The filename of the PVL file to write out.
-
-time : str
+time : float
        The ephemeris time for the position.
 
 description : str
               Optional description that will be added to the label.
+
+returns
+-------
+keywords : list
+           The (name, value) pairs for the table label.
 """
-def create_position_label(file, time, description=None):
-    label =    'SpkTableStartTime    = {}'.format(time)
-    label += '\nSpkTableEndTime      = {}'.format(time)
-    label += '\nSpkTableOriginalSize = 1'
+def position_table_keywords(time, description=None):
+    keywords = [('SpkTableStartTime', str(float(time))),
+                ('SpkTableEndTime', str(float(time))),
+                ('SpkTableOriginalSize', '1')]
     if description:
-        label += '\nDescription          = "{}"'.format(description)
-    label += '\n\nEnd'
-    with open(file, 'w') as out:
-        out.write(label)
+        keywords.append(('Description', description))
+    return keywords
+
+
+"""
+Read the viewing geometry of a template cube once, so many perspective cubes
+can be made from it without reading it again.
+
+parameters
+----------
+cube : str
+       The filename of the template cube.
+
+returns
+-------
+template : dict
+           The first record of the BodyRotation, InstrumentPointing and
+           InstrumentPosition tables, without velocities, and the NAIF body
+           and camera frame codes.
+"""
+def read_template(cube):
+    rotation_fields = ['J2000Q0', 'J2000Q1', 'J2000Q2', 'J2000Q3', 'ET']
+    position_fields = ['J2000X', 'J2000Y', 'J2000Z', 'ET']
+    return {'body_rotation' : repack_fields(get_table(cube, 'BodyRotation')[rotation_fields][:1]),
+            'instrument_rotation' : repack_fields(get_table(cube, 'InstrumentPointing')[rotation_fields][:1]),
+            'instrument_position' : repack_fields(get_table(cube, 'InstrumentPosition')[position_fields][:1]),
+            'body_frame' : get_key(cube, 'BODY_FRAME_CODE', object='NaifKeywords'),
+            'camera_frame' : get_key(cube, 'NaifFrameCode', group='Kernels')}
+
+
+@lru_cache(maxsize=32)
+def _cached_template(cube, size, mtime):
+    return read_template(cube)
+
+
+"""
+Read the viewing geometry of a template cube like read_template, reusing the
+geometry read earlier if the cube has not changed since. This is for long
+running processes that make perspective cubes from the same templates many
+times.
+
+parameters
+----------
+cube : str
+       The filename of the template cube.
+
+returns
+-------
+template : dict
+           The viewing geometry of the template, see read_template. It is
+           shared with the cache and must not be changed.
+"""
+def get_template(cube):
+    stat = os.stat(cube)
+    return _cached_template(os.path.abspath(cube), stat.st_size, stat.st_mtime_ns)
+
+
+"""
+Write a perspective cube, a copy of the template cube with a new viewing
+geometry.
+
+parameters
+----------
+template_cube : str
+                The filename of the template cube.
+
+template : dict
+           The viewing geometry of the template, see read_template.
+
+output_cube : str
+              The filename of the output cube.
+
+rotation : array
+           The rotation from body fixed to the camera as a W, X, Y, Z
+           quaternion, which does not need to be normalized.
+
+position : array
+           The observer position in body fixed X, Y, Z.
+
+description : str
+              Optional description that will be added to the table labels.
+
+detached : bool
+           Write a detached label that points at the pixels of the template
+           instead of copying it, with the new tables in files of their own
+           next to the label. The output is then a few kilobytes whatever the
+           size of the template, but only works while the template is there.
+"""
+def write_perspective(template_cube, template, output_cube, rotation, position, description=None,
+                      detached=False):
+    quat_array = np.asarray(rotation, dtype=float)
+    quat_array = quat_array / np.linalg.norm(quat_array)
+    out_rotation = template['instrument_rotation'].copy()
+    out_rotation['J2000Q0'] = quat_array[0]
+    out_rotation['J2000Q1'] = -quat_array[1]
+    out_rotation['J2000Q2'] = -quat_array[2]
+    out_rotation['J2000Q3'] = -quat_array[3]
+
+    out_position = template['instrument_position'].copy()
+    out_position['J2000X'] = position[0]
+    out_position['J2000Y'] = position[1]
+    out_position['J2000Z'] = position[2]
+
+    # Write the identity rotation out to the body rotation table so that body_fixed=J2000.
+    # This saves a little bit of work because attached spice data is in J2000
+    body_rotation = template['body_rotation'].copy()
+    body_rotation['J2000Q0'] = 1
+    body_rotation['J2000Q1'] = 0
+    body_rotation['J2000Q2'] = 0
+    body_rotation['J2000Q3'] = 0
+
+    if detached:
+        isis_cube.write_detached_label(template_cube, output_cube)
+    else:
+        shutil.copyfile(template_cube, output_cube)
+    attach_table(output_cube, 'BodyRotation', body_rotation,
+                 rotation_table_keywords(template['body_frame'], body_rotation['ET'][0], description))
+    attach_table(output_cube, 'InstrumentPointing', out_rotation,
+                 rotation_table_keywords(template['camera_frame'], out_rotation['ET'][0], description))
+    attach_table(output_cube, 'InstrumentPosition', out_position,
+                 position_table_keywords(out_position['ET'][0], description))
@@ -0,0 +1,165 @@
+"""
+Python script that keeps the orientation module loaded and makes perspective
+cubes on request, like compute_orientation.py, without paying the Python
+start up and import time for each cube.
+
+Requests are JSON objects, one per line, read from the standard input, or
+from each connection to a Unix socket with --socket. Each request has the
+template cube, the output cube and the ground point, and optionally an id,
+the distance and whether to write a detached label, see compute_orientation.py:
+
+    {"id": 1, "template": "template.cub", "output": "out.cub",
+     "x": 1.2, "y": -0.3, "z": 0.8, "distance": 110}
+
+Requests are handled at the same time by a pool of workers, and for each one
+a JSON response is written on a line of its own as soon as it is done, so
+they may come back in a different order than the requests. A response has
+the id and output of the request, a status of ok or error, the error message
+if there was one, and the seconds the request took. The geometry of each
+template is read once and reused until the template changes.
+
+When the standard input is closed, or the worker is interrupted, the number
+of requests and their mean, minimum and maximum latency are written to the
+standard error. Only running totals of the latencies are kept, so a worker
+can stay up for any number of requests.
+
+This script does not use a hash bang so it must be called via
+`python orientation_worker.py <args>`.
+"""
+
+from __future__ import print_function, division
+import numpy as np
+import os, sys, json, time, argparse, threading, socketserver, orientation
+from concurrent.futures import ThreadPoolExecutor
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('-s', '--socket',
+                    help='''Listen for connections on this Unix socket instead
+                            of reading requests from the standard input.''')
+parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                    help='''The number of requests to handle at the same time.
+                            Defaults to the number of CPUs.''')
+parser.add_argument('--detached', action='store_true',
+                    help='''Write detached labels that share the pixels of the
+                            template instead of copying it, for requests that
+                            do not give detached themselves.''')
+parser.add_argument('-d', '--distance', type=float, default=110,
+                    help='''The distance from observer to the center of the
+                            body in km, for requests without one.''')
+
+args = parser.parse_args()
+
+executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+# the running count, total, minimum and maximum of the request latencies
+latency = {'count' : 0, 'total' : 0.0, 'minimum' : float('inf'), 'maximum' : 0.0}
+latency_lock = threading.Lock()
+
+
+def handle(request):
+    start = time.perf_counter()
+    response = {'id' : request.get('id'), 'output' : request.get('output')}
+    try:
+        ground_point = np.array([[float(request['x']), float(request['y']), float(request['z'])]])
+        distance = float(request.get('distance', args.distance))
+        template = orientation.get_template(request['template'])
+        rotation = orientation.compute_rotations(ground_point)[0]
+        position = orientation.compute_positions(ground_point, distance)[0]
+        orientation.write_perspective(request['template'], template, request['output'],
+                                      rotation, position,
+                                      description='created by orientation_worker.py',
+                                      detached=bool(request.get('detached', args.detached)))
+        response['status'] = 'ok'
+    except Exception as error:
+        # any error only fails this request, which still gets a response
+        response['status'] = 'error'
+        response['error'] = '{}: {}'.format(type(error).__name__, error)
+    response['seconds'] = time.perf_counter() - start
+    with latency_lock:
+        latency['count'] += 1
+        latency['total'] += response['seconds']
+        latency['minimum'] = min(latency['minimum'], response['seconds'])
+        latency['maximum'] = max(latency['maximum'], response['seconds'])
+    return response
+
+
+def serve(lines, write):
+    # handle the requests in lines and write each response as it is done,
+    # returning once every response has been written. Only the requests
+    # that have not been answered yet are kept, so a connection can send
+    # any number of them.
+    write_lock = threading.Lock()
+    pending = set()
+    done = threading.Condition()
+
+    def respond(response):
+        with write_lock:
+            write(json.dumps(response) + '\n')
+
+    def finish(future):
+        try:
+            respond(future.result())
+        finally:
+            with done:
+                pending.discard(future)
+                done.notify_all()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request is not a JSON object')
+        except ValueError as error:
+            respond({'id' : None, 'status' : 'error', 'error' : 'Bad request: {}'.format(error)})
+            continue
+        future = executor.submit(handle, request)
+        with done:
+            pending.add(future)
+        future.add_done_callback(finish)
+    with done:
+        done.wait_for(lambda: not pending)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        def write(text):
+            self.wfile.write(text.encode())
+            self.wfile.flush()
+        serve((line.decode() for line in self.rfile), write)
+
+
+def report():
+    with latency_lock:
+        count, total, minimum, maximum = (latency['count'], latency['total'],
+                                          latency['minimum'], latency['maximum'])
+    if not count:
+        print('Handled no requests', file=sys.stderr)
+        return
+    print('Handled {} requests, latency mean {:.4f} s, min {:.4f} s, max {:.4f} s'.format(
+            count, total / count, minimum, maximum), file=sys.stderr)
+
+
+def write_stdout(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+try:
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        with socketserver.ThreadingUnixStreamServer(args.socket, Handler) as server:
+            print('Listening on {}'.format(args.socket), file=sys.stderr)
+            server.serve_forever()
+    else:
+        serve(sys.stdin, write_stdout)
+except KeyboardInterrupt:
+    pass
+finally:
+    executor.shutdown()
+    if args.socket and os.path.exists(args.socket):
+        os.remove(args.socket)
+    report()
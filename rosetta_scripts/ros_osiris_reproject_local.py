@@ -0,0 +1,225 @@
+"""
+Python script to reproject a list of Rosetta OSIRIS images into the
+perspective of a given image with a pool of local processes, and then mosaic
+them. This does the same work as ros_osiris_reproject_parallel.sh, without a
+cluster, so a large workstation can reproject many images at once.
+
+Each image goes through the same chain as ros_osiris_reproject_image.sh:
+rososiris2isis, spiceinit with the DSK shape model, mask, camdev, cam2cam for
+the image and its pixel resolution, editlab and cubeit. The output of each
+application is written to LOGS/<basename>.log in the output directory.
+
+The stacked cube of an image is only put in place once its whole chain has
+finished, so images whose stacked cube already exists are skipped, and a run
+that was interrupted or had failures can be started again with the same
+arguments to only do the rest. The mosaic is only made once every image has
+been reprojected.
+
+The perspective image must be a spiceinited ISIS cube, such as one made with
+compute_orientation.py. The ISISROOT and ISIS3DATA environment variables must
+be set.
+
+This script does not use a hash bang so it must be called via
+`python ros_osiris_reproject_local.py <args>`.
+"""
+
+from __future__ import print_function
+import os, sys, shutil, argparse, subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# the shape model and preferences spiceinit is run with
+shape_model = os.path.join('rosetta', 'kernels', 'dsk', 'ROS_CG_M004_OSPGDLR_U_V1.bds')
+preference_file = 'IsisPreferences_Bullet'
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('-l', '--list', required=True,
+                    help='''The list of image basenames to reproject, one on
+                            each line without path or file extension.''')
+parser.add_argument('-p', '--perspective', required=True,
+                    help='''The spiceinited perspective cube whose viewing
+                            geometry the images are reprojected into.''')
+parser.add_argument('-i', '--input', default='.',
+                    help='''The directory where the raw .IMG and .LBL files
+                            of the images are located.''')
+parser.add_argument('-o', '--output', default='.',
+                    help='The directory where all files will be output.')
+parser.add_argument('-m', '--minimum-mask', required=True,
+                    help='The minimum mask threshold, e.g. 0.0001.')
+parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                    help='''The number of images to reproject at the same
+                            time. Defaults to the number of CPUs.''')
+parser.add_argument('--mosaic', default='mosaic.cub',
+                    help='''The filename of the mosaic in the output
+                            directory. Defaults to mosaic.cub.''')
+
+
+def run(command, log, cwd):
+    # run an ISIS application with its output in the log, and raise
+    # CalledProcessError if it fails
+    log.write('$ {}\n'.format(' '.join(command)))
+    log.flush()
+    subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, cwd=cwd, check=True)
+
+
+def reproject_image(basename, perspective, raw_dir, output_dir, minimum_mask):
+    """
+    Reproject one image into the perspective image and stack it with its
+    reprojected pixel resolution, like ros_osiris_reproject_image.sh.
+
+    Parameters
+    ----------
+    basename : str
+               The basename of the image, without path or file extension
+
+    perspective : str
+                  The absolute path of the perspective cube
+
+    raw_dir : str
+              The absolute path of the directory with the raw image
+
+    output_dir : str
+                 The absolute path of the output directory
+
+    minimum_mask : str
+                   The minimum mask threshold
+
+    Returns
+    -------
+    error : str
+            None if the image was reprojected, otherwise the reason it was not
+    """
+    ingested = os.path.join(output_dir, 'ingested', basename + '.cub')
+    masked = os.path.join(output_dir, 'masked', basename + '.cub')
+    pixres = os.path.join(output_dir, 'resolution', basename + '.cub')
+    reproj_dn = os.path.join(output_dir, 'reproj', basename + '.cub')
+    reproj_pixres = os.path.join(output_dir, 'reproj_pixres', basename + '.cub')
+    stack_list = os.path.join(output_dir, 'stacked_reproj', basename + '.lis')
+    stacked = os.path.join(output_dir, 'stacked_reproj', basename + '.cub')
+    partial = os.path.join(output_dir, 'stacked_reproj', basename + '.partial.cub')
+    model = os.path.join(os.environ['ISIS3DATA'], shape_model)
+
+    with open(os.path.join(output_dir, 'LOGS', basename + '.log'), 'w') as log:
+        try:
+            run(['rososiris2isis', 'from=' + os.path.join(raw_dir, basename + '.IMG'), 'to=' + ingested],
+                log, output_dir)
+            run(['spiceinit', 'from=' + ingested, 'shape=user', 'model=' + model,
+                 '-preference=' + preference_file], log, output_dir)
+            run(['mask', 'minimum=' + minimum_mask, 'from=' + ingested, 'to=' + masked], log, output_dir)
+            run(['camdev', 'dn=no', 'planetocentriclatitude=no', 'pixelresolution=yes',
+                 'from=' + masked, 'to=' + pixres], log, output_dir)
+            run(['cam2cam', 'from=' + masked, 'to=' + reproj_dn, 'match=' + perspective], log, output_dir)
+            run(['cam2cam', 'from=' + pixres, 'to=' + reproj_pixres, 'match=' + perspective], log, output_dir)
+            run(['editlab', 'from=' + reproj_pixres, 'grpname=BandBin', 'keyword=CombinedFilterName',
+                 'value=pixel_resolution'], log, output_dir)
+            with open(stack_list, 'w') as f:
+                f.write(reproj_dn + '\n' + reproj_pixres + '\n')
+            run(['cubeit', 'fromlist=' + stack_list, 'to=' + partial], log, output_dir)
+            # only now is the image complete, so it is skipped when run again
+            os.replace(partial, stacked)
+        except subprocess.CalledProcessError as error:
+            return '{} failed with status {}'.format(error.cmd[0], error.returncode)
+        except OSError as error:
+            return str(error)
+    return None
+
+
+def mosaic_images(basenames, output_dir, mosaic):
+    """
+    Average the stacked cubes of the images into a mosaic, like
+    ros_osiris_mosaic.sh.
+
+    Parameters
+    ----------
+    basenames : list
+                The basenames of the images to mosaic, in order
+
+    output_dir : str
+                 The absolute path of the output directory
+
+    mosaic : str
+             The filename of the mosaic in the output directory
+
+    Returns
+    -------
+    error : str
+            None if the mosaic was made, otherwise the reason it was not
+    """
+    output_mosaic = os.path.join(output_dir, mosaic)
+    with open(os.path.join(output_dir, 'LOGS', 'mosaic.log'), 'w') as log:
+        try:
+            for index, basename in enumerate(basenames):
+                command = ['handmos', 'from=' + os.path.join(output_dir, 'stacked_reproj', basename + '.cub'),
+                           'mosaic=' + output_mosaic, 'priority=average']
+                # the first image creates the mosaic
+                if index == 0:
+                    command += ['create=yes', 'nsamples=2048', 'nlines=2048', 'nbands=1']
+                run(command, log, output_dir)
+        except subprocess.CalledProcessError as error:
+            return '{} failed with status {}'.format(error.cmd[0], error.returncode)
+        except OSError as error:
+            return str(error)
+    return None
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if 'ISISROOT' not in os.environ or 'ISIS3DATA' not in os.environ:
+        print('Environment variables ISISROOT and ISIS3DATA must be set before running this script.')
+        sys.exit(2)
+
+    with open(args.list) as f:
+        basenames = [line.strip() for line in f if line.strip()]
+    if not basenames:
+        print('No images to reproject in [{}].'.format(args.list))
+        sys.exit(2)
+    perspective = os.path.abspath(args.perspective)
+    raw_dir = os.path.abspath(args.input)
+    output_dir = os.path.abspath(args.output)
+    if not os.path.isfile(perspective):
+        print('Perspective image [{}] does not exist.'.format(perspective))
+        sys.exit(2)
+
+    for directory in ['ingested', 'masked', 'resolution', 'reproj', 'reproj_pixres',
+                      'stacked_reproj', 'LOGS']:
+        os.makedirs(os.path.join(output_dir, directory), exist_ok=True)
+    # spiceinit looks for the preferences in the directory it is run from
+    preferences = os.path.join(os.path.dirname(os.path.abspath(__file__)), preference_file)
+    if not os.path.exists(os.path.join(output_dir, preference_file)):
+        shutil.copy(preferences, output_dir)
+
+    todo = [basename for basename in basenames
+            if not os.path.exists(os.path.join(output_dir, 'stacked_reproj', basename + '.cub'))]
+    print('Reprojecting {} of {} images, {} already complete, with {} workers.'.format(
+            len(todo), len(basenames), len(basenames) - len(todo), max(1, args.workers)))
+
+    failures = {}
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(reproject_image, basename, perspective, raw_dir, output_dir,
+                                   args.minimum_mask) : basename
+                   for basename in todo}
+        for count, future in enumerate(as_completed(futures), 1):
+            basename = futures[future]
+            error = future.result()
+            if error:
+                failures[basename] = error
+                print('{}/{} {} failed: {}, see LOGS/{}.log'.format(count, len(todo), basename,
+                                                                     error, basename))
+            else:
+                print('{}/{} {} reprojected'.format(count, len(todo), basename))
+
+    if failures:
+        print('{} of {} images failed, not mosaicing. Run again to retry them.'.format(
+                len(failures), len(todo)))
+        sys.exit(1)
+
+    print('Mosaicing {} images into {}'.format(len(basenames), args.mosaic))
+    error = mosaic_images(basenames, output_dir, args.mosaic)
+    if error:
+        print('Mosaic failed: {}, see LOGS/mosaic.log'.format(error))
+        sys.exit(1)
+
+    print('')
+    print('---Complete---')
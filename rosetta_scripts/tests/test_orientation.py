@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+quaternion = pytest.importorskip('quaternion')
+import orientation
+
+# ground points around a body the size of 67P, with the points straight
+# above and below the poles, where the look vector is parallel or opposite
+# to +Z and there is no north, and points whose rotated +X is opposite north
+GROUND_POINTS = np.concatenate([
+    np.random.default_rng(67).normal(size=(200, 3)) * 2.0,
+    [[0, 0, 2.0], [0, 0, -2.0], [0, 0, 1e-3], [1.5, 0, 0], [-1.5, 0, 0],
+     [0, 1.5, 0], [0, -1.5, 0], [1.0, 0, 1.0], [-1.0, 0, -1.0]]])
+
+
+def as_array(rotation):
+    return quaternion.as_float_array(rotation)
+
+
+def test_rotations_between():
+    x = np.array([1.0, 0, 0])
+    y = np.array([0, 1.0, 0])
+    pairs = [(x, y), (x, 2 * x), (x, -x), (y, -3 * y), (x + 1e-12, x),
+             (np.zeros(3), x), (x, np.zeros(3)), (x, np.array([-1.0, 1e-3, 0]))]
+    u = np.array([pair[0] for pair in pairs])
+    v = np.array([pair[1] for pair in pairs])
+    expected = np.array([as_array(orientation.rotation_between(*pair)) for pair in pairs])
+    np.testing.assert_allclose(orientation.rotations_between(u, v), expected, atol=1e-12)
+
+    fallback = np.array([0, 0, 1.0])
+    expected = np.array([as_array(orientation.rotation_between(*pair, fallback)) for pair in pairs])
+    np.testing.assert_allclose(orientation.rotations_between(u, v, fallback), expected, atol=1e-12)
+
+
+def test_compute_rotations():
+    expected = np.array([as_array(orientation.compute_rotation(point)) for point in GROUND_POINTS])
+    np.testing.assert_allclose(orientation.compute_rotations(GROUND_POINTS), expected, atol=1e-12)
+
+
+@pytest.mark.parametrize('distance', [110.0, np.linspace(10, 200, len(GROUND_POINTS))])
+def test_compute_positions(distance):
+    distances = np.broadcast_to(distance, len(GROUND_POINTS))
+    expected = np.array([orientation.compute_position(point, d) for point, d in zip(GROUND_POINTS, distances)])
+    np.testing.assert_allclose(orientation.compute_positions(GROUND_POINTS, distance), expected,
+                               rtol=1e-12, atol=1e-12)
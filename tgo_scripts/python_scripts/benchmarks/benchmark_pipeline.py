@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Benchmark the orchestration of control_obs.py without ISIS or real data.
+
+Stub ISIS applications, see stub_isis.py, are put on the PATH and
+control_obs.py is run on generated observations of increasing size with
+different numbers of workers. For each run the wall time is compared to the
+time spent in the stub commands, which shows the overhead of the
+orchestration itself and how well the work scales across workers.
+
+Results can be saved as a baseline with --save-baseline and later runs
+compared against it with --baseline, so changes that slow down the
+orchestration are reported as regressions. No baseline is kept in the
+repository, since the times depend on the machine, so there is no comparison
+unless --baseline is given. The script exits with status 1 if any run failed
+or regressed.
+
+Example:
+    python benchmark_pipeline.py --sizes 10 100 --workers 1 4 --save-baseline baseline.json
+    python benchmark_pipeline.py --sizes 10 100 --workers 1 4 --baseline baseline.json
+"""
+
+import os, sys, json, time, shutil, argparse, tempfile, subprocess
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+control_obs = os.path.join(os.path.dirname(script_dir), 'control_obs.py')
+stub = os.path.join(script_dir, 'stub_isis.py')
+
+# the applications that control_obs.py runs
+applications = ['tgocassis2isis', 'spiceinit', 'findfeatures', 'cnetmerge',
+                'cnetcombinept', 'cnetadd', 'pointreg', 'cnetedit', 'jigsaw',
+                'mosrange', 'camrange', 'cam2map', 'automos', 'coreg', 'cubeit',
+                'isis2pds', 'tgocassisrdrgen']
+
+filters = ['PAN', 'RED', 'NIR', 'BLU']
+
+
+def install_stubs(bin_dir):
+    """
+    Write a wrapper on the PATH for each application that runs the stub.
+    """
+    os.makedirs(bin_dir)
+    for application in applications:
+        wrapper = os.path.join(bin_dir, application)
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, stub, application))
+        os.chmod(wrapper, 0o755)
+
+
+def make_observation(directory, framelets):
+    """
+    Write the labels of an observation with a number of framelets, spread
+    over the four filters, and the input list for control_obs.py.
+
+    Returns
+    -------
+    input_list : str
+                 The list of framelet labels
+    """
+    os.makedirs(directory)
+    labels = []
+    for index in range(framelets):
+        filter = filters[index % len(filters)]
+        frame = index // len(filters)
+        seconds = 14.582 + frame
+        label = os.path.join(directory, 'CAS-MCO-2016-11-26T22.{:02d}.{:06.3f}-{}-{:05d}-B1.xml'.format(
+                32 + int(seconds // 60), seconds % 60, filter, 1000 + frame))
+        with open(label, 'w') as f:
+            f.write('<Product_Observational/>\n')
+        labels.append(label)
+    input_list = os.path.join(directory, 'input.lis')
+    with open(input_list, 'w') as f:
+        f.write('\n'.join(labels) + '\n')
+    return input_list
+
+
+def run_benchmark(root, framelets, workers, environment, pairs='sequential', mosaic='automos'):
+    """
+    Run control_obs.py on a generated observation.
+
+    Returns
+    -------
+    result : dict
+             The framelets, workers, wall time, number of commands, the time
+             spent in the commands and whether the run succeeded
+    """
+    run_dir = os.path.join(root, '{}_framelets_{}_workers'.format(framelets, workers))
+    input_list = make_observation(os.path.join(run_dir, 'input'), framelets)
+    def_file = os.path.join(run_dir, 'reg.def')
+    with open(def_file, 'w') as f:
+        f.write('Object = AutoRegistration\nEnd_Object\nEnd\n')
+    working_directory = os.path.join(run_dir, 'work')
+    report = os.path.join(run_dir, 'usage_report.json')
+
+    command = [sys.executable, control_obs, input_list, working_directory, def_file,
+               'RED', '-j', str(workers), '--report', report, '--pairs', pairs,
+               '--mosaic', mosaic]
+    start = time.time()
+    with open(os.path.join(run_dir, 'control_obs.log'), 'w') as log:
+        status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT,
+                                 cwd=run_dir, env=environment)
+    wall_time = time.time() - start
+
+    commands = 0
+    command_time = 0.0
+    if os.path.exists(report):
+        with open(report) as f:
+            records = json.load(f)['records']
+        commands = len(records)
+        command_time = sum(record['wall_time'] for record in records)
+    return {'framelets' : framelets,
+            'workers' : workers,
+            'wall_time' : wall_time,
+            'commands' : commands,
+            'command_time' : command_time,
+            'succeeded' : status == 0}
+
+
+def result_key(result):
+    return '{}x{}'.format(result['framelets'], result['workers'])
+
+
+def print_results(results, baseline, tolerance):
+    """
+    Print a table of the results and compare them to the baseline.
+
+    Returns
+    -------
+    regressions : list
+                  The results that were slower than the baseline by more
+                  than the tolerance
+    """
+    print('{:>9}  {:>7}  {:>9}  {:>8}  {:>11}  {:>10}  {:>13}  {:>10}  {}'.format(
+          'Framelets', 'Workers', 'Wall (s)', 'Commands', 'Command (s)', 'Efficiency',
+          'Overhead (ms)', 'Baseline', 'Status'))
+    regressions = []
+    for result in results:
+        # the time that is not explained by the commands, even if they were
+        # packed perfectly onto the workers, per framelet
+        overhead = result['wall_time'] - result['command_time'] / result['workers']
+        efficiency = result['command_time'] / (result['wall_time'] * result['workers'])
+        status = 'ok' if result['succeeded'] else 'FAILED'
+        baseline_time = ''
+        previous = baseline.get(result_key(result))
+        if previous is not None:
+            baseline_time = '{:.2f}'.format(previous['wall_time'])
+            if result['wall_time'] > previous['wall_time'] * (1 + tolerance):
+                status = 'REGRESSION {:+.0%}'.format(result['wall_time'] / previous['wall_time'] - 1)
+                regressions.append(result)
+        print('{:>9}  {:>7}  {:>9.2f}  {:>8}  {:>11.2f}  {:>10.0%}  {:>13.2f}  {:>10}  {}'.format(
+              result['framelets'], result['workers'], result['wall_time'], result['commands'],
+              result['command_time'], efficiency, 1000 * overhead / result['framelets'],
+              baseline_time, status))
+    return regressions
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                    help='The numbers of framelets to benchmark.')
+parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1],
+                    help='The numbers of workers to run control_obs.py with.')
+parser.add_argument('--stub-latency', type=float, default=0.0,
+                    help='Seconds each stub application run takes.')
+parser.add_argument('--stub-memory', type=float, default=0.0,
+                    help='Megabytes each stub application run allocates.')
+parser.add_argument('--pairs', choices=['sequential', 'overlap'], default='sequential',
+                    help='The pair selection to run control_obs.py with.')
+parser.add_argument('--mosaic', choices=['automos', 'tiled'], default='automos',
+                    help="""The mosaic engine to run control_obs.py with. The
+                            stub cam2map writes small projected cubes that
+                            the tiled mosaic reads.""")
+parser.add_argument('--baseline', metavar='FILE',
+                    help="""The baseline results, saved on the same machine
+                            with --save-baseline, to compare against. The
+                            comparison is opt-in, without this option the
+                            results are only printed.""")
+parser.add_argument('--save-baseline', metavar='FILE',
+                    help='Save the results to this file as a new baseline.')
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help="""How much slower than the baseline a run can be
+                            before it is reported as a regression.
+                            Defaults to 0.2, 20%%.""")
+parser.add_argument('--work-dir',
+                    help="""The directory for the benchmark runs. Defaults to a
+                            temporary directory that is removed afterwards.""")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    root = args.work_dir or tempfile.mkdtemp(prefix='cassis_benchmark_')
+    if os.path.exists(os.path.join(root, 'bin')):
+        shutil.rmtree(os.path.join(root, 'bin'))
+    install_stubs(os.path.join(root, 'bin'))
+    environment = dict(os.environ)
+    environment['PATH'] = os.path.join(root, 'bin') + os.pathsep + environment['PATH']
+    environment['CASSIS_STUB_LATENCY'] = str(args.stub_latency)
+    environment['CASSIS_STUB_MEMORY'] = str(args.stub_memory)
+
+    baseline = {}
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            parser.error('the baseline [{}] does not exist'.format(args.baseline))
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = []
+    try:
+        for framelets in args.sizes:
+            for workers in args.workers:
+                run_dir = os.path.join(root, '{}_framelets_{}_workers'.format(framelets, workers))
+                if os.path.exists(run_dir):
+                    shutil.rmtree(run_dir)
+                print('Running {} framelets with {} workers'.format(framelets, workers))
+                results.append(run_benchmark(root, framelets, workers, environment, args.pairs,
+                                             args.mosaic))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    regressions = print_results(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(dict((result_key(result), result) for result in results),
+                      f, indent=2, sort_keys=True)
+        print('Saved the baseline to {}'.format(args.save_baseline))
+
+    if regressions or not all(result['succeeded'] for result in results):
+        sys.exit(1)
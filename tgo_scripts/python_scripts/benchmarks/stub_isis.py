@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Stand in for the ISIS applications used by cassis_process, for benchmarking
+the processing without ISIS or real CaSSIS data.
+
+The benchmark puts a wrapper for each application on the PATH that runs this
+script with the name of the application as the first argument. Each stub
+writes small but plausible outputs, cube labels with the dimensions and
+filter of a CaSSIS framelet for cubes, small projected cubes with pixels
+from cam2map and short text files for everything else, so the labels
+cassis_process reads can be parsed and the projected framelets mosaicked. The -batchlist,
+-errlist and -onerror options are supported.
+
+The cost of each run can be set with environment variables:
+
+CASSIS_STUB_LATENCY
+    Seconds each run sleeps, default 0. A run of an application with
+    -batchlist sleeps this long for every row.
+
+CASSIS_STUB_MEMORY
+    Megabytes each run allocates and touches, default 0.
+
+CASSIS_STUB_LATENCY_<APPLICATION> and CASSIS_STUB_MEMORY_<APPLICATION>
+    Override the settings for one application, for example
+    CASSIS_STUB_LATENCY_CAM2MAP=0.5.
+"""
+
+import os, re, sys, time
+
+filters = ['PAN', 'RED', 'NIR', 'BLU']
+
+cube_label = '''Object = IsisCube
+  Object = Core
+    StartByte = 65537
+    Format    = Tile
+
+    Group = Dimensions
+      Samples = 2048
+      Lines   = 256
+      Bands   = 1
+    End_Group
+
+    Group = Pixels
+      Type       = Real
+      ByteOrder  = Lsb
+      Base       = 0.0
+      Multiplier = 1.0
+    End_Group
+  End_Object
+
+  Group = Instrument
+    SpacecraftName = TRACE GAS ORBITER
+    InstrumentId   = CaSSIS
+    Filter         = {filter}
+  End_Group
+End_Object
+
+Object = Label
+  Bytes = 65536
+End_Object
+End
+'''
+
+# a small map, so a mosaic of it stays small
+map_label = '''Group = Mapping
+  ProjectionName     = Equirectangular
+  TargetName         = Mars
+  EquatorialRadius   = 3396190.0 <meters>
+  PolarRadius        = 3376200.0 <meters>
+  LatitudeType       = Planetocentric
+  LongitudeDirection = PositiveEast
+  LongitudeDomain    = 360
+  CenterLongitude    = 0.0
+  CenterLatitude     = 0.0
+  MinimumLatitude    = 0.0
+  MaximumLatitude    = 0.1
+  MinimumLongitude   = 0.0
+  MaximumLongitude   = 0.05
+  PixelResolution    = 4.5 <meters/pixel>
+End_Group
+End
+'''
+
+# the projected framelets written by cam2map are real cubes, with pixels and
+# the Mapping group of the map, so they can be mosaicked with the tiled
+# mosaic. They step down the map with the framelet number.
+projected_samples = 256
+projected_lines = 128
+projected_label = '''Object = IsisCube
+  Object = Core
+    StartByte   = 65537
+    Format      = Tile
+    TileSamples = 128
+    TileLines   = 128
+
+    Group = Dimensions
+      Samples = {samples}
+      Lines   = {lines}
+      Bands   = 1
+    End_Group
+
+    Group = Pixels
+      Type       = Real
+      ByteOrder  = Lsb
+      Base       = 0.0
+      Multiplier = 1.0
+    End_Group
+  End_Object
+
+  Group = Instrument
+    SpacecraftName = TRACE GAS ORBITER
+    InstrumentId   = CaSSIS
+    Filter         = {filter}
+  End_Group
+
+  Group = BandBin
+    FilterName = {filter}
+  End_Group
+
+  Group = Mapping
+    ProjectionName     = Equirectangular
+    TargetName         = Mars
+    EquatorialRadius   = 3396190.0 <meters>
+    PolarRadius        = 3376200.0 <meters>
+    LatitudeType       = Planetocentric
+    LongitudeDirection = PositiveEast
+    LongitudeDomain    = 360
+    CenterLongitude    = 0.0
+    CenterLatitude     = 0.0
+    PixelResolution    = 4.5 <meters/pixel>
+    UpperLeftCornerX   = {x} <meters>
+    UpperLeftCornerY   = {y} <meters>
+  End_Group
+End_Object
+
+Object = Label
+  Bytes = 65536
+End_Object
+End
+'''
+
+# footprints step along the track with the framelet number, so neighbors
+# overlap within and across filters
+range_label = '''Group = UniversalGroundRange
+  MinimumLatitude  = {min_lat}
+  MaximumLatitude  = {max_lat}
+  MinimumLongitude = 0.0
+  MaximumLongitude = 1.0
+End_Group
+End
+'''
+
+
+def setting(name, application, default):
+    value = os.environ.get('CASSIS_STUB_{}_{}'.format(name, application.upper()))
+    if value is None:
+        value = os.environ.get('CASSIS_STUB_{}'.format(name), default)
+    return float(value)
+
+
+def find_filter(*filenames):
+    for filename in filenames:
+        fields = re.split(r'[-_.]', os.path.basename(filename))
+        for field in fields:
+            if field in filters:
+                return field
+    return 'RED'
+
+
+def framelet_number(filename):
+    numbers = re.findall(r'-(\d+)-', os.path.basename(filename))
+    return int(numbers[-1]) if numbers else 0
+
+
+def run(application, parameters):
+    time.sleep(setting('LATENCY', application, 0))
+    source = parameters.get('from', '')
+    for name in ['to', 'onet', 'mosaic']:
+        if name not in parameters:
+            continue
+        output = parameters[name]
+        with open(output, 'w') as f:
+            if application == 'mosrange':
+                f.write(map_label)
+            elif application == 'camrange':
+                latitude = 0.01 * framelet_number(source) + 0.003 * filters.index(find_filter(source))
+                f.write(range_label.format(min_lat=latitude, max_lat=latitude + 0.015))
+            elif application == 'cam2map' and output.endswith('.cub'):
+                line = 32 * (framelet_number(source) % 36)
+                f.write(projected_label.format(samples=projected_samples, lines=projected_lines,
+                                               filter=find_filter(source, output),
+                                               x=0.0, y=5926.0 - 4.5 * line).ljust(65536, '\0'))
+                f.truncate(65536 + 4 * projected_samples * projected_lines)
+            elif output.endswith('.cub'):
+                f.write(cube_label.format(filter=find_filter(source, output)))
+            else:
+                f.write('{} output\n'.format(application))
+    if application == 'spiceinit':
+        with open(source, 'a') as f:
+            f.write('spiceinit\n')
+    if application == 'jigsaw' and parameters.get('update', '').lower() == 'true':
+        with open(parameters['fromlist']) as f:
+            for cube in f.read().split():
+                with open(cube, 'a') as c:
+                    c.write('jigsaw\n')
+
+
+def main(application, arguments):
+    batch_list = error_list = None
+    parameters = {}
+    for argument in arguments:
+        name, _, value = argument.partition('=')
+        if name == '-batchlist':
+            batch_list = value
+        elif name == '-errlist':
+            error_list = value
+        elif not name.startswith('-'):
+            parameters[name.lower()] = value.strip('"')
+
+    memory = int(setting('MEMORY', application, 0) * 1024**2)
+    if memory:
+        # touch every page so the memory is resident
+        buffer = bytearray(memory)
+        buffer[::4096] = b'\1' * len(range(0, memory, 4096))
+
+    if batch_list is None:
+        run(application, parameters)
+        return 0
+
+    status = 0
+    with open(batch_list) as f:
+        rows = f.read().splitlines()
+    for row in rows:
+        columns = row.split()
+        row_parameters = {}
+        for name, value in parameters.items():
+            for index, column in enumerate(columns):
+                value = value.replace('${}'.format(index + 1), column)
+            row_parameters[name] = value
+        try:
+            run(application, row_parameters)
+        except (IOError, OSError):
+            status = 1
+            if error_list:
+                with open(error_list, 'a') as errors:
+                    errors.write(row + '\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,224 @@
+"""
+This module contains an incremental rebuild cache for the TGO CaSSIS
+processing steps.
+
+Every step that runs through run_step records a fingerprint of its command
+line, the state of its input files and the version of the tool it ran. When
+the same step is run again with the same fingerprint and its outputs have not
+changed since, it is skipped. Because a step that does run produces new
+outputs, everything downstream of a changed input is run again while
+everything upstream of it is skipped.
+"""
+
+import os, json, hashlib, shutil, threading
+
+# directory for the step records, caching is turned off when this is None
+cache_dir = None
+
+# files up to this size are fingerprinted by their content, larger files by
+# their size and modification time
+hash_size_limit = 64 * 1024**2
+
+# steps seen during this run, by the files they produce, so that files that
+# are modified in place by a later step can be recreated
+_producers = {}
+_lock = threading.RLock()
+
+
+def file_signature(filename):
+    """
+    Compute a signature for the current state of a file.
+
+    Parameters
+    ----------
+    filename : str
+               The file to fingerprint
+
+    Returns
+    -------
+    signature : str
+                The signature of the file, or None if it does not exist
+    """
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    if stat.st_size > hash_size_limit:
+        return 'stat:{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            digest.update(block)
+    return 'sha1:' + digest.hexdigest()
+
+
+def tool_version(tool):
+    """
+    Get a string identifying the version of an ISIS application.
+    This is the ISIS version file, if ISISROOT is set, plus the size and
+    modification time of the executable.
+
+    Parameters
+    ----------
+    tool : str
+           The name of the application
+
+    Returns
+    -------
+    version : str
+              The version string for the application
+    """
+    if not tool:
+        return ''
+    version = ''
+    isis_root = os.environ.get('ISISROOT')
+    if isis_root and os.path.isfile(os.path.join(isis_root, 'version')):
+        with open(os.path.join(isis_root, 'version')) as f:
+            version = f.readline().strip()
+    executable = shutil.which(tool)
+    if executable:
+        stat = os.stat(executable)
+        version += ' {}:{}:{}'.format(executable, stat.st_size, stat.st_mtime_ns)
+    return version
+
+
+def _record_file(key):
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+def _load_record(key):
+    record_file = _record_file(key)
+    if not os.path.exists(record_file):
+        return None
+    try:
+        with open(record_file) as f:
+            record = json.load(f)
+    except ValueError:
+        return None
+    if record.get('key') != key:
+        return None
+    return record
+
+
+def _save_record(record):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    record_file = _record_file(record['key'])
+    with open(record_file + '.tmp', 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+    os.rename(record_file + '.tmp', record_file)
+
+
+def _is_current(record, tool, inputs, outputs, updates):
+    if record is None or record['tool'] != tool:
+        return False
+    for filename in list(inputs) + list(updates):
+        if record['inputs'].get(filename) != file_signature(filename):
+            return False
+    for filename in list(outputs) + list(updates):
+        signature = file_signature(filename)
+        if signature is None or record['outputs'].get(filename) != signature:
+            return False
+    return True
+
+
+def run_step(key, action, inputs=(), outputs=(), updates=(), lists=(), tool=None):
+    """
+    Run a processing step unless it is up to date with the previous run.
+
+    Parameters
+    ----------
+    key : str
+          The command line, or other description, that identifies the step
+
+    action : callable
+             Runs the step and returns its status, 0 for success
+
+    inputs : list
+             The files the step reads
+
+    outputs : list
+              The files the step writes
+
+    updates : list
+              The files the step modifies in place, such as cubes that
+              spiceinit or jigsaw update=true change. If the step needs to run
+              again, these files are first recreated by the step that
+              produced them earlier in this run.
+
+    lists : list
+            List files used by the step. Their paths in the key are replaced
+            by their contents and the listed files are added to the inputs,
+            so temporary list file names do not affect the fingerprint.
+
+    tool : str
+           The name of the application the step runs, for its version
+
+    Returns
+    -------
+    status : int
+             The status of the step, 0 if it was skipped
+    """
+    inputs = list(inputs)
+    for list_file in lists:
+        with open(list_file) as f:
+            listed = f.read().splitlines()
+        key = key.replace(list_file, '[{}]'.format(','.join(listed)))
+        inputs += listed
+
+    if cache_dir is None:
+        return action()
+
+    with _lock:
+        for filename in outputs:
+            _producers[filename] = (key, action)
+        record = _load_record(key)
+    version = tool_version(tool)
+    if _is_current(record, version, inputs, outputs, updates):
+        print('Skipping up to date step: {}'.format(key))
+        return 0
+
+    # files modified in place that still hold the result of the previous run
+    # of this step have to be made again before it runs
+    if record is not None:
+        for filename in updates:
+            signature = file_signature(filename)
+            if signature is None or record['outputs'].get(filename) != signature:
+                continue
+            with _lock:
+                producer = _producers.get(filename)
+            if producer is None:
+                print('Cannot recreate [{}] before running: {}'.format(filename, key))
+                continue
+            status = producer[1]()
+            if status != 0:
+                return status
+
+    input_signatures = dict((filename, file_signature(filename)) for filename in inputs)
+    status = action()
+    with _lock:
+        if status != 0:
+            if os.path.exists(_record_file(key)):
+                os.remove(_record_file(key))
+            return status
+
+        record = {'key' : key,
+                  'tool' : version,
+                  'inputs' : input_signatures,
+                  'outputs' : {}}
+        for filename in list(outputs) + list(updates):
+            record['outputs'][filename] = file_signature(filename)
+        for filename in updates:
+            record['inputs'][filename] = record['outputs'][filename]
+        _save_record(record)
+
+        # the producers of the updated files now see the updated state as
+        # their own output, so they stay up to date
+        for filename in updates:
+            producer = _producers.get(filename)
+            if producer is None or producer[0] == key:
+                continue
+            producer_record = _load_record(producer[0])
+            if producer_record is not None:
+                producer_record['outputs'][filename] = record['outputs'][filename]
+                _save_record(producer_record)
+    return status
@@ -0,0 +1,505 @@
+"""
+This module contains the backends that run the external commands of
+cassis_process. Every command goes through the module level backend, so the
+same processing can run its commands in the calling process, in a local pool
+of worker processes, or on other machines through a job queue, without
+changing the orchestration.
+
+Commands are lists of arguments that are run directly, without a shell, by
+an asyncio event loop. The loop runs in a thread of its own, so the threads
+of the scheduler can all wait on it through run, while the commands
+themselves are waited for without blocking each other. At most
+max_commands commands run at the same time, however many threads submit
+them, and a command that runs longer than its timeout is killed. The output
+of a command can go to a log file of its own instead of the terminal.
+
+The queue is a directory on a filesystem shared with the worker machines.
+Each command is written to it as a job file, claimed by one of the workers
+started with cassis_worker.py, and its result is written back next to it.
+This stands in for a cluster batch queue.
+"""
+
+import os, sys, json, time, uuid, shlex, signal, socket, asyncio, weakref, subprocess, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# the number of commands that can run at the same time, through any backend,
+# or None for no limit. Set this before the first command runs.
+max_commands = None
+
+
+def command_args(command):
+    """
+    Get the arguments of a command.
+
+    Parameters
+    ----------
+    command : list or str
+              The arguments of the command, or a command line, which is
+              split like a shell would split it
+
+    Returns
+    -------
+    args : list
+           The arguments, starting with the application
+    """
+    if isinstance(command, str):
+        return shlex.split(command)
+    return [str(arg) for arg in command]
+
+
+def command_line(command):
+    """
+    Format a command as a command line that a shell would run the same way.
+    """
+    if isinstance(command, str):
+        return command
+    return shlex.join(command_args(command))
+
+
+class _Runner(object):
+    # the event loop that runs the commands of this process, in a daemon
+    # thread
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self.loop.run_forever, name='cassis_executor', daemon=True)
+        thread.start()
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+# the semaphore that limits the commands running on each event loop
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _call(coroutine):
+    # run a coroutine on the event loop of this process and wait for it,
+    # starting the loop the first time, or again after a fork
+    global _runner
+    with _runner_lock:
+        if _runner is None or _runner.pid != os.getpid():
+            _runner = _Runner()
+        runner = _runner
+    return runner.call(coroutine)
+
+
+async def _wait_pidfd(pid, pidfd):
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return os.wait4(pid, 0)
+
+
+def _wait(pid):
+    # a future that reaps a process with its resource usage when it exits,
+    # and a pidfd of the process or None. A pidfd lets the event loop watch
+    # for the exit, otherwise a thread waits in wait4, which cannot be
+    # cancelled, so the same future has to be awaited until the process is
+    # reaped.
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return loop.run_in_executor(None, os.wait4, pid, 0), None
+    return loop.create_task(_wait_pidfd(pid, pidfd)), pidfd
+
+
+def _kill(pid, pidfd):
+    # kill a process without reaping it, which is left to its waiter. The
+    # pidfd cannot refer to another process, even if this one has exited.
+    try:
+        if pidfd is not None:
+            signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _start(args, cwd, env, output):
+    # opening the log and starting the process can block on the filesystem,
+    # so this runs on a thread rather than on the event loop
+    if output:
+        with open(output, 'wb') as f:
+            return subprocess.Popen(args, cwd=cwd, env=env, stdout=f, stderr=subprocess.STDOUT)
+    return subprocess.Popen(args, cwd=cwd, env=env)
+
+
+async def execute_async(command, cwd=None, env=None, output=None, timeout=None):
+    """
+    Run a command without a shell and measure its resource usage.
+
+    Parameters
+    ----------
+    command : list or str
+              The arguments of the command, see command_args
+
+    cwd : str
+          The optional directory to run the command in
+
+    env : dict
+          The optional environment to run the command with
+
+    output : str
+             The optional file to write the standard output and error of the
+             command to, instead of the standard output
+
+    timeout : float
+              The optional number of seconds after which the command is
+              killed
+
+    Returns
+    -------
+    usage : dict
+            The exit status, or the negative signal number if the command was
+            killed by a signal, the arguments, the log file, whether it timed
+            out, the host it ran on, its start and end times, and the user
+            and system CPU time, maximum RSS and block I/O bytes of the
+            command and everything it started
+    """
+    args = command_args(command)
+    result = {'args' : args,
+              'log' : output,
+              'timed_out' : False,
+              'host' : socket.gethostname()}
+    start = time.time()
+    try:
+        process = await asyncio.get_running_loop().run_in_executor(None, _start, args, cwd, env, output)
+    except OSError as error:
+        # like a shell, 127 for an application that cannot be run
+        print('Failed to run command [{}]: {}'.format(command_line(args), error))
+        result.update({'status' : 127, 'start' : start, 'end' : start, 'error' : str(error)})
+        return result
+
+    waiter, pidfd = _wait(process.pid)
+    try:
+        # shielded, so a timeout leaves the waiter to reap the killed process
+        pid, wait_status, usage = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+    except asyncio.TimeoutError:
+        print('Killed command after {} s: {}'.format(timeout, command_line(args)))
+        # not process.kill, which can reap the process before the waiter
+        if not waiter.done():
+            _kill(process.pid, pidfd)
+        result['timed_out'] = True
+        pid, wait_status, usage = await waiter
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    end = time.time()
+    result.update({'status' : process.returncode,
+                   'start' : start,
+                   'end' : end,
+                   'wall_time' : end - start,
+                   'user_time' : usage.ru_utime,
+                   'system_time' : usage.ru_stime,
+                   # Linux reports the maximum resident set size in kilobytes
+                   'max_rss' : usage.ru_maxrss * 1024,
+                   'read_bytes' : usage.ru_inblock * 512,
+                   'write_bytes' : usage.ru_oublock * 512})
+    return result
+
+
+def execute(command, cwd=None, env=None, output=None, timeout=None):
+    """
+    Run a command without a shell and wait for it, see execute_async.
+    """
+    return _call(execute_async(command, cwd, env, output, timeout))
+
+
+class InlineBackend(object):
+    """
+    Run each command from the calling process, the default.
+    """
+    async def run_async(self, command, output=None, timeout=None):
+        """
+        Run a command on the event loop.
+
+        Parameters
+        ----------
+        command : list or str
+                  The arguments of the command, see command_args
+
+        output : str
+                 The optional log file for the output of the command
+
+        timeout : float
+                  The optional number of seconds after which the command is
+                  killed
+
+        Returns
+        -------
+        usage : dict
+                The exit status and resource usage, see execute_async
+        """
+        return await execute_async(command, output=output, timeout=timeout)
+
+    def run(self, command, output=None, timeout=None):
+        """
+        Run a command and wait for it to finish, see run_async.
+        """
+        return _call(self.run_async(command, output, timeout))
+
+    def shutdown(self):
+        """
+        Release the resources held by the backend.
+        """
+        pass
+
+
+class LocalPoolBackend(InlineBackend):
+    """
+    Run commands in a pool of local worker processes, which limits how many
+    run at once no matter how many threads submit them. The commands are
+    started by the small worker processes instead of the main process.
+
+    The workers are started by a fork server rather than forked from this
+    process, which by then has the event loop and scheduler threads running
+    and could fork while one of them holds a lock. The workers import the
+    main script, like spawned processes do, so its main code has to be
+    guarded by if __name__ == '__main__'.
+
+    Parameters
+    ----------
+    max_workers : int
+                  The number of commands that can run at the same time
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count()
+        self._pool = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    async def run_async(self, command, output=None, timeout=None):
+        # processes forked from this one cannot use its pool
+        if os.getpid() != self._pid:
+            return await execute_async(command, output=output, timeout=timeout)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('forkserver'))
+        future = self._pool.submit(execute, command, os.getcwd(), None, output, timeout)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        if self._pool is not None and os.getpid() == self._pid:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class QueueBackend(InlineBackend):
+    """
+    Run commands on cassis_worker.py workers through a job queue directory on
+    a shared filesystem.
+
+    A job is a JSON file with the arguments of the command, the working
+    directory and the environment to run it in, and its log file and
+    timeout. It is written to the pending directory of the queue, moved to
+    the running directory by the worker that claims it, and its result is
+    written to the done directory, where the submitter picks it up. The
+    output of a command without a log file of its own is written to the logs
+    directory and copied to the standard output of the submitter.
+
+    Workers refresh the modification time of the jobs they are running. A
+    running job that has not been refreshed for stale_timeout seconds is
+    assumed to have lost its worker and is put back in the queue as a new
+    attempt. Each attempt has its own job file name, so the worker of an
+    earlier attempt, if it was only slow, cannot remove the running file of
+    the new one, and its result is ignored.
+
+    Parameters
+    ----------
+    queue_dir : str
+                The queue directory
+
+    poll_interval : float
+                    Seconds between checks for the result of a job
+
+    stale_timeout : float
+                    Seconds after which a running job without a live worker
+                    is queued again
+    """
+    def __init__(self, queue_dir, poll_interval=0.5, stale_timeout=300):
+        self.queue_dir = queue_dir
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        make_queue(queue_dir)
+
+    async def run_async(self, command, output=None, timeout=None):
+        # the time in the name keeps the queue in submission order
+        job_id = '{:020d}_{}'.format(time.time_ns(), uuid.uuid4().hex)
+        job = {'command' : command_args(command),
+               'cwd' : os.getcwd(),
+               'env' : dict(os.environ),
+               'output' : output and os.path.abspath(output),
+               'timeout' : timeout}
+        attempt = 0
+        job_name = _job_name(job_id, attempt)
+        _write_json(os.path.join(self.queue_dir, 'pending', job_name), job)
+
+        while not os.path.exists(os.path.join(self.queue_dir, 'done', job_name)):
+            await asyncio.sleep(self.poll_interval)
+            running = os.path.join(self.queue_dir, 'running', job_name)
+            try:
+                stale = time.time() - os.path.getmtime(running) > self.stale_timeout
+                if stale:
+                    # only the claim of this attempt is removed, a worker
+                    # that finishes it anyway finds it gone
+                    os.remove(running)
+            except OSError:
+                continue
+            if stale:
+                print('Queuing job again after losing its worker: {}'.format(command_line(command)))
+                attempt += 1
+                job_name = _job_name(job_id, attempt)
+                _write_json(os.path.join(self.queue_dir, 'pending', job_name), job)
+
+        with open(os.path.join(self.queue_dir, 'done', job_name)) as f:
+            usage = json.load(f)
+        # the results and logs of every attempt, the earlier ones are ignored
+        for earlier in range(attempt + 1):
+            name = os.path.splitext(_job_name(job_id, earlier))[0]
+            log = os.path.join(self.queue_dir, 'logs', name + '.log')
+            if earlier == attempt and os.path.exists(log):
+                with open(log) as f:
+                    sys.stdout.write(f.read())
+                sys.stdout.flush()
+            for filename in [os.path.join(self.queue_dir, 'done', name + '.json'), log]:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+        return usage
+
+
+def _job_name(job_id, attempt):
+    # the file name of an attempt of a job, in every directory of the queue.
+    # Only one worker can claim the pending file of an attempt, so the name
+    # also identifies the claim.
+    return '{}_{}.json'.format(job_id, attempt)
+
+
+def make_queue(queue_dir):
+    """
+    Create the directories of a job queue if they do not exist.
+    """
+    for directory in ['pending', 'running', 'done', 'logs']:
+        os.makedirs(os.path.join(queue_dir, directory), exist_ok=True)
+
+
+def _write_json(filename, data):
+    # write to a temporary name first so readers never see a partial file
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(filename + '.tmp', filename)
+
+
+def claim_job(queue_dir):
+    """
+    Claim the oldest pending job in a queue.
+
+    Parameters
+    ----------
+    queue_dir : str
+                The queue directory
+
+    Returns
+    -------
+    job_name : str
+               The name of the claimed job, now in the running directory, or
+               None if there are no pending jobs
+    """
+    pending_dir = os.path.join(queue_dir, 'pending')
+    for job_name in sorted(os.listdir(pending_dir)):
+        if not job_name.endswith('.json'):
+            continue
+        try:
+            # only one worker can move the file, the others get an error
+            os.rename(os.path.join(pending_dir, job_name),
+                      os.path.join(queue_dir, 'running', job_name))
+        except OSError:
+            continue
+        return job_name
+    return None
+
+
+def run_job(queue_dir, job_name):
+    """
+    Run a claimed job and write its result to the done directory.
+
+    Parameters
+    ----------
+    queue_dir : str
+                The queue directory
+
+    job_name : str
+               The name of the job in the running directory. If the job is
+               no longer there when it has run, it was queued again, and its
+               result is dropped.
+    """
+    running = os.path.join(queue_dir, 'running', job_name)
+    with open(running) as f:
+        job = json.load(f)
+    log = job.get('output') or os.path.join(queue_dir, 'logs', os.path.splitext(job_name)[0] + '.log')
+    try:
+        usage = execute(job['command'], job['cwd'], job['env'], log, job.get('timeout'))
+    except OSError as error:
+        usage = {'status' : 1, 'host' : socket.gethostname(), 'error' : str(error)}
+    if not os.path.exists(running):
+        # the submitter gave up on this worker and queued the job again
+        print('Dropping the result of job {}, it was queued again'.format(job_name))
+        return
+    _write_json(os.path.join(queue_dir, 'done', job_name), usage)
+    try:
+        os.remove(running)
+    except OSError:
+        pass
+
+
+# the backend every command runs through
+backend = InlineBackend()
+
+
+async def run_async(command, output=None, timeout=None):
+    """
+    Run a command with the current backend, once fewer than max_commands
+    commands are running.
+
+    Parameters
+    ----------
+    command : list or str
+              The arguments of the command, see command_args
+
+    output : str
+             The optional log file for the output of the command
+
+    timeout : float
+              The optional number of seconds after which the command is
+              killed
+
+    Returns
+    -------
+    usage : dict
+            The exit status and resource usage, see execute_async
+    """
+    if not max_commands:
+        return await backend.run_async(command, output, timeout)
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(max_commands)
+    async with _semaphores[loop]:
+        return await backend.run_async(command, output, timeout)
+
+
+def run(command, output=None, timeout=None):
+    """
+    Run a command with the current backend and wait for it, see run_async.
+    This can be called from any thread.
+    """
+    return _call(run_async(command, output, timeout))
@@ -0,0 +1,263 @@
+"""
+This module mosaics projected framelets in Python, as an alternative to
+automos and cubeit. Each framelet is placed in the mosaic by the upper left
+corner and pixel resolution in its Mapping group, so all of the framelets
+have to be projected with the same map, as cam2map does with a map file.
+
+The mosaic is written one block of output tiles at a time, by a pool of
+threads. Each block only reads the parts of the framelets that overlap it,
+through memory maps, so the memory used stays about the size of a block for
+each thread, however large the mosaic is. A mosaic can have several bands,
+such as one for each filter, and they are all written in one pass.
+"""
+
+import math, os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import isis_cube, isis_label
+
+# how the framelets that overlap are combined, ontop puts later framelets on
+# top of earlier ones, like automos priority=ontop, beneath puts earlier ones
+# on top and average averages the valid pixels
+priorities = ['ontop', 'beneath', 'average']
+
+
+def _mapping(cube):
+    return isis_label.read_label(cube).find('Group', 'Mapping')
+
+
+def _equirectangular(mapping):
+    # the radius, center longitude, cosine of the center latitude and
+    # longitude direction of an equirectangular projection, or None for
+    # other projections, and maps without the keywords to convert them,
+    # whose ground ranges are not converted
+    if mapping.get('ProjectionName', '').lower() != 'equirectangular' or \
+            mapping.get('LatitudeType', 'Planetocentric').lower() != 'planetocentric':
+        return None
+    if not all(name in mapping for name in ['EquatorialRadius', 'CenterLongitude', 'CenterLatitude']):
+        return None
+    direction = -1.0 if mapping.get('LongitudeDirection', '').lower() == 'positivewest' else 1.0
+    return (float(mapping['EquatorialRadius']),
+            direction * math.radians(float(mapping['CenterLongitude'])),
+            math.cos(math.radians(float(mapping['CenterLatitude']))),
+            direction)
+
+
+def map_extent(mapping):
+    """
+    Compute the projection coordinates of the ground range of a map.
+
+    Parameters
+    ----------
+    mapping : PvlBlock
+              The Mapping group of the map, with its latitude and longitude
+              range
+
+    Returns
+    -------
+    extent : tuple
+             The minimum x, maximum x, minimum y and maximum y in meters, or
+             None if the map is not a planetocentric equirectangular map or
+             has no ground range
+    """
+    projection = _equirectangular(mapping)
+    names = ['MinimumLatitude', 'MaximumLatitude', 'MinimumLongitude', 'MaximumLongitude']
+    if projection is None or not all(name in mapping for name in names):
+        return None
+    radius, center_longitude, cos_center_latitude, direction = projection
+    x = [radius * (direction * math.radians(float(mapping[name])) - center_longitude) * cos_center_latitude
+         for name in ['MinimumLongitude', 'MaximumLongitude']]
+    y = [radius * math.radians(float(mapping[name])) for name in ['MinimumLatitude', 'MaximumLatitude']]
+    return min(x), max(x), min(y), max(y)
+
+
+def _ground_range(mapping, extent):
+    # the latitude and longitude range of an extent, as Mapping keywords
+    projection = _equirectangular(mapping)
+    if projection is None:
+        return []
+    radius, center_longitude, cos_center_latitude, direction = projection
+    min_x, max_x, min_y, max_y = extent
+    longitudes = sorted(math.degrees(direction * (x / (radius * cos_center_latitude) + center_longitude))
+                        for x in [min_x, max_x])
+    return [('MinimumLatitude', repr(math.degrees(min_y / radius))),
+            ('MaximumLatitude', repr(math.degrees(max_y / radius))),
+            ('MinimumLongitude', repr(longitudes[0])),
+            ('MaximumLongitude', repr(longitudes[1]))]
+
+
+def _mosaic_block(args):
+    (band, first_line, last_line, first_sample, last_sample), placements, priority, output_file = args
+    shape = (last_line - first_line, last_sample - first_sample)
+    if priority == 'average':
+        total = np.zeros(shape)
+        count = np.zeros(shape, np.int32)
+    else:
+        result = np.full(shape, np.nan, np.float32)
+    if priority == 'beneath':
+        placements = reversed(placements)
+
+    for filename, line, sample, lines, samples in placements:
+        top = max(first_line, line)
+        bottom = min(last_line, line + lines)
+        left = max(first_sample, sample)
+        right = min(last_sample, sample + samples)
+        if top >= bottom or left >= right:
+            continue
+        # cubes of their own for each block, so their memory maps are
+        # closed when the block is done and only the block stays in memory
+        cube = isis_cube.Cube(filename)
+        values = cube.dn(cube.read((top - line, bottom - line), (left - sample, right - sample), 0))
+        window = (slice(top - first_line, bottom - first_line), slice(left - first_sample, right - first_sample))
+        valid = ~np.isnan(values)
+        if priority == 'average':
+            total[window][valid] += values[valid]
+            count[window] += valid
+        else:
+            result[window][valid] = values[valid]
+
+    if priority == 'average':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = (total / count).astype(np.float32)
+    output = isis_cube.Cube(output_file, 'r+')
+    result[np.isnan(result)] = output.null
+    output.write(result, (first_line, last_line), (first_sample, last_sample), band)
+
+
+def mosaic_cubes(bands, output_file, map_file='', priority='ontop', band_names=None,
+                 block_size=512, max_workers=None):
+    """
+    Mosaic projected framelets into one cube, with a band for each list of
+    framelets.
+
+    Parameters
+    ----------
+    bands : list
+            For each band of the mosaic, the list of projected framelets to
+            mosaic into it, in priority order. The first band of each
+            framelet is used.
+
+    output_file : str
+                  The filename of the output mosaic
+
+    map_file : str
+               Optional map file whose ground range is the extent of the
+               mosaic, for planetocentric equirectangular maps. If not
+               entered, the mosaic will be made sufficiently large to
+               contain the image data.
+
+    priority : str
+               How overlapping framelets are combined, see priorities.
+               Defaults to ontop.
+
+    band_names : list
+                 Optional filter names of the bands, for the BandBin group
+
+    block_size : int
+                 The lines and samples of the blocks of the mosaic written
+                 at a time, rounded up to whole tiles
+
+    max_workers : int
+                  The number of threads writing blocks, defaults to the
+                  number of processors
+
+    Returns
+    -------
+    cube : isis_cube.Cube
+           The mosaic
+
+    Raises
+    ------
+    ValueError
+               If there are no framelets, the priority is unknown, or the
+               framelets are not projected with the same map
+    """
+    if priority not in priorities:
+        raise ValueError('Unknown mosaic priority [{}]'.format(priority))
+    framelets = [filename for filenames in bands for filename in filenames]
+    if not framelets:
+        raise ValueError('No framelets to mosaic')
+
+    # the corners of the framelets, which must share a projection and resolution
+    mapping = _mapping(framelets[0])
+    resolution = float(mapping['PixelResolution'])
+    corners = {}
+    for filename in framelets:
+        framelet_mapping = _mapping(filename)
+        if framelet_mapping.get('ProjectionName') != mapping.get('ProjectionName') or \
+                not math.isclose(float(framelet_mapping['PixelResolution']), resolution, rel_tol=1e-9):
+            raise ValueError('Framelet [{}] is not projected like framelet [{}]'.format(filename, framelets[0]))
+        cube = isis_cube.Cube(filename)
+        corners[filename] = (float(framelet_mapping['UpperLeftCornerX']),
+                             float(framelet_mapping['UpperLeftCornerY']),
+                             cube.lines, cube.samples)
+
+    extent = None
+    if map_file:
+        extent = map_extent(isis_label.read_label(map_file).find('Group', 'Mapping'))
+    if extent is None:
+        extent = (min(x for x, y, lines, samples in corners.values()),
+                  max(x + samples * resolution for x, y, lines, samples in corners.values()),
+                  min(y - lines * resolution for x, y, lines, samples in corners.values()),
+                  max(y for x, y, lines, samples in corners.values()))
+
+    # line up the corner of the mosaic with the pixels of the framelets
+    x0, y0 = corners[framelets[0]][:2]
+    left = x0 + round((extent[0] - x0) / resolution) * resolution
+    top = y0 + round((extent[3] - y0) / resolution) * resolution
+    samples = max(1, int(round((extent[1] - left) / resolution)))
+    lines = max(1, int(round((top - extent[2]) / resolution)))
+
+    output_mapping = isis_label.parse_label(isis_label.read_label_text(framelets[0])).find('Group', 'Mapping')
+    output_mapping['UpperLeftCornerX'] = repr(left)
+    output_mapping['UpperLeftCornerY'] = repr(top)
+    output_mapping.keywords = [keyword for keyword in output_mapping.keywords
+                               if not keyword[0].lower().endswith(('latitude', 'longitude'))
+                               or keyword[0].lower().startswith('center')]
+    output_mapping.keywords += _ground_range(mapping, (left, left + samples * resolution,
+                                                       top - lines * resolution, top))
+    groups = [output_mapping]
+    if band_names:
+        band_bin = isis_label.PvlBlock('Group', 'BandBin')
+        band_bin.keywords = [('FilterName', list(band_names))]
+        groups.insert(0, band_bin)
+
+    output_dir = os.path.dirname(output_file)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    output = isis_cube.create_cube(output_file, samples, lines, len(bands), groups, fill=False)
+
+    # the framelets overlapping each block of the mosaic
+    # in whole tiles both ways, since the threads rewrite the tiles their
+    # blocks only partly cover
+    tile_size = math.lcm(output.tile_lines, output.tile_samples)
+    block_size = -(-block_size // tile_size) * tile_size
+    blocks = {}
+    for band, filenames in enumerate(bands):
+        for filename in filenames:
+            x, y, framelet_lines, framelet_samples = corners[filename]
+            line = int(round((top - y) / resolution))
+            sample = int(round((x - left) / resolution))
+            placement = (filename, line, sample, framelet_lines, framelet_samples)
+            first_line = max(0, line)
+            last_line = min(lines, line + framelet_lines)
+            first_sample = max(0, sample)
+            last_sample = min(samples, sample + framelet_samples)
+            if first_line >= last_line or first_sample >= last_sample:
+                continue
+            for row in range(first_line // block_size, (last_line - 1) // block_size + 1):
+                for column in range(first_sample // block_size, (last_sample - 1) // block_size + 1):
+                    blocks.setdefault((band, row, column), []).append(placement)
+
+    work = []
+    for band in range(len(bands)):
+        for first_line in range(0, lines, block_size):
+            for first_sample in range(0, samples, block_size):
+                block = (band, first_line, min(first_line + block_size, lines),
+                         first_sample, min(first_sample + block_size, samples))
+                placements = blocks.get((band, first_line // block_size, first_sample // block_size), [])
+                work.append((block, placements, priority, output_file))
+    with ThreadPoolExecutor(max_workers) as pool:
+        # list raises the first exception from the blocks
+        list(pool.map(_mosaic_block, work))
+    return output
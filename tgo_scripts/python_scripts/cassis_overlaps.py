@@ -0,0 +1,270 @@
+"""
+This module selects the framelet pairs to match from their ground footprints,
+instead of only matching each framelet with the next one of its filter.
+Pairs are chosen wherever two framelets overlap on the ground, within a
+filter and across filters, so the combined network gets its ties between
+filters directly from the matching.
+
+A footprint is the latitude and longitude range of a framelet, as reported
+by camrange. A framelet that crosses the 0/360 longitude seam has a minimum
+longitude below 0, and is split in two at the seam where the footprints are
+compared. The footprints are kept in a grid of cells about the size of a
+framelet, so each framelet is only compared with the framelets in the cells
+it touches instead of with every other framelet.
+"""
+
+import math
+import isis_label
+
+
+def read_footprint(range_file):
+    """
+    Read the footprint of a framelet from the output of camrange.
+
+    Parameters
+    ----------
+    range_file : str
+                 The camrange output file
+
+    Returns
+    -------
+    footprint : tuple
+                The minimum latitude, maximum latitude, minimum longitude and
+                maximum longitude of the framelet in degrees, see
+                normalize_footprint
+    """
+    label = isis_label.read_label(range_file)
+    ground_range = label.find('Group', 'UniversalGroundRange')
+    footprint = tuple(float(ground_range[name]) for name in ['MinimumLatitude',
+                                                             'MaximumLatitude',
+                                                             'MinimumLongitude',
+                                                             'MaximumLongitude'])
+    if footprint[3] - footprint[2] > 180:
+        # a framelet across the 0/360 seam, whose range in the -180 to 180
+        # domain does not cross it
+        try:
+            east_180 = label.find('Group', 'PositiveEast180')
+            longitudes = (float(east_180['MinimumLongitude']), float(east_180['MaximumLongitude']))
+        except (KeyError, ValueError):
+            longitudes = None
+        if longitudes and longitudes[1] - longitudes[0] <= 180:
+            return footprint[:2] + longitudes
+    return normalize_footprint(footprint)
+
+
+def normalize_footprint(footprint):
+    """
+    Put the longitudes of a footprint in the 0 to 360 domain. A footprint
+    that spans more than 180 degrees of longitude, but not all of them, is
+    taken to cross the 0/360 seam instead, from its maximum longitude to its
+    minimum longitude. Footprints that cross the seam have a minimum
+    longitude below 0.
+
+    Parameters
+    ----------
+    footprint : tuple
+                The minimum latitude, maximum latitude, minimum longitude and
+                maximum longitude in degrees
+
+    Returns
+    -------
+    footprint : tuple
+                The footprint, with a minimum longitude from -180 to 360 and
+                a maximum longitude no more than 360 degrees from it
+    """
+    min_lat, max_lat, min_lon, max_lon = footprint
+    if max_lon - min_lon >= 360:
+        return (min_lat, max_lat, 0.0, 360.0)
+    offset = math.floor(min_lon / 360) * 360
+    min_lon -= offset
+    max_lon -= offset
+    if max_lon - min_lon > 180:
+        min_lon, max_lon = max_lon - 360, min_lon
+    elif max_lon > 360:
+        min_lon, max_lon = min_lon - 360, max_lon - 360
+    return (min_lat, max_lat, min_lon, max_lon)
+
+
+def _boxes(footprint):
+    # the footprint split at the 0/360 seam
+    min_lat, max_lat, min_lon, max_lon = footprint
+    if min_lon < 0:
+        return [(min_lat, max_lat, min_lon + 360, 360.0), (min_lat, max_lat, 0.0, max_lon)]
+    return [footprint]
+
+
+def overlap_area(footprint, other):
+    """
+    Compute the area where two footprints overlap.
+
+    Parameters
+    ----------
+    footprint : tuple
+                The first footprint, see read_footprint
+
+    other : tuple
+            The second footprint
+
+    Returns
+    -------
+    area : float
+           The overlap in square degrees of latitude, with the longitude
+           scaled by the cosine of the latitude, or 0 if the footprints do
+           not overlap
+    """
+    return sum(_box_overlap(box, other_box) for box in _boxes(footprint) for other_box in _boxes(other))
+
+
+def _box_overlap(footprint, other):
+    min_lat = max(footprint[0], other[0])
+    max_lat = min(footprint[1], other[1])
+    min_lon = max(footprint[2], other[2])
+    max_lon = min(footprint[3], other[3])
+    if min_lat >= max_lat or min_lon >= max_lon:
+        return 0.0
+    return (max_lat - min_lat) * (max_lon - min_lon) * math.cos(math.radians((min_lat + max_lat) / 2))
+
+
+class FootprintIndex(object):
+    """
+    A grid of cells that finds the footprints overlapping a footprint.
+
+    Parameters
+    ----------
+    cell_size : float
+                The size of the cells in degrees. About the size of one
+                footprint works best.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.footprints = {}
+
+    def _cells(self, footprint):
+        cells = set()
+        for min_lat, max_lat, min_lon, max_lon in _boxes(footprint):
+            for row in range(math.floor(min_lat / self.cell_size), math.floor(max_lat / self.cell_size) + 1):
+                for column in range(math.floor(min_lon / self.cell_size),
+                                    math.floor(max_lon / self.cell_size) + 1):
+                    cells.add((row, column))
+        return cells
+
+    def insert(self, key, footprint):
+        """
+        Add a footprint to the index.
+
+        Parameters
+        ----------
+        key : object
+              The key to return from query for the footprint
+
+        footprint : tuple
+                    The footprint, see read_footprint
+        """
+        self.footprints[key] = footprint
+        for cell in self._cells(footprint):
+            self.cells.setdefault(cell, []).append(key)
+
+    def query(self, footprint):
+        """
+        Find the footprints in the index that overlap a footprint.
+
+        Parameters
+        ----------
+        footprint : tuple
+                    The footprint to look for, see read_footprint
+
+        Returns
+        -------
+        overlaps : list
+                   (key, area) tuples for each overlapping footprint
+        """
+        candidates = set()
+        for cell in self._cells(footprint):
+            candidates.update(self.cells.get(cell, ()))
+        overlaps = []
+        for key in candidates:
+            area = overlap_area(footprint, self.footprints[key])
+            if area > 0:
+                overlaps.append((key, area))
+        return overlaps
+
+
+def overlapping_pairs(footprints, max_pairs=4, min_overlap=0.0):
+    """
+    Select the pairs of framelets to match from their footprints.
+
+    The pairs are ranked by their overlap area. The largest overlaps that
+    connect every group of overlapping framelets are always kept, so the
+    network stays connected, then the next largest overlaps are added while
+    both framelets have fewer than max_pairs pairs.
+
+    Parameters
+    ----------
+    footprints : list
+                 (key, footprint) tuples for each framelet, in the order the
+                 framelets were taken. The footprints are normalized, see
+                 normalize_footprint.
+
+    max_pairs : int
+                The number of pairs each framelet should have at most, apart
+                from the pairs needed to keep the network connected
+
+    min_overlap : float
+                  The smallest overlap of a pair, as a fraction of the area
+                  of the smaller footprint. Defaults to 0, any overlap.
+
+    Returns
+    -------
+    pairs : list
+            (key, key, area) tuples for the selected pairs, with the earlier
+            framelet first, from the largest overlap to the smallest
+    """
+    if not footprints:
+        return []
+    footprints = [(key, normalize_footprint(footprint)) for key, footprint in footprints]
+
+    # size the cells from a typical footprint
+    sizes = sorted(max(footprint[1] - footprint[0], footprint[3] - footprint[2])
+                   for key, footprint in footprints)
+    cell_size = sizes[len(sizes) // 2] or 1.0
+
+    index = FootprintIndex(cell_size)
+    order = {}
+    candidates = []
+    for key, footprint in footprints:
+        area = overlap_area(footprint, footprint)
+        for other, overlap in index.query(footprint):
+            smaller = min(area, overlap_area(index.footprints[other], index.footprints[other]))
+            if overlap >= min_overlap * smaller:
+                candidates.append((other, key, overlap))
+        order[key] = len(order)
+        index.insert(key, footprint)
+    candidates.sort(key=lambda pair: (-pair[2], order[pair[0]], order[pair[1]]))
+
+    # keep the largest overlaps that join separate groups of framelets
+    groups = dict((key, key) for key in order)
+
+    def group(key):
+        while groups[key] != key:
+            groups[key] = groups[groups[key]]
+            key = groups[key]
+        return key
+
+    selected = set()
+    counts = dict((key, 0) for key in order)
+    for position, (key, other, area) in enumerate(candidates):
+        if group(key) != group(other):
+            groups[group(key)] = group(other)
+            selected.add(position)
+            counts[key] += 1
+            counts[other] += 1
+
+    # then fill up to the cap with the largest remaining overlaps
+    for position, (key, other, area) in enumerate(candidates):
+        if position not in selected and counts[key] < max_pairs and counts[other] < max_pairs:
+            selected.add(position)
+            counts[key] += 1
+            counts[other] += 1
+
+    return [pair for position, pair in enumerate(candidates) if position in selected]
@@ -0,0 +1,852 @@
+"""
+This module describes the processing of a TGO CaSSIS observation, from
+framelet labels to a controlled color mosaic, as a graph of cassis_process
+steps. The graph is run by cassis_scheduler.TaskGraph, so each step starts
+as soon as its own inputs are ready. For example, the mosaic for one filter
+starts as soon as that filter's framelets are projected.
+
+In streaming mode, framelets can be added while the graph runs, for example
+as their labels are downlinked, and each pair of neighboring framelets is
+matched as soon as both are ingested.
+"""
+
+import os, time
+from xml.etree import ElementTree
+import cassis_cache, cassis_overlaps, cassis_process, isis_cube, isis_label
+
+# the filters, in the band order of the color mosaic
+filters = ['PAN', 'RED', 'NIR', 'BLU']
+
+# slot for the cam2map jobs, limited by the CPUs and memory available
+projection_slot = 'cam2map'
+
+# how ingested cubes are staged for the bundle adjustment, see
+# isis_cube.stage_cube
+staging_method = 'auto'
+
+# how each filter is mosaicked, see cassis_process.mosaic_filter
+mosaic_engine = 'automos'
+
+# if non-zero, the framelets of each observation are ingested and projected
+# with -batchlist, in this many batches at a time, see
+# cassis_process.run_batchlist. Streaming observations still ingest each
+# framelet as it arrives.
+batch_shards = 0
+
+
+def ingest_and_classify(filename, output_dir, expected_filter=None):
+    """
+    Ingest a framelet and read which filter it was taken through.
+
+    Parameters
+    ----------
+    filename : str
+               The XML label of the framelet to ingest
+
+    output_dir : str
+                 The directory where the output cube will be
+
+    expected_filter : str
+                      The optional filter the framelet should have, for
+                      example from its file name
+
+    Returns
+    -------
+    cube : str
+           The ingested cube
+
+    filter : str
+             The name of the framelet's filter
+    """
+    cube = cassis_process.ingest_framelet(filename, output_dir)
+    return classify_framelet(cube, expected_filter)
+
+
+def classify_framelet(cube, expected_filter=None):
+    """
+    Read which filter an ingested framelet was taken through.
+
+    Parameters
+    ----------
+    cube : str
+           The ingested cube
+
+    expected_filter : str
+                      The optional filter the framelet should have
+
+    Returns
+    -------
+    cube : str
+           The ingested cube
+
+    filter : str
+             The name of the framelet's filter
+    """
+    filter = isis_label.get_key(cube, 'Filter', 'IsisCube', 'Instrument')
+    if filter not in filters:
+        raise RuntimeError('Unknown filter [{}] in cube [{}]'.format(filter, cube))
+    if expected_filter and filter != expected_filter:
+        raise RuntimeError('Cube [{}] has filter [{}], expected [{}]'.format(cube, filter, expected_filter))
+    return cube, filter
+
+
+def framelet_footprint(cube, footprint_dir):
+    """
+    Compute the ground footprint of an ingested framelet.
+
+    Parameters
+    ----------
+    cube : str
+           The ingested cube
+
+    footprint_dir : str
+                    The directory for the camrange output
+
+    Returns
+    -------
+    footprint : tuple
+                The latitude and longitude range of the framelet, see
+                cassis_overlaps.read_footprint
+    """
+    footprint_file = os.path.join(footprint_dir, os.path.basename(cube)[:-4] + '.pvl')
+    if cassis_process.compute_footprint(cube, footprint_file) != 0:
+        raise RuntimeError('Failed to compute the footprint of [{}]'.format(cube))
+    return cassis_overlaps.read_footprint(footprint_file)
+
+
+def stage_adjusted(cube, adjusted_dir):
+    """
+    Stage an ingested cube in the directory of cubes that will have their
+    pointing updated by the bundle adjustment, with the module's
+    staging_method. By default this shares the pixels of the ingested cube,
+    with a reflink or a detached label, and only copies the whole cube if
+    neither works. The staging goes through the rebuild cache, so it can be
+    made again if the bundle adjustment has to be rerun on cubes it already
+    updated.
+
+    Parameters
+    ----------
+    cube : str
+           The ingested cube
+
+    adjusted_dir : str
+                   The directory for the adjusted cubes
+
+    Returns
+    -------
+    adjusted_cube : str
+                    The staged cube
+    """
+    adjusted_cube = os.path.join(adjusted_dir, os.path.basename(cube))
+
+    def stage():
+        isis_cube.stage_cube(cube, adjusted_cube, staging_method)
+        return 0
+
+    cassis_cache.run_step('stage {} {} {}'.format(staging_method, cube, adjusted_cube), stage,
+                          inputs=[cube], outputs=[adjusted_cube])
+    return adjusted_cube
+
+
+def read_manifest(filename):
+    """
+    Read a manifest of observations to process together. Each line has the
+    input list, working directory, definition file and reference filter of
+    an observation, the same as the arguments of control_obs.py, separated
+    by white space. Blank lines and lines starting with # are ignored.
+
+    Parameters
+    ----------
+    filename : str
+               The manifest file
+
+    Returns
+    -------
+    observations : list
+                   A tuple for each observation of its input list, working
+                   directory, definition file and reference filter, in
+                   manifest order
+
+    Raises
+    ------
+    ValueError
+               If a line does not have four fields or two observations have
+               the same working directory
+    """
+    observations = []
+    working_directories = set()
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) != 4:
+                raise ValueError('Line {} of manifest [{}] does not have 4 fields'.format(number, filename))
+            working_directory = os.path.normpath(fields[1])
+            if working_directory in working_directories:
+                raise ValueError('Line {} of manifest [{}] reuses working directory [{}]'.format(
+                                 number, filename, fields[1]))
+            working_directories.add(working_directory)
+            observations.append(tuple(fields))
+    return observations
+
+
+
+
+class Observation(object):
+    """
+    The tasks that process one observation in a task graph.
+
+    Framelets are added one at a time with add_framelet, which ingests them
+    and stages them in the adjusted directory as soon as possible. Once
+    every framelet has been added, finish adds the tasks for matching, bundle
+    adjusting, projecting, mosaicking, registering and stacking, which start
+    once every framelet is ingested and its filter is known.
+
+    In streaming mode, the filter of each framelet is taken from its file
+    name, and checked against its label when it is ingested, so each
+    framelet is matched with the previous framelet of the same filter as soon
+    as both are ingested, while later framelets are still being added or
+    ingested. The framelets have to be added in the order they were taken.
+    A framelet that fails to ingest is left out, as it is without streaming, and the
+    next framelet of its filter is matched with the one before it instead.
+
+    With overlap pair selection, the ground footprint of each framelet is
+    computed once it is ingested, and the framelets are matched wherever
+    their footprints overlap, within and across filters, instead of only
+    with the next framelet of their filter. The networks then tie the
+    filters together themselves, so the combined network is not extended
+    with cnetadd and pointreg. This cannot be used in streaming mode.
+
+    Parameters
+    ----------
+    graph : TaskGraph
+            The graph to add the tasks to
+
+    working_directory : str
+                        The directory where output files will be made
+
+    def_file : str
+               The definition file used to sub pixel register the networks
+
+    reference_filter : str
+                       The filter whose center framelet will be held fixed and
+                       that the other filter mosaics will be registered to
+
+    tolerant : bool
+               If framelet pairs that fail to match should be left out of the
+               filter networks instead of failing the filter
+
+    max_workers : int
+                  Optional upper bound on the number of projection jobs
+
+    prefix : str
+             Prefix for the task names, so several observations can be added
+             to the same graph
+
+    priority : int
+               The priority of the observation's tasks, see TaskGraph.add
+
+    streaming : bool
+                If neighboring framelets should be matched as soon as they
+                are ingested
+
+    pair_selection : str
+                     How the framelet pairs to match are chosen, sequential
+                     for each framelet and the next one of its filter, or
+                     overlap for the framelets whose footprints overlap.
+                     Defaults to sequential.
+
+    max_pairs : int
+                With overlap pair selection, the number of pairs each
+                framelet should have at most, see
+                cassis_overlaps.overlapping_pairs
+
+    Raises
+    ------
+    ValueError
+               If overlap pair selection is used in streaming mode
+    """
+    def __init__(self, graph, working_directory, def_file, reference_filter,
+                 tolerant=False, max_workers=None, prefix='', priority=0,
+                 streaming=False, pair_selection='sequential', max_pairs=4):
+        if streaming and pair_selection == 'overlap':
+            raise ValueError('Overlap pair selection cannot be used in streaming mode')
+        self.graph = graph
+        self.working_directory = working_directory
+        self.def_file = def_file
+        self.reference_filter = reference_filter
+        self.tolerant = tolerant
+        self.max_workers = max_workers
+        self.prefix = prefix
+        self.priority = priority
+        self.streaming = streaming
+        self.pair_selection = pair_selection
+        self.max_pairs = max_pairs
+
+        self.log_dir = os.path.join(working_directory, 'logs')
+        self.ingested_dir = os.path.join(working_directory, 'ingested')
+        self.adjusted_dir = os.path.join(working_directory, 'adjusted')
+        self.network_dir = os.path.join(working_directory, 'networks')
+        self.projected_dir = os.path.join(working_directory, 'projected')
+        self.mosaic_dir = os.path.join(working_directory, 'mosaics')
+        self.footprint_dir = os.path.join(working_directory, 'footprints')
+        directories = [self.log_dir, self.ingested_dir, self.adjusted_dir,
+                       self.network_dir, self.projected_dir, self.mosaic_dir]
+        if pair_selection == 'overlap':
+            directories.append(self.footprint_dir)
+        for directory in directories:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        self.combined_net = os.path.join(self.network_dir, 'combined_filters.net')
+        self.adjusted_net = os.path.join(self.network_dir, 'adjusted.net')
+        self.map_file = os.path.join(working_directory, 'adjusted_equi.map')
+        self.color_mosaic = os.path.join(self.mosaic_dir, 'COLOR_equi.cub')
+        self.exported = os.path.join(self.mosaic_dir, 'COLOR_equi.img')
+
+        self.ingest_tasks = []
+        # the task that ingests the framelets with -batchlist, if there is one
+        self.batch_ingest_task = None
+        self.stage_tasks = {}
+        self.footprint_tasks = {}
+        # in streaming mode, the tasks that pair up each filter's framelets,
+        # one after the other, and the match tasks they add
+        self.filter_links = dict((filter, []) for filter in filters)
+        self.filter_pairs = dict((filter, []) for filter in filters)
+
+    def add(self, name, function, *args, **kwargs):
+        """
+        Add a task for the observation to the graph, see TaskGraph.add.
+        """
+        return self.graph.add(self.prefix + name, function, *args,
+                              priority=self.priority, **kwargs)
+
+    def adjusted_path(self, cube):
+        return os.path.join(self.adjusted_dir, os.path.basename(cube))
+
+    def add_batch_ingest(self, filenames):
+        """
+        Add a task that ingests framelets with -batchlist, in batch_shards
+        batches at a time. The framelets are then added with add_framelet,
+        which reads their filters once the batches are done.
+
+        Parameters
+        ----------
+        filenames : list
+                    The XML labels of the framelets
+        """
+        self.batch_ingest_task = self.add('ingest_batch', cassis_process.ingest_observation,
+                                          list(filenames), self.ingested_dir,
+                                          batch_shards=batch_shards)
+
+    def classify_batch_ingested(self, filename, expected_filter=None):
+        # the cube and filter of a framelet ingested by the batch ingest task
+        cube = cassis_process.ingested_path(filename, self.ingested_dir)
+        if cube not in self.graph.result(self.batch_ingest_task):
+            raise RuntimeError('Failed to ingest [{}]'.format(filename))
+        return classify_framelet(cube, expected_filter)
+
+    def add_framelet(self, filename):
+        """
+        Add the tasks that ingest a framelet and stage it for the bundle
+        adjustment, and in streaming mode, match it to the previous
+        framelet of its filter.
+
+        Parameters
+        ----------
+        filename : str
+                   The XML label of the framelet
+
+        Returns
+        -------
+        ingest_task : str
+                      The name of the task that ingests the framelet
+
+        Raises
+        ------
+        ValueError
+                   In streaming mode, if the filter is not in the file name
+        """
+        index = len(self.ingest_tasks)
+        expected_filter = None
+        if self.streaming:
+            expected_filter = cassis_process.image_filter(filename)
+            if expected_filter is None:
+                raise ValueError('Cannot tell the filter of [{}] from its name'.format(filename))
+
+        if self.batch_ingest_task:
+            ingest_task = self.add('ingest_{}'.format(index), self.classify_batch_ingested,
+                                   filename, expected_filter, deps=[self.batch_ingest_task])
+        else:
+            ingest_task = self.add('ingest_{}'.format(index), ingest_and_classify,
+                                   filename, self.ingested_dir, expected_filter)
+        self.ingest_tasks.append(ingest_task)
+        self.stage_tasks[ingest_task] = self.add(
+                'stage_{}'.format(index),
+                lambda: stage_adjusted(self.graph.result(ingest_task)[0], self.adjusted_dir),
+                deps=[ingest_task])
+        if self.pair_selection == 'overlap':
+            self.footprint_tasks[ingest_task] = self.add(
+                    'footprint_{}'.format(index),
+                    lambda: framelet_footprint(self.graph.result(ingest_task)[0], self.footprint_dir),
+                    deps=[ingest_task])
+
+        if self.streaming:
+            links = self.filter_links[expected_filter]
+            previous_link = links[-1] if links else None
+            links.append(self.add('link_{}'.format(index), self.link_framelet,
+                                  expected_filter, ingest_task, previous_link,
+                                  after=[ingest_task] + links[-1:]))
+        return ingest_task
+
+    def link_framelet(self, filter, ingest_task, previous_link):
+        # match a framelet with the last framelet of its filter that was
+        # ingested, once it is ingested itself. Returns the cube, and its
+        # position among the ingested framelets of the filter, of the last
+        # framelet that was ingested so far, for the next link.
+        last = self.graph.result(previous_link) if previous_link else None
+        if not self.graph.succeeded(ingest_task):
+            return last
+        cube = self.graph.result(ingest_task)[0]
+        if last is None:
+            return (cube, 0)
+        base, position = last
+        pair = cassis_process.framelet_pair(base, cube, position, self.network_dir,
+                                            filter, self.log_dir)
+        self.filter_pairs[filter].append(
+                (pair, self.add('match_{}'.format(pair[3]), cassis_process.match_framelets, *pair)))
+        return (cube, position + 1)
+
+    def finish(self):
+        """
+        Add the tasks that run once every framelet is ingested. No more
+        framelets can be added after this.
+
+        Returns
+        -------
+        export_task : str
+                      The name of the last task, that exports the color mosaic
+        """
+        links = [task for filter in filters for task in self.filter_links[filter]]
+        self.add('sort', self.sort_filters,
+                 after=list(self.ingest_tasks) + list(self.footprint_tasks.values()) + links)
+        return self.prefix + 'export'
+
+    def sort_filters(self):
+        # sort out the different filters, keeping the input order
+        filter_tasks = dict((filter, []) for filter in filters)
+        for ingest_task in self.ingest_tasks:
+            if self.graph.succeeded(ingest_task):
+                filter_tasks[self.graph.result(ingest_task)[1]].append(ingest_task)
+        if not filter_tasks[self.reference_filter]:
+            raise RuntimeError('No images for reference filter [{}]'.format(self.reference_filter))
+
+        for filter in filters:
+            if filter_tasks[filter]:
+                cassis_process.make_file_list([self.graph.result(task)[0] for task in filter_tasks[filter]],
+                                              os.path.join(self.working_directory,
+                                                           "{}_ingested.lis".format(filter)))
+        self.add_filter_tasks(filter_tasks)
+
+    def overlap_pairs(self, filter_tasks):
+        """
+        Select the overlapping framelet pairs to match. Each pair network is
+        named after the filters of its framelets and their positions in
+        their filters.
+
+        Parameters
+        ----------
+        filter_tasks : dict
+                       The ingest tasks of each filter
+
+        Returns
+        -------
+        pairs : list
+                The arguments to match_framelets for each pair, from the
+                largest overlap to the smallest
+        """
+        positions = {}
+        for filter in filters:
+            for position, ingest_task in enumerate(filter_tasks[filter]):
+                positions[ingest_task] = (filter, position)
+
+        footprints = []
+        for ingest_task in self.ingest_tasks:
+            if ingest_task not in positions:
+                continue
+            footprint_task = self.footprint_tasks[ingest_task]
+            if not self.graph.succeeded(footprint_task):
+                cube = self.graph.result(ingest_task)[0]
+                if not self.tolerant:
+                    raise RuntimeError('No footprint for [{}]'.format(cube))
+                print('Leaving [{}] out of the framelet pairs, it has no footprint'.format(cube))
+                continue
+            footprints.append((ingest_task, self.graph.result(footprint_task)))
+
+        pairs = []
+        for base_task, train_task, area in cassis_overlaps.overlapping_pairs(footprints, self.max_pairs):
+            base_filter, base_position = positions[base_task]
+            train_filter, train_position = positions[train_task]
+            if base_filter == train_filter:
+                network_id = '{}_{}_{}'.format(base_filter, base_position, train_position)
+            else:
+                network_id = '{}_{}_{}_{}'.format(base_filter, base_position,
+                                                  train_filter, train_position)
+            pairs.append(cassis_process.image_pair(self.graph.result(base_task)[0],
+                                                   self.graph.result(train_task)[0],
+                                                   network_id, self.network_dir, self.log_dir))
+        return pairs
+
+    def add_filter_tasks(self, filter_tasks):
+        graph = self.graph
+
+        # with overlap pair selection, every pair network goes straight into
+        # the combined network, since a filter can be tied together through
+        # the other filters alone
+        pair_networks = []
+        if self.pair_selection == 'overlap':
+            pair_networks = [(self.add('match_{}'.format(pair[3]),
+                                       cassis_process.match_framelets, *pair),
+                              pair[2])
+                             for pair in self.overlap_pairs(filter_tasks)]
+
+        # otherwise generate a control net for each filter from its framelet pairs
+        merge_tasks = []
+        for filter in filters:
+            if not filter_tasks[filter] or self.pair_selection == 'overlap':
+                continue
+            network_file = os.path.join(self.network_dir, '{}.net'.format(filter))
+            if self.streaming:
+                pairs = [pair for pair, task in self.filter_pairs[filter]]
+                pair_tasks = [task for pair, task in self.filter_pairs[filter]]
+            else:
+                images = [graph.result(task)[0] for task in filter_tasks[filter]]
+                pairs = cassis_process.framelet_pairs(images, self.network_dir, filter, self.log_dir)
+                pair_tasks = [self.add('match_{}'.format(pair[3]),
+                                       cassis_process.match_framelets, *pair)
+                              for pair in pairs]
+
+            def merge(filter=filter, pairs=pairs, pair_tasks=pair_tasks,
+                      network_file=network_file):
+                networks = [pair[2] for pair, task in zip(pairs, pair_tasks)
+                            if graph.succeeded(task)]
+                if not networks:
+                    print('No framelet pairs were matched for the {} filter'.format(filter))
+                    return 1
+                return cassis_process.merge_filter_networks(networks, network_file, filter)
+
+            if self.tolerant:
+                merge_task = self.add('merge_{}'.format(filter), merge, after=pair_tasks)
+            else:
+                merge_task = self.add('merge_{}'.format(filter), merge, deps=pair_tasks)
+            merge_tasks.append((merge_task, network_file))
+
+        # combine the individual filter networks
+        ingested_cubes = [graph.result(task)[0] for task in self.ingest_tasks
+                          if graph.succeeded(task)]
+
+        def combine():
+            networks = [network for task, network in merge_tasks + pair_networks
+                        if graph.succeeded(task)]
+            if not networks:
+                print('No filter networks to combine.')
+                return 1
+            return cassis_process.combine_nets(networks, self.combined_net, ingested_cubes,
+                                               self.def_file,
+                                               add_depth=self.pair_selection != 'overlap')
+
+        merge_task_names = [task for task, network in merge_tasks]
+        pair_task_names = [task for task, network in pair_networks]
+        if self.tolerant:
+            combine_task = self.add('combine', combine, after=merge_task_names + pair_task_names)
+        else:
+            combine_task = self.add('combine', combine, deps=pair_task_names, after=merge_task_names)
+
+        # bundle adjust the network and update the pointing on the copied cubes
+        filter_stages = dict((filter, [self.stage_tasks[task] for task in filter_tasks[filter]])
+                             for filter in filters)
+        all_stages = [task for filter in filters for task in filter_stages[filter]]
+        reference_stages = filter_stages[self.reference_filter]
+        held_task = reference_stages[len(reference_stages)//2]
+
+        def bundle():
+            adjusted_cubes = [graph.result(task) for task in all_stages]
+            return cassis_process.bundle_network(self.combined_net,
+                                                 self.adjusted_net,
+                                                 adjusted_cubes,
+                                                 graph.result(held_task),
+                                                 os.path.join(self.log_dir, 'bundle'),
+                                                 1.0,
+                                                 True)
+
+        bundle_task = self.add('bundle', bundle, deps=[combine_task] + all_stages)
+
+        # make the map and size the projection pool
+        def make_map():
+            adjusted_cubes = [graph.result(task) for task in all_stages]
+            status = cassis_process.make_map_file(adjusted_cubes, self.map_file)
+            if status != 0:
+                return status
+            graph.limit(projection_slot,
+                        cassis_process.projection_workers(adjusted_cubes, self.max_workers))
+
+        map_task = self.add('map', make_map, deps=[bundle_task])
+
+        # with batch_shards, every framelet is projected in a few -batchlist
+        # batches, made of framelets of all the filters
+        project_batch_task = None
+        if batch_shards:
+            adjusted_cubes = [self.adjusted_path(graph.result(task)[0])
+                              for filter in filters for task in filter_tasks[filter]]
+            project_batch_task = self.add('project_batch', cassis_process.project_observation,
+                                          adjusted_cubes, self.projected_dir, self.map_file,
+                                          max_workers=self.max_workers, batch_shards=batch_shards,
+                                          deps=[map_task])
+
+        # project, then mosaic, each filter as soon as its framelets are ready
+        mosaic_tasks = {}
+        for filter in filters:
+            if not filter_stages[filter]:
+                continue
+            project_tasks = []
+            projected = []
+            for ingest_task in filter_tasks[filter]:
+                adjusted_cube = self.adjusted_path(graph.result(ingest_task)[0])
+                projected_cube = os.path.join(self.projected_dir,
+                                              os.path.basename(adjusted_cube)[:-4] + '_proj.cub')
+                if project_batch_task is None:
+                    project_tasks.append(self.add('project_{}'.format(ingest_task[len(self.prefix + 'ingest_'):]),
+                                                  cassis_process.project_framelet,
+                                                  adjusted_cube, self.map_file, projected_cube,
+                                                  deps=[map_task], slot=projection_slot))
+                projected.append(projected_cube)
+            if project_batch_task is not None:
+                project_tasks = [project_batch_task]
+
+            mosaic_file = os.path.join(self.mosaic_dir, '{}_equi.cub'.format(filter))
+
+            def mosaic(project_tasks=project_tasks, projected=projected,
+                       mosaic_file=mosaic_file):
+                if project_batch_task is not None:
+                    done = set(graph.result(project_batch_task) or ())
+                    projected = [cube for cube in projected if cube in done]
+                else:
+                    projected = [cube for cube, task in zip(projected, project_tasks)
+                                 if graph.succeeded(task)]
+                if not projected:
+                    return 1
+                return cassis_process.mosaic_filter(projected, mosaic_file, self.map_file,
+                                                    mosaic_engine)
+
+            mosaic_tasks[filter] = (self.add('mosaic_{}'.format(filter), mosaic,
+                                             deps=[map_task], after=project_tasks),
+                                    mosaic_file)
+
+        # register each mosaic to the reference mosaic
+        reference_task, reference_mosaic = mosaic_tasks[self.reference_filter]
+        registered = []
+        for filter in filters:
+            if filter not in mosaic_tasks:
+                continue
+            if filter == self.reference_filter:
+                registered.append((reference_task, reference_mosaic))
+                continue
+            mosaic_task, mosaic_file = mosaic_tasks[filter]
+            registered_mosaic = os.path.splitext(mosaic_file)[0] + '_reg.cub'
+            registration_net = os.path.join(self.network_dir,
+                                            '{}_reg_to_{}.net'.format(filter, self.reference_filter))
+            registered.append((self.add('coreg_{}'.format(filter),
+                                        cassis_process.coreg_image,
+                                        mosaic_file, registered_mosaic,
+                                        reference_mosaic, registration_net,
+                                        deps=[mosaic_task, reference_task]),
+                               registered_mosaic))
+
+        # stack the mosaics and export the color mosaic
+        def stack():
+            mosaics = [mosaic for task, mosaic in registered if graph.succeeded(task)]
+            return cassis_process.stack_mosaics(mosaics, self.color_mosaic)
+
+        stack_task = self.add('stack', stack, deps=[reference_task],
+                              after=[task for task, mosaic in registered])
+        self.add('export', cassis_process.export_mosaic, self.color_mosaic, self.exported,
+                 deps=[stack_task])
+
+
+def add_observation(graph, input_files, working_directory, def_file,
+                    reference_filter, tolerant=False, max_workers=None,
+                    prefix='', priority=0, streaming=False, pair_selection='sequential',
+                    max_pairs=4):
+    """
+    Add the tasks that process one observation to a task graph.
+    See Observation.
+
+    Parameters
+    ----------
+    graph : TaskGraph
+            The graph to add the tasks to
+
+    input_files : list
+                  The XML labels of the framelets, in the order they were taken
+
+    working_directory : str
+                        The directory where output files will be made
+
+    def_file : str
+               The definition file used to sub pixel register the networks
+
+    reference_filter : str
+                       The filter whose center framelet will be held fixed and
+                       that the other filter mosaics will be registered to
+
+    tolerant : bool
+               If framelet pairs that fail to match should be left out of the
+               filter networks instead of failing the filter
+
+    max_workers : int
+                  Optional upper bound on the number of projection jobs
+
+    prefix : str
+             Prefix for the task names, so several observations can be added
+             to the same graph
+
+    priority : int
+               The priority of the observation's tasks, see TaskGraph.add
+
+    streaming : bool
+                If neighboring framelets should be matched as soon as they
+                are ingested
+
+    pair_selection : str
+                     How the framelet pairs to match are chosen, sequential
+                     or overlap
+
+    max_pairs : int
+                With overlap pair selection, the number of pairs each
+                framelet should have at most
+
+    Returns
+    -------
+    export_task : str
+                  The name of the last task, that exports the color mosaic
+    """
+    observation = Observation(graph, working_directory, def_file, reference_filter,
+                              tolerant, max_workers, prefix, priority, streaming,
+                              pair_selection, max_pairs)
+    if batch_shards and not streaming:
+        observation.add_batch_ingest(input_files)
+    for filename in input_files:
+        observation.add_framelet(filename)
+    return observation.finish()
+
+
+def _data_files(label):
+    # the data files a PDS4 label points to, which are next to it, or None
+    # if the label cannot be read yet
+    try:
+        tree = ElementTree.parse(label)
+    except (ElementTree.ParseError, OSError):
+        return None
+    directory = os.path.dirname(label)
+    return [os.path.join(directory, element.text.strip()) for element in tree.iter()
+            if element.tag.rsplit('}', 1)[-1] == 'file_name' and element.text
+            and element.text.strip() != os.path.basename(label)]
+
+
+def watch_directory(observation, directory, idle_timeout, poll_interval=5.0):
+    """
+    Add the XML labels that appear in a directory to a streaming observation
+    until nothing has changed there for a while, then finish it. This is
+    meant to run as a task in the observation's graph, on a thread of its
+    own, so the graph keeps running while labels arrive.
+
+    A label is ready once its size, and the size of the data files it points
+    to, have stopped changing between two checks. Ready labels are added in
+    name order, which is the order CaSSIS framelets were taken, and a label
+    is held back while a label of the same filter with an earlier name is
+    still arriving. A label that only appears after later framelets of its
+    filter have been added is added last, with a warning, since its
+    neighbors have already been paired. Labels without a filter in their
+    name are left out.
+
+    Parameters
+    ----------
+    observation : Observation
+                  The observation to add the framelets to
+
+    directory : str
+                The directory to watch
+
+    idle_timeout : float
+                   Seconds without new or growing files after which the
+                   observation is finished. Labels that are still not ready
+                   then are left out.
+
+    poll_interval : float
+                    Seconds between checks for new labels
+
+    Returns
+    -------
+    export_task : str
+                  The name of the observation's last task
+    """
+    added = set()
+    # the sizes of the pending labels and their data files at the last check
+    sizes = {}
+    # the name of the last label added of each filter
+    last_added = {}
+    last_change = time.time()
+    while True:
+        pending = []
+        for name in sorted(os.listdir(directory)):
+            filename = os.path.join(directory, name)
+            if not name.lower().endswith('.xml') or filename in added:
+                continue
+            # a label that is not named like a framelet cannot be paired
+            if cassis_process.image_filter(filename) is None:
+                print('Leaving out {}, the filter is not in its name'.format(filename))
+                added.add(filename)
+                continue
+            pending.append(filename)
+
+        ready = []
+        current_sizes = {}
+        waiting = set()
+        for filename in pending:
+            filter = cassis_process.image_filter(filename)
+            files = [filename]
+            data_files = _data_files(filename)
+            if data_files is not None:
+                files += data_files
+            current = tuple(os.path.getsize(path) if os.path.exists(path) else None for path in files)
+            # keep the name order, the labels of a filter after one that is
+            # not ready wait
+            if sizes.get(filename) != current:
+                last_change = time.time()
+                waiting.add(filter)
+            elif None in current or filter in waiting:
+                waiting.add(filter)
+            else:
+                ready.append(filename)
+            current_sizes[filename] = current
+        sizes = current_sizes
+
+        for filename in ready:
+            filter = cassis_process.image_filter(filename)
+            if filename < last_added.get(filter, filename):
+                print('Framelet {} arrived after {}, it is matched out of order'.format(
+                        filename, last_added[filter]))
+            print('Adding framelet {}'.format(filename))
+            observation.add_framelet(filename)
+            added.add(filename)
+            del sizes[filename]
+            last_added[filter] = max(filename, last_added.get(filter, filename))
+            last_change = time.time()
+        if time.time() - last_change > idle_timeout:
+            for filename in sorted(sizes):
+                print('Leaving out framelet {}, it did not finish arriving'.format(filename))
+            break
+        time.sleep(poll_interval)
+    return observation.finish()
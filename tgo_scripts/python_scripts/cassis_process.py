@@ -2,11 +2,63 @@
 This module contains functions for working with TGO CaSSIS images.
 """
 
-import os, subprocess
+import os, re, shutil, hashlib, tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import cassis_cache, cassis_executor, cassis_mosaic, cassis_usage, isis_label
 
 # temporary directory for storing list files
 temp_dir = 'cassis_temp'
 
+# directory for the output of each command, or '' to leave the output on the
+# standard output
+command_log_dir = ''
+
+# seconds after which a command is killed, for every stage, and for the
+# stages in stage_timeouts, by stage name. None waits for ever.
+command_timeout = None
+stage_timeouts = {}
+
+# the CaSSIS filters
+filters = ['PAN', 'RED', 'NIR', 'BLU']
+
+# rough resident memory of an ISIS application before it loads any image data
+isis_app_overhead = 256 * 1024**2
+
+# bytes per pixel for each ISIS pixel type
+pixel_type_sizes = {'UnsignedByte' : 1,
+                    'SignedWord' : 2,
+                    'UnsignedWord' : 2,
+                    'SignedInteger' : 4,
+                    'UnsignedInteger' : 4,
+                    'Real' : 4,
+                    'Double' : 8}
+
+@contextmanager
+def temp_workspace():
+    """
+    Create a private directory under temp_dir for the list files of a single
+    call. Calls running at the same time, in threads or in other processes
+    sharing the working directory, each get their own directory, so their
+    list files never collide. The directory and everything in it is removed
+    when the with block exits, even if a step fails.
+
+    Usage: with temp_workspace() as workspace:
+
+    Returns
+    -------
+    workspace : str
+                The path of the private directory
+    """
+    if not(os.path.exists(temp_dir)):
+        os.makedirs(temp_dir, exist_ok=True)
+    workspace = tempfile.mkdtemp(dir=temp_dir)
+    try:
+        yield workspace
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
 def make_file_list(files, list_filename):
     """
     Write a python list of files to a list file witch each element on a new line.
@@ -28,6 +80,218 @@ def make_file_list(files, list_filename):
         for file in files:
             f.write('{}\n'.format(file))
 
+def image_filter(filename):
+    """
+    Get the filter of a file from its name. CaSSIS framelets are named like
+    CAS-MCO-2016-11-26T22.32.14.582-RED-01000-B1, and the files made from them
+    keep the filter in their names, as do per filter files like RED_equi.cub.
+
+    Parameters
+    ----------
+    filename : str
+               The file name
+
+    Returns
+    -------
+    filter : str
+             The filter, or None if the name does not contain one
+    """
+    fields = re.split(r'[-_.]', os.path.basename(filename))
+    return next((field for field in fields if field in filters), None)
+
+
+def run_command(command, inputs=(), outputs=(), updates=(), lists=(),
+                stage=None, framelet=None):
+    """
+    Run an ISIS command, skipping it if it is up to date according to the
+    rebuild cache. See cassis_cache.run_step. The resource usage of commands
+    that run is recorded by cassis_usage, tagged with the stage, the framelet
+    and the filter of the files the command reads and writes.
+
+    The command runs without a shell, through cassis_executor. If
+    command_log_dir is set its output goes to a log file there, named after
+    the stage and the framelet, and it is killed after the timeout of its
+    stage, see command_timeout and stage_timeouts.
+
+    Parameters
+    ----------
+    command : list
+              The arguments of the command, starting with the application.
+              A command line string is split like a shell would split it.
+
+    inputs : list
+             The files the command reads
+
+    outputs : list
+              The files the command writes
+
+    updates : list
+              The files the command modifies in place
+
+    lists : list
+            The list files the command reads
+
+    stage : str
+            The processing stage of the command. Defaults to the name of the
+            application.
+
+    framelet : str
+               The framelet the command processes, if it processes just one
+
+    Returns
+    -------
+    status : int
+             The return status of the command
+    """
+    args = cassis_executor.command_args(command)
+    command_line = cassis_executor.command_line(args)
+    tool = os.path.basename(args[0])
+    file_filters = set(image_filter(filename)
+                       for filename in list(inputs) + list(outputs) + list(updates)) - set([None])
+    filter = file_filters.pop() if len(file_filters) == 1 else None
+    timeout = stage_timeouts.get(stage or tool, command_timeout)
+    log = None
+    if command_log_dir:
+        os.makedirs(command_log_dir, exist_ok=True)
+        if framelet:
+            name = os.path.splitext(os.path.basename(framelet))[0]
+        else:
+            name = hashlib.sha1(command_line.encode()).hexdigest()[:12]
+        log = os.path.join(command_log_dir, '{}_{}.log'.format(stage or tool, name))
+
+    def run():
+        status = cassis_usage.run(args, stage, filter, framelet, log, timeout)
+        if status != 0 and log:
+            print('The output of [{}] is in [{}]'.format(command_line, log))
+        return status
+
+    return cassis_cache.run_step(command_line, run, inputs, outputs, updates, lists, tool)
+
+
+# the characters that separate or quote the columns of a batchlist
+_batch_separators = re.compile(r'[\s,"\']')
+
+
+def _batch_line(row):
+    # a row of a batchlist, as written to it and to its -errlist
+    return ' '.join(row)
+
+
+def run_batchlist(application, parameters, rows, shards=1,
+                  inputs=(), outputs=(), updates=(), stage=None):
+    """
+    Run an ISIS application over many files with its -batchlist option, so
+    the application start up cost is paid once per batch instead of once
+    per file. The rows are split into contiguous shards that each run as
+    their own batch at the same time.
+
+    Parameters
+    ----------
+    application : str
+                  The name of the ISIS application
+
+    parameters : list
+                 The application parameters. Columns of the batchlist are
+                 referenced as $1, $2, and so on, for example
+                 ['from=$1', 'to=$2']. There is no shell, so they are not
+                 escaped.
+
+    rows : list
+           A list of tuples, one per file, of the batchlist column values
+
+    shards : int
+             The number of batches to split the rows into and run at once.
+             Defaults to 1, one batch.
+
+    inputs : list
+             The indices of the columns that are input files
+
+    outputs : list
+              The indices of the columns that are output files
+
+    updates : list
+              The indices of the columns that are files modified in place
+
+    stage : str
+            The processing stage of the batches, see run_command
+
+    Returns
+    -------
+    failed_rows : list
+                  The rows that failed, in their original order. Rows with
+                  a value that a batchlist cannot hold, with white space,
+                  commas or quotes, are not run and count as failed.
+    """
+    rows = [tuple(row) for row in rows]
+    rejected = [row for row in rows if any(_batch_separators.search(value) for value in row)]
+    for row in rejected:
+        print('Cannot run {} on [{}] with a batchlist, its columns cannot contain '
+              'white space, commas or quotes'.format(application, ', '.join(row)))
+    if rejected:
+        failed = set(rejected)
+        failed.update(run_batchlist(application, parameters,
+                                    [row for row in rows if row not in failed], shards,
+                                    inputs, outputs, updates, stage))
+        return [row for row in rows if row in failed]
+    if not rows:
+        return []
+    shards = max(1, min(shards, len(rows)))
+    shard_size = -(-len(rows) // shards)
+    batches = [rows[start:start + shard_size] for start in range(0, len(rows), shard_size)]
+
+    def run_batch(index, batch, workspace):
+        batch_file = os.path.join(workspace, 'batch_{}.lis'.format(index))
+        error_file = os.path.join(workspace, 'errors_{}.lis'.format(index))
+        with open(batch_file, 'w') as f:
+            for row in batch:
+                f.write('{}\n'.format(_batch_line(row)))
+        command = [application, '-batchlist=' + batch_file, '-errlist=' + error_file,
+                   '-onerror=continue'] + list(parameters)
+        status = run_command(command,
+                             inputs=[row[column] for row in batch for column in inputs],
+                             outputs=[row[column] for row in batch for column in outputs],
+                             updates=[row[column] for row in batch for column in updates],
+                             lists=[batch_file],
+                             stage=stage)
+        # -errlist has the lines that failed, if it is missing after a failure
+        # the whole batch failed
+        if os.path.exists(error_file):
+            with open(error_file) as f:
+                failed_lines = set(line.strip() for line in f)
+            return [row for row in batch if _batch_line(row) in failed_lines]
+        if status != 0:
+            print('Failed to run batch with command:')
+            print(cassis_executor.command_line(command))
+            return batch
+        return []
+
+    with temp_workspace() as workspace:
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            results = list(executor.map(run_batch, range(len(batches)), batches,
+                                        [workspace] * len(batches)))
+    return [row for failed_rows in results for row in failed_rows]
+
+
+def ingested_path(filename, output_dir):
+    """
+    Get the name of the cube a framelet is ingested to.
+
+    Parameters
+    ----------
+    filename : str
+               The XML label of the framelet
+
+    output_dir : str
+                 The directory where the cube will be
+
+    Returns
+    -------
+    cube : str
+           The cube, with the same basename as the label
+    """
+    return os.path.join(output_dir, os.path.basename(filename)[:-4] + ".cub") # Assume it ends in a .xml
+
+
 def ingest_framelet(filename, output_dir):
     """
     Ingest a TGO CaSSIS framelet image and attach SPICE data to it
@@ -47,27 +311,38 @@ def ingest_framelet(filename, output_dir):
     output_filename : str
                The filename of the output cube.
                Including the absolute or relative path.
+
+    Raises
+    ------
+    RuntimeError
+                 If either tgocassis2isis or spiceinit fails.
     """
 
-    basename =  os.path.basename(filename)
-    output_filename = basename[:-4] + ".cub" # Assume it ends in a .xml
-    print output_filename
+    output_filename = ingested_path(filename, output_dir)
+    print(os.path.basename(output_filename))
 
     if not(os.path.exists(output_dir)):
-        os.system("mkdir {}".format(output_dir))
-
-    output_filename = os.path.join(output_dir, output_filename)
+        os.makedirs(output_dir)
 
-    ingest_command = "tgocassis2isis from={} to={}".format(filename, output_filename)
-    spiceinit_command = "spiceinit ckpredict=true spkpredict=true from={}".format(output_filename)
+    ingest_command = ['tgocassis2isis', 'from=' + filename, 'to=' + output_filename]
+    spiceinit_command = ['spiceinit', 'ckpredict=true', 'spkpredict=true', 'from=' + output_filename]
 
-    os.system(ingest_command)
-    os.system(spiceinit_command)
+    status = run_command(ingest_command, inputs=[filename], outputs=[output_filename],
+                         stage='ingest', framelet=filename)
+    if status == 0:
+        command = spiceinit_command
+        status = run_command(spiceinit_command, updates=[output_filename],
+                             stage='spiceinit', framelet=filename)
+    else:
+        command = ingest_command
+    if status != 0:
+        raise RuntimeError('Failed with status {} running command: {}'.format(
+                status, cassis_executor.command_line(command)))
 
     return output_filename
 
 
-def ingest_observation(filenames, output_dir):
+def ingest_observation(filenames, output_dir, max_workers=1, batch_shards=0):
     """
     Ingest a TGO CaSSIS observation and attach SPICE data to the images
 
@@ -77,21 +352,57 @@ def ingest_observation(filenames, output_dir):
                A list of the filenames to ingest
     output_dir: str
                 The directory that the output cubes will be in
+    max_workers: int
+                 The maximum number of framelets to ingest and spiceinit at
+                 the same time. Defaults to 1, one framelet at a time.
+    batch_shards: int
+                  If non-zero, ingest and spiceinit with -batchlist instead of
+                  once per framelet, split into this many batches that run at
+                  the same time. max_workers is ignored in this mode.
 
     Returns:
     --------
     output_filenames: list
-                      A list of the filenames of the output cubes
+                      A list of the filenames of the output cubes, in the same
+                      order as the input filenames. Framelets that failed to
+                      ingest are reported and left out of the list.
     """
 
     if not(os.path.exists(output_dir)):
         os.makedirs(output_dir)
 
     output_filenames = []
-
-    for filename in filenames:
-        output_filename = ingest_framelet(filename, output_dir)
-        output_filenames.append(output_filename)
+    failures = []
+
+    if batch_shards:
+        # ingest and spiceinit everything in a few long running batches
+        rows = [(filename, ingested_path(filename, output_dir)) for filename in filenames]
+        failed_rows = run_batchlist('tgocassis2isis', ['from=$1', 'to=$2'], rows,
+                                    batch_shards, inputs=[0], outputs=[1], stage='ingest')
+        failures += [(row[0], 'tgocassis2isis failed') for row in failed_rows]
+        failed = set(failed_rows)
+        rows = [row for row in rows if row not in failed]
+        failed_rows = run_batchlist('spiceinit', ['ckpredict=true', 'spkpredict=true', 'from=$2'], rows,
+                                    batch_shards, updates=[1], stage='spiceinit')
+        failures += [(row[0], 'spiceinit failed') for row in failed_rows]
+        failed = set(failed_rows)
+        output_filenames = [row[1] for row in rows if row not in failed]
+    else:
+        # each framelet is an independent tgocassis2isis + spiceinit chain, so
+        # the chains can run side by side while results are gathered in order
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(ingest_framelet, filename, output_dir)
+                       for filename in filenames]
+            for filename, future in zip(filenames, futures):
+                try:
+                    output_filenames.append(future.result())
+                except RuntimeError as error:
+                    failures.append((filename, error))
+
+    if failures:
+        print('Failed to ingest {} of {} framelets:'.format(len(failures), len(filenames)))
+        for filename, error in failures:
+            print('  [{}] {}'.format(filename, error))
 
     return output_filenames
 
@@ -127,18 +438,20 @@ def match_framelets(base, train, output_network, network_id, point_id, log=''):
     status : int
              The return status of the matching application
     """
-    command = 'findfeatures algorithm=sift/sift'
-    command += ' match={}'.format(base)
-    command += ' from={}'.format(train)
-    command += ' onet={}'.format(output_network)
-    command += ' networkID={}'.format(network_id)
-    command += ' pointID="{}"'.format(point_id)
+    command = ['findfeatures', 'algorithm=sift/sift']
+    command.append('match=' + base)
+    command.append('from=' + train)
+    command.append('onet=' + output_network)
+    command.append('networkID=' + network_id)
+    command.append('pointID=' + point_id)
     if log:
-        command += ' debug=true debuglog="{}"'.format(log)
-    return os.system(command)
+        command += ['debug=true', 'debuglog=' + log]
+    return run_command(command, inputs=[base, train], outputs=[output_network],
+                       stage='match')
 
 
-def generate_filter_control(images, output_network, filter, log_dir=''):
+def generate_filter_control(images, output_network, filter, log_dir='',
+                            max_workers=1, tolerant=False):
     """
     Match all of the framelets for a single filter and create a control network.
 
@@ -156,6 +469,15 @@ def generate_filter_control(images, output_network, filter, log_dir=''):
     log_dir : str
               The optional directory for log files
 
+    max_workers : int
+                  The maximum number of framelet pairs to match at the same time.
+                  Defaults to 1, one pair at a time.
+
+    tolerant : bool
+               If pairs that fail to match should be reported and left out of
+               the network instead of failing the whole filter.
+               Defaults to False
+
     Returns
     -------
     status : int
@@ -168,37 +490,167 @@ def generate_filter_control(images, output_network, filter, log_dir=''):
     if log_dir and not(os.path.exists(log_dir)):
         os.makedirs(log_dir)
 
-    # match sequential framelets
+    # match sequential framelets, each pair is independent so they can all
+    # be matched at the same time. findfeatures runs in a process of its
+    # own, so threads are enough, and unlike forked processes they are safe
+    # to start from a scheduler thread while other commands are running.
+    pairs = framelet_pairs(images, network_dir, filter, log_dir)
     framelet_nets = []
-    for index in range(0, len(images) - 1):
-        base = images[index]
-        train = images[index+1]
-        network_id = '{}_{}_{}'.format(filter, index, index+1)
-        network = os.path.join(network_dir, network_id + ".net")
-        point_id = network_id + "????"
-        log = ''
-        if log_dir:
-            log = os.path.join(log_dir, network_id + '.log')
-        status = match_framelets(base, train, network, network_id, point_id, log)
-        if status != 0:
-            msg = 'Failed to match framelets [{}] and [{}]'.format(base, train)
-            print(msg)
-            return status
-        framelet_nets.append(network)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(match_framelets, *pair) for pair in pairs]
+        # collect the networks in index order so cnetmerge sees the same
+        # list no matter what order the matches finish in
+        for pair, future in zip(pairs, futures):
+            base, train, network = pair[:3]
+            status = future.result()
+            if status != 0:
+                msg = 'Failed to match framelets [{}] and [{}]'.format(base, train)
+                print(msg)
+                if tolerant:
+                    continue
+                for pending in futures:
+                    pending.cancel()
+                return status
+            framelet_nets.append(network)
+
+    if not framelet_nets:
+        print('No framelet pairs were matched for the {} filter'.format(filter))
+        return 1
+    if len(framelet_nets) < len(pairs):
+        print('Skipped {} of {} framelet pairs for the {} filter'.format(
+              len(pairs) - len(framelet_nets), len(pairs), filter))
 
     # combine the individual networks
-    framelet_nets_file = os.path.join(temp_dir, "nets.lis")
-    make_file_list(framelet_nets, framelet_nets_file)
-    command = 'cnetmerge clist={}'.format(framelet_nets_file)
-    command += ' onet={}'.format(output_network)
-    command += ' network={}'.format(filter)
-    command += ' description="network for the {} filter"'.format(filter)
-    status = os.system(command)
-    os.remove(framelet_nets_file)
-    return status
+    return merge_filter_networks(framelet_nets, output_network, filter)
+
+
+def framelet_pairs(images, network_dir, filter, log_dir=''):
+    """
+    List the sequential framelet pairs of a filter that need to be matched.
+
+    Parameters
+    ----------
+    images : list
+             List of images sorted by adjacency
+
+    network_dir : str
+                  The directory the pair networks will be written to
+
+    filter : str
+             The name of the filter
+
+    log_dir : str
+              The optional directory for log files
+
+    Returns
+    -------
+    pairs : list
+            A list of tuples of the arguments to match_framelets for each pair,
+            in index order.
+    """
+    return [framelet_pair(images[index], images[index+1], index, network_dir, filter, log_dir)
+            for index in range(0, len(images) - 1)]
+
+
+def framelet_pair(base, train, index, network_dir, filter, log_dir=''):
+    """
+    Get the arguments to match_framelets for a pair of neighboring framelets.
+
+    Parameters
+    ----------
+    base : str
+           The first image of the pair
+
+    train : str
+            The next image of the filter
+
+    index : int
+            The position of the base image in the filter
+
+    network_dir : str
+                  The directory the pair network will be written to
+
+    filter : str
+             The name of the filter
+
+    log_dir : str
+              The optional directory for log files
 
+    Returns
+    -------
+    pair : tuple
+           The arguments to match_framelets
+    """
+    network_id = '{}_{}_{}'.format(filter, index, index+1)
+    return image_pair(base, train, network_id, network_dir, log_dir)
 
-def combine_nets(networks, combined_net, images, def_file, clean=True):
+
+def image_pair(base, train, network_id, network_dir, log_dir=''):
+    """
+    Get the arguments to match_framelets for any pair of framelets.
+
+    Parameters
+    ----------
+    base : str
+           The first image of the pair
+
+    train : str
+            The image that will be matched to the base image
+
+    network_id : str
+                 The ID for the pair network, also used for its file names
+
+    network_dir : str
+                  The directory the pair network will be written to
+
+    log_dir : str
+              The optional directory for log files
+
+    Returns
+    -------
+    pair : tuple
+           The arguments to match_framelets
+    """
+    network = os.path.join(network_dir, network_id + ".net")
+    point_id = network_id + "????"
+    log = ''
+    if log_dir:
+        log = os.path.join(log_dir, network_id + '.log')
+    return (base, train, network, network_id, point_id, log)
+
+
+def merge_filter_networks(networks, output_network, filter):
+    """
+    Merge the framelet pair networks of a filter into a single network.
+
+    Parameters
+    ----------
+    networks : list
+               The framelet pair networks to merge
+
+    output_network : str
+                     The name of the output control network
+
+    filter : str
+             The name of the filter
+
+    Returns
+    -------
+    status : int
+             The return status of cnetmerge
+    """
+    with temp_workspace() as workspace:
+        framelet_nets_file = os.path.join(workspace, "nets.lis")
+        make_file_list(networks, framelet_nets_file)
+        command = ['cnetmerge', 'clist=' + framelet_nets_file]
+        command.append('onet=' + output_network)
+        command.append('network=' + filter)
+        command.append('description=network for the {} filter'.format(filter))
+        return run_command(command, outputs=[output_network], lists=[framelet_nets_file],
+                           stage='merge')
+
+
+def combine_nets(networks, combined_net, images, def_file, clean=True, add_depth=True):
     """
     Combine a list of networks into one single network.
     This method will also attempt to add depth to the network.
@@ -222,76 +674,88 @@ def combine_nets(networks, combined_net, images, def_file, clean=True):
             If the final network should have mesaures that failed to be registered removed.
             Defaults to True
 
+    add_depth : bool
+                If the points should be added to every image they fall on and
+                registered there. This can be skipped if the networks already
+                tie the filters together, such as networks of overlapping
+                framelet pairs. Defaults to True
+
     Returns
     -------
     status : int
              The return status of the applications.
     """
-    # make file lists of the networks and images
-    networks_file_list = os.path.join(temp_dir, "nets.lis")
-    images_file_list = os.path.join(temp_dir, "images.lis")
-    make_file_list(networks, networks_file_list)
-    make_file_list(images, images_file_list)
-
-    # make sure the output directory exists
-    output_dir = os.path.dirname(combined_net)
-    if output_dir and not(os.path.exists(output_dir)):
-        os.makedirs(output_dir)
-
-    # make the inbetween file names
-    output_basename = os.path.splitext(combined_net)[0]
-    cnetcombinept_net = output_basename + '_combined.net'
-    added_net = output_basename + '_added.net'
-    if clean:
-        regged_net = output_basename + '_regged.net'
-    else:
-        regged_net = combined_net
-
-    # combine the networks
-    combine_command = 'cnetcombinept cnetlist={}'.format(networks_file_list)
-    combine_command += ' onet={}'.format(cnetcombinept_net)
-    status = os.system(combine_command)
-    if status != 0:
-        print('failed to combine networks with command:')
-        print(combine_command)
-        return status
-
-    # add the images for depth
-    add_command = 'cnetadd fromlist={}'.format(images_file_list)
-    add_command += ' cnet={}'.format(cnetcombinept_net)
-    add_command += ' addlist={}'.format(images_file_list)
-    add_command += ' onet={}'.format(added_net)
-    status = os.system(add_command)
-    if status != 0:
-        print('Failed to create depth in the combined network with command:')
-        print(add_command)
-        return status
+    with temp_workspace() as workspace:
+        # make file lists of the networks and images
+        networks_file_list = os.path.join(workspace, "nets.lis")
+        images_file_list = os.path.join(workspace, "images.lis")
+        make_file_list(networks, networks_file_list)
+        make_file_list(images, images_file_list)
+
+        # make sure the output directory exists
+        output_dir = os.path.dirname(combined_net)
+        if output_dir and not(os.path.exists(output_dir)):
+            os.makedirs(output_dir)
+
+        # make the inbetween file names
+        output_basename = os.path.splitext(combined_net)[0]
+        cnetcombinept_net = output_basename + '_combined.net'
+        added_net = output_basename + '_added.net'
+        if clean:
+            regged_net = output_basename + '_regged.net'
+        else:
+            regged_net = combined_net
+        if not add_depth:
+            cnetcombinept_net = combined_net
+
+        # combine the networks
+        combine_command = ['cnetcombinept', 'cnetlist=' + networks_file_list]
+        combine_command.append('onet=' + cnetcombinept_net)
+        status = run_command(combine_command, outputs=[cnetcombinept_net],
+                             lists=[networks_file_list], stage='combine')
+        if status != 0:
+            print('failed to combine networks with command:')
+            print(cassis_executor.command_line(combine_command))
+            return status
+        if not add_depth:
+            return status
 
-    # sub-pixel register the newly added points
-    pointreg_command = 'pointreg fromlist={}'.format(images_file_list)
-    pointreg_command += ' cnet={}'.format(added_net)
-    pointreg_command += ' onet={}'.format(regged_net)
-    pointreg_command += ' deffile={}'.format(def_file)
-    status = os.system(pointreg_command)
-    if status != 0:
-        print('Failed to sub pixel register network with command:')
-        print(pointreg_command)
-        return status
+        # add the images for depth
+        add_command = ['cnetadd', 'fromlist=' + images_file_list]
+        add_command.append('cnet=' + cnetcombinept_net)
+        add_command.append('addlist=' + images_file_list)
+        add_command.append('onet=' + added_net)
+        status = run_command(add_command, inputs=[cnetcombinept_net], outputs=[added_net],
+                             lists=[images_file_list], stage='combine')
+        if status != 0:
+            print('Failed to create depth in the combined network with command:')
+            print(cassis_executor.command_line(add_command))
+            return status
 
-    # optionally remove measures that failed to be registered
-    if clean:
-        clean_command = 'cnetedit cnet={}'.format(regged_net)
-        clean_command += ' onet={}'.format(combined_net)
-        status = os.system(clean_command)
+        # sub-pixel register the newly added points
+        pointreg_command = ['pointreg', 'fromlist=' + images_file_list]
+        pointreg_command.append('cnet=' + added_net)
+        pointreg_command.append('onet=' + regged_net)
+        pointreg_command.append('deffile=' + def_file)
+        status = run_command(pointreg_command, inputs=[added_net, def_file], outputs=[regged_net],
+                             lists=[images_file_list], stage='combine')
         if status != 0:
-            print('Failed to clean network with command:')
-            print(clean_command)
+            print('Failed to sub pixel register network with command:')
+            print(cassis_executor.command_line(pointreg_command))
             return status
 
-    # clean up
-    os.remove(networks_file_list)
-    os.remove(images_file_list)
-    return status
+        # optionally remove measures that failed to be registered
+        if clean:
+            clean_command = ['cnetedit', 'cnet=' + regged_net]
+            clean_command.append('onet=' + combined_net)
+            status = run_command(clean_command, inputs=[regged_net], outputs=[combined_net],
+                                 stage='combine')
+            if status != 0:
+                print('Failed to clean network with command:')
+                print(cassis_executor.command_line(clean_command))
+                return status
+
+        return status
 
 
 def bundle_network(network, output_network, images, held_image, log_prefix,
@@ -335,33 +799,57 @@ def bundle_network(network, output_network, images, held_image, log_prefix,
     if log_dir and not(os.path.exists(log_dir)):
         os.makedirs(log_dir)
 
-    # make the input file lists
-    images_file_list = os.path.join(temp_dir, 'images.lis')
-    make_file_list(images, images_file_list)
-    held_list = [held_image]
-    held_file_list = os.path.join(temp_dir, 'held.lis')
-    make_file_list(held_list, held_file_list)
-
-
-    # run the bundle adjustment
-    bundle_command = 'jigsaw fromlist={}'.format(images_file_list)
-    bundle_command += ' heldlist={}'.format(held_file_list)
-    bundle_command += ' cnet={}'.format(network)
-    bundle_command += ' onet={}'.format(output_network)
-    bundle_command += ' camera_angles_sigma={}'.format(angle_sigma)
-    bundle_command += ' file_prefix={}'.format(log_prefix)
-    if update:
-        bundle_command += ' update=true'
-    status = os.system(bundle_command)
-    if status != 0:
-        print('Failed to bundle adjust network with command:')
-        print(bundle_command)
-        return status
+    with temp_workspace() as workspace:
+        # make the input file lists
+        images_file_list = os.path.join(workspace, 'images.lis')
+        make_file_list(images, images_file_list)
+        held_list = [held_image]
+        held_file_list = os.path.join(workspace, 'held.lis')
+        make_file_list(held_list, held_file_list)
+
+        # run the bundle adjustment
+        bundle_command = ['jigsaw', 'fromlist=' + images_file_list]
+        bundle_command.append('heldlist=' + held_file_list)
+        bundle_command.append('cnet=' + network)
+        bundle_command.append('onet=' + output_network)
+        bundle_command.append('camera_angles_sigma={}'.format(angle_sigma))
+        bundle_command.append('file_prefix=' + log_prefix)
+        if update:
+            bundle_command.append('update=true')
+        updated_images = images if update else []
+        status = run_command(bundle_command, inputs=[network], outputs=[output_network],
+                             updates=updated_images, lists=[images_file_list, held_file_list],
+                             stage='bundle')
+        if status != 0:
+            print('Failed to bundle adjust network with command:')
+            print(cassis_executor.command_line(bundle_command))
+
+    return status
+
+
+def compute_footprint(image_file, output_file):
+    """
+    Compute the ground footprint of a framelet with camrange.
 
-    # clean up
-    os.remove(images_file_list)
-    os.remove(held_file_list)
+    Parameters
+    ----------
+    image_file : str
+                 The framelet cube, with SPICE attached
+
+    output_file : str
+                  The output file for the ground ranges of the framelet
 
+    Returns
+    -------
+    status : int
+             The return status of the camrange application
+    """
+    command = ['camrange', 'from=' + image_file, 'to=' + output_file]
+    status = run_command(command, inputs=[image_file], outputs=[output_file],
+                         stage='footprint', framelet=image_file)
+    if status != 0:
+        print('Failed to compute the footprint of framelet with command:')
+        print(cassis_executor.command_line(command))
     return status
 
 
@@ -376,13 +864,23 @@ def make_map_file(images, output_file):
 
     output_file : str
                   The output map file name.
+
+    Returns
+    -------
+    status : int
+             The return status of the mosrange application
      """
-    image_list_file = os.path.join(temp_dir, "mosrange.lis")
-    make_file_list(images, image_list_file)
+    with temp_workspace() as workspace:
+        image_list_file = os.path.join(workspace, "mosrange.lis")
+        make_file_list(images, image_list_file)
 
-    mosrange_command = "mosrange fromlist={} to={}".format(image_list_file, output_file)
-    os.system(mosrange_command)
-    os.remove(image_list_file)
+        mosrange_command = ['mosrange', 'fromlist=' + image_list_file, 'to=' + output_file]
+        status = run_command(mosrange_command, outputs=[output_file], lists=[image_list_file],
+                             stage='map')
+        if status != 0:
+            print('Failed to make map file with command:')
+            print(cassis_executor.command_line(mosrange_command))
+    return status
 
 
 def project_framelet(image_file, map_file, output_file, trim=False):
@@ -402,14 +900,108 @@ def project_framelet(image_file, map_file, output_file, trim=False):
 
     trim : bool
            If the projected file should be trimmed to just the projected data
+
+    Returns
+    -------
+    status : int
+             The return status of the cam2map application
     """
 
     # More complicated cam2map options needed?
-    cam2map_command = "cam2map from={} to={} map={} pixres=map".format(image_file, output_file, map_file)
-    os.system(cam2map_command)
+    cam2map_command = ['cam2map', 'from=' + image_file, 'to=' + output_file, 'map=' + map_file, 'pixres=map']
+    status = run_command(cam2map_command, inputs=[image_file, map_file], outputs=[output_file],
+                         stage='project', framelet=image_file)
+    if status != 0:
+        print('Failed to project framelet with command:')
+        print(cassis_executor.command_line(cam2map_command))
+    return status
+
+
+def estimate_projection_memory(image_file):
+    """
+    Estimate the peak memory used by cam2map when projecting a cube.
+    The estimate is based on the cube dimensions and pixel type in its label
+    and assumes the projected cube is about the same size as the input.
+
+    Parameters
+    ----------
+    image_file : str
+                 The cube that will be projected
+
+    Returns
+    -------
+    memory : int
+             The estimated peak memory in bytes
+    """
+    label = isis_label.read_label(image_file)
+    dimensions = label.find('Object', 'Core').find('Group', 'Dimensions')
+    samples = int(dimensions['Samples'])
+    lines = int(dimensions['Lines'])
+    bands = int(dimensions['Bands'])
+    pixel_type = label.find('Object', 'Core').find('Group', 'Pixels')['Type']
+    pixels = samples * lines * bands
+    # input pixels, plus the Real output buffer and interpolation cache
+    per_pixel = pixel_type_sizes.get(pixel_type, 4) + 2 * pixel_type_sizes['Real']
+    return isis_app_overhead + pixels * per_pixel
+
+
+def projection_workers(filenames, max_workers=None):
+    """
+    Compute how many cam2map jobs can run at once on this machine.
+    The limit is the number of CPUs, reduced so that the estimated memory
+    of the largest job times the number of jobs fits in the available memory.
+
+    Parameters
+    ----------
+    filenames : list
+                The cubes that will be projected.
 
+    max_workers : int
+                  Optional upper bound on the number of jobs.
 
-def project_observation(filenames, output_dir, map_file, trim=False):
+    Returns
+    -------
+    workers : int
+              The number of projection jobs to run at the same time
+    """
+    workers = os.cpu_count() or 1
+    if max_workers:
+        workers = min(workers, max_workers)
+
+    # every framelet from one filter has the same dimensions, so only one
+    # cube per filter needs to be inspected
+    samples = {}
+    for image in filenames:
+        samples.setdefault(image_filter(image) or image, image)
+    if not samples:
+        return workers
+    job_memory = max(estimate_projection_memory(image) for image in samples.values())
+
+    available_memory = _available_memory()
+    if available_memory is None:
+        return workers
+    return max(1, min(workers, available_memory // job_memory))
+
+
+def _available_memory():
+    # the bytes of memory that can be used without swapping. MemAvailable
+    # counts the page cache that can be reclaimed, which is full after
+    # ingesting an observation, while the free pages of sysconf do not.
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+
+def project_observation(filenames, output_dir, map_file, trim=False, max_workers=None,
+                        batch_shards=0):
     """
     Project an entire observation. Output projected files will have '_proj'
     appended to their basename.
@@ -418,7 +1010,8 @@ def project_observation(filenames, output_dir, map_file, trim=False):
     Parameters:
     -----------
     filenames : list
-                A list of the cube filenames to be projected
+                A list of the cube filenames to be projected.
+                Framelets from several filters can be projected together.
 
     output_dir: string
                 The directory to put the projected cubes in
@@ -429,10 +1022,22 @@ def project_observation(filenames, output_dir, map_file, trim=False):
     trim : bool
            If the projected file should be trimmed to just the projected data
 
+    max_workers : int
+                  Optional upper bound on the number of framelets to project
+                  at the same time. The actual number is also limited by the
+                  CPU count and available memory, see projection_workers.
+
+    batch_shards : int
+                   If non-zero, project with -batchlist instead of once per
+                   framelet, split into this many batches that run at the same
+                   time. The number of batches is limited like max_workers.
+
     Returns:
     --------
     output_files : list
-                   A list of the projected cubes created
+                   A list of the projected cubes created, in the same order as
+                   the input filenames. Framelets that failed to project are
+                   reported and left out of the list.
     """
     if not(os.path.exists(output_dir)):
         os.makedirs(output_dir)
@@ -441,14 +1046,37 @@ def project_observation(filenames, output_dir, map_file, trim=False):
     for image in filenames:
         basename =  os.path.basename(image)
         output_file = basename[:-4] + "_proj.cub"
-        full_output_file = os.path.join(output_dir, output_file)
-        project_framelet(image, map_file, full_output_file, trim)
-        output_files.append(full_output_file)
+        output_files.append(os.path.join(output_dir, output_file))
+
+    if batch_shards:
+        limit = min(batch_shards, max_workers) if max_workers else batch_shards
+        workers = projection_workers(filenames, limit)
+        rows = list(zip(filenames, output_files))
+        parameters = ['from=$1', 'to=$2', 'map=' + map_file, 'pixres=map']
+        failed_rows = run_batchlist('cam2map', parameters, rows, workers,
+                                    inputs=[0], outputs=[1], stage='project')
+        failed = set(failed_rows)
+        statuses = [1 if row in failed else 0 for row in rows]
+    else:
+        workers = projection_workers(filenames, max_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            statuses = list(executor.map(project_framelet,
+                                         filenames,
+                                         [map_file] * len(filenames),
+                                         output_files,
+                                         [trim] * len(filenames)))
+
+    failures = [image for image, status in zip(filenames, statuses) if status != 0]
+    if failures:
+        print('Failed to project {} of {} framelets:'.format(len(failures), len(filenames)))
+        for image in failures:
+            print('  [{}]'.format(image))
 
-    return output_files
+    return [output_file for output_file, status in zip(output_files, statuses)
+            if status == 0]
 
 
-def mosaic_filter(filenames, output_file, map_file=''):
+def mosaic_filter(filenames, output_file, map_file='', engine='automos'):
     """
     Mosaic all of the framelets from a single filter.
 
@@ -464,43 +1092,66 @@ def mosaic_filter(filenames, output_file, map_file=''):
                Optional map file defining the extents of the mosaic.
                If not entered, the mosaic will made sufficiently large to
                contain the image data.
-    """
-    image_list_file = os.path.join(temp_dir, "framelets.lis")
-    make_file_list(filenames, image_list_file)
 
+    engine : str
+             automos to run the ISIS application, or tiled to mosaic the
+             framelets in Python with cassis_mosaic, a tile at a time with a
+             thread pool. Defaults to automos.
+
+    Returns
+    -------
+    status : int
+             The return status of the automos application, or of the tiled
+             mosaic
+    """
     output_dir = os.path.dirname(output_file)
     if output_dir and not(os.path.exists(output_dir)):
         os.makedirs(output_dir)
 
-    command = 'automos fromlist={} mosaic={}'.format(image_list_file, output_file)
-
+    grange = []
     if map_file:
         if not os.path.exists(map_file):
             print('Map file [{}] does not exist'.format(map_file))
-            os.remove(image_list_file)
-            return
-
-        min_lat_proc = subprocess.Popen(['getkey from={} keyword=MinimumLatitude grpname=Mapping'.format(map_file)],
-                                        stdout=subprocess.PIPE, shell=True)
-        (min_lat, err) = min_lat_proc.communicate()
-        max_lat_proc = subprocess.Popen(['getkey from={} keyword=MaximumLatitude grpname=Mapping'.format(map_file)],
-                                        stdout=subprocess.PIPE, shell=True)
-        (max_lat, err) = max_lat_proc.communicate()
-        min_lon_proc = subprocess.Popen(['getkey from={} keyword=MinimumLongitude grpname=Mapping'.format(map_file)],
-                                        stdout=subprocess.PIPE, shell=True)
-        (min_lon, err) = min_lon_proc.communicate()
-        max_lon_proc = subprocess.Popen(['getkey from={} keyword=MaximumLongitude grpname=Mapping'.format(map_file)],
-                                        stdout=subprocess.PIPE, shell=True)
-        (max_lon, err) = max_lon_proc.communicate()
-
-        command += ' grange=user minlat={} maxlat={} minlon={} maxlon={}'.format(min_lat.strip(),
-                                                                                 max_lat.strip(),
-                                                                                 min_lon.strip(),
-                                                                                 max_lon.strip())
-
-    os.system(command)
-
-    os.remove(image_list_file)
+            return 1
+
+        mapping = isis_label.read_label(map_file).find('Group', 'Mapping')
+        if engine == 'tiled' and cassis_mosaic.map_extent(mapping) is None:
+            print('Map file [{}] has no equirectangular ground range for the tiled mosaic'.format(map_file))
+            return 1
+        grange = ['grange=user',
+                  'minlat={}'.format(mapping['MinimumLatitude']),
+                  'maxlat={}'.format(mapping['MaximumLatitude']),
+                  'minlon={}'.format(mapping['MinimumLongitude']),
+                  'maxlon={}'.format(mapping['MaximumLongitude'])]
+
+    if engine == 'tiled':
+        # keep the filter in a BandBin group, like automos does
+        filter = image_filter(filenames[0]) if filenames else None
+        band_names = [filter] if filter else None
+
+        def mosaic():
+            try:
+                cassis_mosaic.mosaic_cubes([filenames], output_file, map_file, band_names=band_names)
+            except (OSError, ValueError, KeyError) as e:
+                print('Failed to mosaic framelets into [{}]: {}'.format(output_file, e))
+                return 1
+            return 0
+
+        inputs = list(filenames) + ([map_file] if map_file else [])
+        return cassis_cache.run_step('mosaic tiled {} {}'.format(output_file, ' '.join(inputs)), mosaic,
+                                     inputs=inputs, outputs=[output_file])
+
+    with temp_workspace() as workspace:
+        image_list_file = os.path.join(workspace, "framelets.lis")
+        make_file_list(filenames, image_list_file)
+        command = ['automos', 'fromlist=' + image_list_file, 'mosaic=' + output_file]
+        command += grange
+        status = run_command(command, outputs=[output_file], lists=[image_list_file],
+                             stage='mosaic')
+        if status != 0:
+            print('Failed to mosaic framelets with command:')
+            print(cassis_executor.command_line(command))
+    return status
 
 def coreg_image(image, output_image, reference_image, output_network):
     """
@@ -534,14 +1185,15 @@ def coreg_image(image, output_image, reference_image, output_network):
         os.makedirs(network_dir)
 
     # do the registration
-    command = 'coreg from={}'.format(image)
-    command += ' to={}'.format(output_image)
-    command += ' match={}'.format(reference_image)
-    command += ' transform=warp onet={}'.format(output_network)
-    status = os.system(command)
+    command = ['coreg', 'from=' + image]
+    command.append('to=' + output_image)
+    command.append('match=' + reference_image)
+    command += ['transform=warp', 'onet=' + output_network]
+    status = run_command(command, inputs=[image, reference_image],
+                         outputs=[output_image, output_network], stage='coreg')
     if status != 0:
         print('Failed to sub pixel register image with command:')
-        print(command)
+        print(cassis_executor.command_line(command))
     return status
 
 
@@ -557,12 +1209,22 @@ def stack_mosaics(mosaics, output_file):
 
     output_file : str
                   The filename for the output stacked cube.
+
+    Returns
+    -------
+    status : int
+             The return status of the cubeit application
     """
-    mosaic_list_file = os.path.join(temp_dir, "mosaics.lis")
-    make_file_list(mosaics, mosaic_list_file)
-    command = 'cubeit fromlist={} to={}'.format(mosaic_list_file, output_file)
-    os.system(command)
-    os.remove(mosaic_list_file)
+    with temp_workspace() as workspace:
+        mosaic_list_file = os.path.join(workspace, "mosaics.lis")
+        make_file_list(mosaics, mosaic_list_file)
+        command = ['cubeit', 'fromlist=' + mosaic_list_file, 'to=' + output_file]
+        status = run_command(command, outputs=[output_file], lists=[mosaic_list_file],
+                             stage='stack')
+        if status != 0:
+            print('Failed to stack mosaics with command:')
+            print(cassis_executor.command_line(command))
+    return status
 
 
 def export_image(image, output_file):
@@ -583,8 +1245,37 @@ def export_image(image, output_file):
     status : int
              The return status of the export application.
     """
-    command = 'tgocassisrdrgen from={} to={}'.format(image, output_file)
-    return os.system(command)
+    command = ['tgocassisrdrgen', 'from=' + image, 'to=' + output_file]
+    return run_command(command, inputs=[image], outputs=[output_file],
+                       stage='export', framelet=image)
+
+
+def export_images(images, output_files, batch_shards=1):
+    """
+    Export many framelets, projected or un-projected, with -batchlist.
+
+    Parameters
+    ----------
+    images : list
+             The image files to export
+
+    output_files : list
+                   The names of the exported PDS4 image files, in the same
+                   order as the images.
+
+    batch_shards : int
+                   The number of batches to split the images into and run at
+                   the same time. Defaults to 1, one batch.
+
+    Returns
+    -------
+    failed : list
+             The images that failed to export
+    """
+    rows = list(zip(images, output_files))
+    failed_rows = run_batchlist('tgocassisrdrgen', ['from=$1', 'to=$2'], rows,
+                                batch_shards, inputs=[0], outputs=[1], stage='export')
+    return [row[0] for row in failed_rows]
 
 def export_mosaic(mosaic, output_file):
     """
@@ -604,5 +1295,34 @@ def export_mosaic(mosaic, output_file):
     status : int
              The return status of isis2pds.
     """
-    command = 'isis2pds from={} to={} pdsversion=PDS4'.format(mosaic, output_file)
-    return os.system(command)
+    command = ['isis2pds', 'from=' + mosaic, 'to=' + output_file, 'pdsversion=PDS4']
+    return run_command(command, inputs=[mosaic], outputs=[output_file],
+                       stage='export')
+
+
+def export_mosaics(mosaics, output_files, batch_shards=1):
+    """
+    Export many mosaics with -batchlist.
+
+    Parameters
+    ----------
+    mosaics : list
+              The mosaic files to export
+
+    output_files : list
+                   The names of the exported PDS4 image files, in the same
+                   order as the mosaics.
+
+    batch_shards : int
+                   The number of batches to split the mosaics into and run at
+                   the same time. Defaults to 1, one batch.
+
+    Returns
+    -------
+    failed : list
+             The mosaics that failed to export
+    """
+    rows = list(zip(mosaics, output_files))
+    failed_rows = run_batchlist('isis2pds', ['from=$1', 'to=$2', 'pdsversion=PDS4'], rows,
+                                batch_shards, inputs=[0], outputs=[1], stage='export')
+    return [row[0] for row in failed_rows]
@@ -0,0 +1,345 @@
+"""
+This module contains a small dependency graph scheduler for running the
+TGO CaSSIS processing steps. Each step is a task that starts as soon as the
+tasks it depends on have finished, instead of waiting for a whole stage.
+"""
+
+import heapq, threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# task states
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Task(object):
+    """
+    A single step in a TaskGraph.
+
+    Attributes
+    ----------
+    name : str
+           The unique name of the task
+
+    function : callable
+               The function that runs the task
+
+    args : tuple
+           The positional arguments for the function
+
+    kwargs : dict
+             The keyword arguments for the function
+
+    deps : list
+           The names of the tasks that must succeed before this task starts.
+           If any of them fail, this task is skipped.
+
+    after : list
+            The names of the tasks that must finish, successfully or not,
+            before this task starts.
+
+    slot : str
+           The optional name of a limited slot the task must hold while it runs
+
+    priority : int
+               Ready tasks with a lower priority start first
+
+    thread : bool
+             If the task runs on a thread of its own instead of the pool, so
+             it does not take a worker away from the other tasks
+
+    state : str
+            The current state of the task
+
+    result : object
+             The return value of the function once the task has finished
+
+    error : str
+            A description of why the task failed or was skipped
+    """
+    def __init__(self, name, function, args, kwargs, deps, after, slot, priority=0, thread=False):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = list(deps)
+        self.after = list(after)
+        self.slot = slot
+        self.priority = priority
+        self.thread = thread
+        self.state = PENDING
+        self.result = None
+        self.error = ''
+        # the position of the task in the order it was added, and the number
+        # of its deps and after tasks that have not finished yet
+        self.order = 0
+        self.waiting = 0
+
+
+class TaskGraph(object):
+    """
+    A set of tasks and the dependencies between them, run on a thread pool.
+
+    A task fails if its function raises an exception or returns a non-zero
+    integer status, the same convention used by the cassis_process functions.
+    Tasks can add more tasks to the graph while it is running. Ready tasks
+    start in order of their priority, then in the order they were added.
+
+    Parameters
+    ----------
+    max_workers : int
+                  The maximum number of tasks to run at the same time
+    """
+    def __init__(self, max_workers=1):
+        self.max_workers = max(1, max_workers)
+        self.tasks = {}
+        self._order = []
+        # the names of the tasks waiting on each task, including tasks that
+        # have not been added yet
+        self._dependents = {}
+        # heaps of (priority, order, name) of the tasks that are ready to
+        # start, on the pool or on threads of their own, and of the ready
+        # tasks waiting for each slot
+        self._ready = []
+        self._ready_threads = []
+        self._slot_waiting = {}
+        # the position in the order before which no task is pending
+        self._first_pending = 0
+        self._limits = {}
+        self._slots_in_use = {}
+        # the running tasks, and those of them running on the pool
+        self._running = 0
+        self._pooled = 0
+        self._condition = threading.Condition()
+
+    def add(self, name, function, *args, **kwargs):
+        """
+        Add a task to the graph.
+
+        Parameters
+        ----------
+        name : str
+               The unique name of the task
+
+        function : callable
+                   The function that runs the task. Any other positional and
+                   keyword arguments are passed to it, except for the
+                   keywords below.
+
+        deps : list
+               The names of the tasks that must succeed first
+
+        after : list
+                The names of the tasks that must finish first
+
+        slot : str
+               The optional name of a limited slot, see limit
+
+        priority : int
+                   Ready tasks with a lower priority start first. Defaults to 0.
+
+        thread : bool
+                 If the task should run on a thread of its own, outside the
+                 max_workers of the pool, for tasks that mostly wait, such as
+                 one that adds tasks as their inputs arrive. Defaults to False.
+
+        Returns
+        -------
+        name : str
+               The name of the task
+        """
+        deps = kwargs.pop('deps', ())
+        after = kwargs.pop('after', ())
+        slot = kwargs.pop('slot', None)
+        priority = kwargs.pop('priority', 0)
+        thread = kwargs.pop('thread', False)
+        with self._condition:
+            if name in self.tasks:
+                raise ValueError('Task [{}] is already in the graph'.format(name))
+            task = Task(name, function, args, kwargs, deps, after, slot, priority, thread)
+            task.order = len(self._order)
+            self.tasks[name] = task
+            self._order.append(name)
+            for dep in dict.fromkeys(task.deps + task.after):
+                other = self.tasks.get(dep)
+                if other is None or other.state in [PENDING, RUNNING]:
+                    task.waiting += 1
+                    self._dependents.setdefault(dep, []).append(name)
+                elif other.state != SUCCEEDED and dep in task.deps:
+                    task.state = SKIPPED
+                    task.error = 'dependency [{}] did not succeed'.format(dep)
+                    break
+            if task.state == SKIPPED:
+                self._settle(task)
+            elif task.waiting == 0:
+                self._push_ready(task)
+            self._condition.notify_all()
+        return name
+
+    def limit(self, slot, count):
+        """
+        Limit how many tasks holding a slot can run at the same time.
+        Slots without a limit can be held by one task at a time.
+
+        Parameters
+        ----------
+        slot : str
+               The name of the slot
+
+        count : int
+                The number of tasks that can hold the slot at once
+        """
+        with self._condition:
+            self._limits[slot] = max(1, count)
+            # let the tasks waiting for the slot try again
+            for entry in self._slot_waiting.pop(slot, []):
+                self._push_ready(self.tasks[entry[2]])
+            self._condition.notify_all()
+
+    def result(self, name):
+        """
+        Get the return value of a finished task.
+        """
+        return self.tasks[name].result
+
+    def succeeded(self, name):
+        """
+        Check if a task has finished successfully.
+        """
+        return name in self.tasks and self.tasks[name].state == SUCCEEDED
+
+    def failures(self):
+        """
+        Get the tasks that failed or were skipped.
+
+        Returns
+        -------
+        failures : list
+                   The failed and skipped tasks, in the order they were added
+        """
+        return [self.tasks[name] for name in self._order
+                if self.tasks[name].state in [FAILED, SKIPPED]]
+
+    def run(self):
+        """
+        Run every task in the graph, starting each one as soon as the tasks
+        it depends on have finished.
+
+        Returns
+        -------
+        success : bool
+                  True if every task succeeded
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            with self._condition:
+                while True:
+                    self._start_ready(executor)
+                    if self._running == 0:
+                        if not self._resolve_stalled():
+                            break
+                    else:
+                        self._condition.wait()
+        return not self.failures()
+
+    def _push_ready(self, task):
+        heapq.heappush(self._ready_threads if task.thread else self._ready,
+                       (task.priority, task.order, task.name))
+
+    def _start_ready(self, executor):
+        # start the ready tasks in order, while there are workers for them
+        while self._ready_threads or (self._ready and self._pooled < self.max_workers):
+            entry = heapq.heappop(self._ready_threads or self._ready)
+            task = self.tasks[entry[2]]
+            if task.slot is not None:
+                in_use = self._slots_in_use.get(task.slot, 0)
+                if in_use >= self._limits.get(task.slot, 1):
+                    heapq.heappush(self._slot_waiting.setdefault(task.slot, []), entry)
+                    continue
+                self._slots_in_use[task.slot] = in_use + 1
+            task.state = RUNNING
+            self._running += 1
+            if task.thread:
+                future = Future()
+                threading.Thread(target=self._run_thread, args=(task, future),
+                                 name=task.name, daemon=True).start()
+            else:
+                self._pooled += 1
+                future = executor.submit(task.function, *task.args, **task.kwargs)
+            future.add_done_callback(lambda future, task=task: self._finish(task, future))
+
+    def _run_thread(self, task, future):
+        try:
+            future.set_result(task.function(*task.args, **task.kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+
+    def _finish(self, task, future):
+        with self._condition:
+            error = future.exception()
+            if error is not None:
+                task.state = FAILED
+                task.error = str(error)
+            else:
+                task.result = future.result()
+                if (isinstance(task.result, int) and not isinstance(task.result, bool)
+                        and task.result != 0):
+                    task.state = FAILED
+                    task.error = 'returned status {}'.format(task.result)
+                else:
+                    task.state = SUCCEEDED
+            if task.state == FAILED:
+                print('Task [{}] failed: {}'.format(task.name, task.error))
+            if task.slot is not None:
+                self._slots_in_use[task.slot] -= 1
+                waiting = self._slot_waiting.get(task.slot)
+                if waiting:
+                    self._push_ready(self.tasks[heapq.heappop(waiting)[2]])
+            self._running -= 1
+            if not task.thread:
+                self._pooled -= 1
+            self._settle(task)
+            self._condition.notify_all()
+
+    def _settle(self, task):
+        # A task has finished, so count it off for the tasks waiting on it,
+        # and skip those that needed it to succeed, then their dependents in
+        # turn.
+        finished = [task]
+        while finished:
+            task = finished.pop()
+            for name in self._dependents.pop(task.name, ()):
+                dependent = self.tasks[name]
+                if dependent.state != PENDING:
+                    continue
+                if task.state != SUCCEEDED and task.name in dependent.deps:
+                    dependent.state = SKIPPED
+                    dependent.error = 'dependency [{}] did not succeed'.format(task.name)
+                    finished.append(dependent)
+                else:
+                    dependent.waiting -= 1
+                    if dependent.waiting == 0:
+                        self._push_ready(dependent)
+
+    def _resolve_stalled(self):
+        # Nothing is running and nothing can start, so any pending task is
+        # waiting on a task that was never added or on a dependency cycle.
+        # Skip the first of them, which cascades to its dependents, and let
+        # the caller try again.
+        while self._first_pending < len(self._order):
+            task = self.tasks[self._order[self._first_pending]]
+            if task.state == PENDING:
+                break
+            self._first_pending += 1
+        else:
+            return False
+        missing = [dep for dep in task.deps + task.after if dep not in self.tasks]
+        task.state = SKIPPED
+        if missing:
+            task.error = 'dependency [{}] was never added'.format(missing[0])
+        else:
+            task.error = 'dependencies could not be satisfied'
+        self._settle(task)
+        return True
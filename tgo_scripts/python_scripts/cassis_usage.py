@@ -0,0 +1,186 @@
+"""
+This module records the resources used by every external command that
+cassis_process runs, so that the time, CPU and memory of a run can be broken
+down by processing stage, filter and framelet.
+
+Each command is run by the cassis_executor backend, which waits for it with
+wait4 so the resource usage of the command and everything it started is
+known. Bytes read and written are counted in the 512 byte blocks that the
+kernel reports for actual device I/O, so reads served from the page cache
+are not included.
+"""
+
+import os, json, threading
+import cassis_executor
+
+# the usage of every command run so far, in the order they finished
+records = []
+_lock = threading.Lock()
+
+# the columns of the summary table, with the summary field and format of each
+_summary_columns = [('Commands', 'commands', '{:d}'),
+                    ('Failed', 'failed', '{:d}'),
+                    ('Wall (s)', 'wall_time', '{:.1f}'),
+                    ('Span (s)', 'span', '{:.1f}'),
+                    ('User (s)', 'user_time', '{:.1f}'),
+                    ('System (s)', 'system_time', '{:.1f}'),
+                    ('Max RSS (MB)', 'max_rss', '{:.0f}'),
+                    ('Read (MB)', 'read_bytes', '{:.0f}'),
+                    ('Written (MB)', 'write_bytes', '{:.0f}')]
+
+
+def run(command, stage=None, filter=None, framelet=None, log=None, timeout=None):
+    """
+    Run a command and record its resource usage.
+
+    Parameters
+    ----------
+    command : list or str
+              The arguments of the command, see cassis_executor.command_args
+
+    stage : str
+            The processing stage the command belongs to. Defaults to the
+            name of the application.
+
+    filter : str
+             The optional filter the command processes
+
+    framelet : str
+               The optional framelet the command processes
+
+    log : str
+          The optional file to write the output of the command to
+
+    timeout : float
+              The optional number of seconds after which the command is
+              killed
+
+    Returns
+    -------
+    status : int
+             The exit status of the command, or the negative signal number
+             if it was killed by a signal
+    """
+    tool = os.path.basename(cassis_executor.command_args(command)[0])
+    usage = cassis_executor.run(command, log, timeout)
+    record = {'command' : cassis_executor.command_line(command),
+              'tool' : tool,
+              'stage' : stage or tool,
+              'filter' : filter,
+              'framelet' : framelet,
+              'log' : log,
+              'timed_out' : False,
+              'host' : None,
+              'start' : 0.0,
+              'end' : 0.0,
+              'wall_time' : 0.0,
+              'user_time' : 0.0,
+              'system_time' : 0.0,
+              'max_rss' : 0,
+              'read_bytes' : 0,
+              'write_bytes' : 0,
+              'status' : 1}
+    record.update(usage)
+    with _lock:
+        records.append(record)
+    return record['status']
+
+
+def clear():
+    """
+    Remove all of the records.
+    """
+    with _lock:
+        del records[:]
+
+
+def summarize(key='stage'):
+    """
+    Total the recorded usage by stage, or by another record field.
+
+    Parameters
+    ----------
+    key : str
+          The record field to group by, such as stage, tool or filter
+
+    Returns
+    -------
+    summary : dict
+              For each value of the key, the number of commands and failed
+              commands, the total wall, user and system times, the span from
+              the first start to the last end, the largest maximum RSS and
+              the total bytes read and written
+    """
+    with _lock:
+        current = list(records)
+    summary = {}
+    for record in current:
+        group = summary.setdefault(record[key], {'commands' : 0,
+                                                 'failed' : 0,
+                                                 'wall_time' : 0.0,
+                                                 'user_time' : 0.0,
+                                                 'system_time' : 0.0,
+                                                 'max_rss' : 0,
+                                                 'read_bytes' : 0,
+                                                 'write_bytes' : 0,
+                                                 'start' : record['start'],
+                                                 'end' : record['end']})
+        group['commands'] += 1
+        group['failed'] += record['status'] != 0
+        for field in ['wall_time', 'user_time', 'system_time', 'read_bytes', 'write_bytes']:
+            group[field] += record[field]
+        group['max_rss'] = max(group['max_rss'], record['max_rss'])
+        group['start'] = min(group['start'], record['start'])
+        group['end'] = max(group['end'], record['end'])
+    for group in summary.values():
+        group['span'] = group['end'] - group['start']
+    return summary
+
+
+def write_report(filename):
+    """
+    Write every record and the summary by stage to a JSON file.
+
+    Parameters
+    ----------
+    filename : str
+               The JSON file to write
+    """
+    report_dir = os.path.dirname(filename)
+    if report_dir and not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    with _lock:
+        current = list(records)
+    with open(filename, 'w') as f:
+        json.dump({'records' : current, 'stages' : summarize()}, f, indent=2)
+
+
+def format_summary(key='stage'):
+    """
+    Format the summary by stage, or by another record field, as a table with
+    the stages in the order they started.
+
+    Returns
+    -------
+    table : str
+            The summary table
+    """
+    summary = summarize(key)
+    names = sorted(summary, key=lambda name: summary[name]['start'])
+    rows = [[key.capitalize()] + [column for column, field, format in _summary_columns]]
+    for name in names:
+        group = summary[name]
+        row = [str(name)]
+        for column, field, format in _summary_columns:
+            value = group[field]
+            if field in ['max_rss', 'read_bytes', 'write_bytes']:
+                value = value / 1024**2
+            row.append(format.format(value))
+        rows.append(row)
+    widths = [max(len(row[index]) for row in rows) for index in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        cells = [row[0].ljust(widths[0])]
+        cells += [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+        lines.append('  '.join(cells))
+    return '\n'.join(lines)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import os, time, argparse, threading, cassis_executor
+
+parser = argparse.ArgumentParser(description='''This script runs the commands
+    that control_obs.py --executor queue puts in a job queue directory. Start
+    one on each machine that shares the queue directory, for example from a
+    cluster job, and they will split the commands between them.''')
+parser.add_argument('queue_dir',
+                    help='The job queue directory, on a filesystem shared with the submitting machine.')
+parser.add_argument('-j', '--max-jobs', type=int, default=os.cpu_count(),
+                    help='The number of jobs to run at the same time. Defaults to the number of CPUs.')
+parser.add_argument('--poll-interval', type=float, default=0.5,
+                    help='Seconds between checks for new jobs.')
+parser.add_argument('--heartbeat', type=float, default=30,
+                    help="""Seconds between updates of the modification time of
+                            running jobs, which shows the submitter that this
+                            worker is still alive.""")
+parser.add_argument('--idle-exit', type=float, default=0,
+                    help="""Exit after the queue has been empty for this many
+                            seconds. Defaults to 0, run until killed.""")
+args = parser.parse_args()
+
+cassis_executor.make_queue(args.queue_dir)
+
+running = set()
+lock = threading.Lock()
+
+
+def run_job(job_name):
+    try:
+        cassis_executor.run_job(args.queue_dir, job_name)
+    finally:
+        with lock:
+            running.discard(job_name)
+
+
+def heartbeat():
+    while True:
+        time.sleep(args.heartbeat)
+        with lock:
+            job_names = list(running)
+        for job_name in job_names:
+            try:
+                os.utime(os.path.join(args.queue_dir, 'running', job_name))
+            except OSError:
+                pass
+
+
+threading.Thread(target=heartbeat, daemon=True).start()
+
+idle_since = time.time()
+while True:
+    with lock:
+        free = len(running) < args.max_jobs
+        busy = bool(running)
+    job_name = cassis_executor.claim_job(args.queue_dir) if free else None
+    if job_name is None:
+        if not busy and args.idle_exit and time.time() - idle_since > args.idle_exit:
+            break
+        if busy:
+            idle_since = time.time()
+        time.sleep(args.poll_interval)
+        continue
+    idle_since = time.time()
+    with lock:
+        running.add(job_name)
+    threading.Thread(target=run_job, args=(job_name,)).start()
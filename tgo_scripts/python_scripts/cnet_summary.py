@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import argparse, isis_cnet
+
+parser = argparse.ArgumentParser(description='''This script prints the number of
+    points and measures in ISIS binary control networks, and optionally the
+    number of measures on each image, without running any ISIS applications.
+    With more than one network and --merge, the networks are merged first.''')
+parser.add_argument('networks', nargs='+',
+                    help='The binary control networks to summarize.')
+parser.add_argument('--images', action='store_true',
+                    help='Also print the number of measures on each image.')
+parser.add_argument('--merge',
+                    help="""Merge the networks and write the merged network to
+                            this file. Points with the same id are merged.""")
+parser.add_argument('--min-measures', type=int, default=0,
+                    help="""With --merge, leave out ignored measures and the
+                            points left with fewer measures than this.""")
+args = parser.parse_args()
+
+networks = [isis_cnet.read_network(network) for network in args.networks]
+if args.merge:
+    merged = isis_cnet.merge_networks(networks, duplicates='merge')
+    if args.min_measures:
+        merged = merged.select(measures=~merged.measures['ignore'],
+                               min_measures=args.min_measures)
+    isis_cnet.write_network(merged, args.merge)
+    networks = [merged]
+    args.networks = [args.merge]
+
+for filename, network in zip(args.networks, networks):
+    print('{} ({})'.format(filename, network.network_id))
+    for name, count in network.summary().items():
+        print('  {:<20} {:>10}'.format(name.replace('_', ' '), count))
+    if args.images:
+        for serial, count in sorted(network.image_measure_counts().items()):
+            print('  {:<60} {:>10}'.format(serial, count))
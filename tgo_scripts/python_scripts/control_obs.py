@@ -1,157 +1,260 @@
 #!/usr/bin/env python
 
-import sys, os, subprocess, argparse, cassis_process, shutil
+import os, argparse, cassis_cache, cassis_executor, cassis_process, cassis_pipeline, cassis_scheduler, cassis_usage, isis_cube
 
 parser = argparse.ArgumentParser(description='''This script takes a list of
-    TGO CaSSIS framelets and created a controlled color mosaic from them.''')
-parser.add_argument('input_list',
+    TGO CaSSIS framelets and created a controlled color mosaic from them.
+    With --manifest, it processes many observations at once instead.''')
+parser.add_argument('input_list', nargs='?',
                     help="""The input list of XML labels for the framelets. For
                             each label there must be a raw image file with the
                             same name in the same directory.""")
-parser.add_argument('working_directory',
+parser.add_argument('working_directory', nargs='?',
                     help='The directory where output files will be made.')
-parser.add_argument('def_file',
+parser.add_argument('def_file', nargs='?',
                     help='The definition file used to sub pixel register the networks')
-parser.add_argument('reference_filter',
+parser.add_argument('reference_filter', nargs='?',
                     help="""The filter whose center framelet will be held fixed.
                             Valid options are RED, PAN, NIR, or BLU.""")
-args = parser.parse_args()
-
-# ensure that a valid filter was entered for the reference filter
-valid_filters = ['RED', 'PAN', 'NIR', 'BLU']
-if args.reference_filter not in valid_filters:
-    print('Invalid reference filter entered.')
-    exit()
-
-# set the temp directory to be in the working_directory
-cassis_process.temp_dir = os.path.join(args.working_directory, 'cassis_temp')
-
-# save some working directories for future use
-log_dir = os.path.join(args.working_directory, 'logs')
-ingested_dir = os.path.join(args.working_directory, 'ingested')
-adjusted_dir = os.path.join(args.working_directory, 'adjusted')
-network_dir = os.path.join(args.working_directory, 'networks')
-projected_dir = os.path.join(args.working_directory, 'projected')
-mosaic_dir = os.path.join(args.working_directory, 'mosaics')
-
-# open the input file
-with open(args.input_list, 'r') as f:
-    input_files = f.read().splitlines()
-
-# ingest and spiceinit the cubes
-ingested_cubes = cassis_process.ingest_observation(input_files, ingested_dir)
-
-# sort out the different filters
-filter_framelets = {'PAN' : [],
-                    'RED' : [],
-                    'NIR' : [],
-                    'BLU' : []}
-for cube in ingested_cubes:
-    # get the filter keyword from the cube's instrument group
-    filter_proc = subprocess.Popen(['getkey from={} objname=IsisCube grpname=Instrument keyword=Filter'.format(cube)],
-                                   stdout=subprocess.PIPE, shell=True)
-    (filter, err) = filter_proc.communicate()
-    if err:
-        message = 'Failed to get filter name from cube [{}]\n'.format(cube)
-        message += '\n' + err
-        print(message)
-        exit()
-    filter_framelets[filter.strip()].append(cube)
-
-# generate a control net for each filter
-filter_networks = []
-for filter in filter_framelets:
-    if not(filter_framelets[filter]):
-        continue
-    network_file = os.path.join(network_dir, '{}.net'.format(filter))
-    status = cassis_process.generate_filter_control(filter_framelets[filter],
-                                                    network_file,
-                                                    filter,
-                                                    log_dir)
-    if status != 0:
-        msg = 'Failed to generate control network for {} filter'.format(filter)
-        print(msg)
-        continue
-    filter_networks.append(network_file)
-    cassis_process.make_file_list(filter_framelets[filter], "{}_ingested.lis".format(filter))
-
-# combine the individual filter networks
-combined_net = os.path.join(network_dir, 'combined_filters.net')
-status = cassis_process.combine_nets(filter_networks, combined_net, ingested_cubes, args.def_file)
-if status != 0:
-    print('Failed to combine control networks.')
-
-# copy all of the ingested images into a new directory
-if not os.path.exists(adjusted_dir):
-    os.makedirs(adjusted_dir)
-filter_adjusted = {'PAN' : [],
-                   'RED' : [],
-                   'NIR' : [],
-                   'BLU' : []}
-for filter in filter_framelets:
-    for ingested_image in filter_framelets[filter]:
-        image_basename = os.path.basename(ingested_image)
-        adjusted_image = os.path.join(adjusted_dir, image_basename)
-        shutil.copy(ingested_image, adjusted_dir)
-        filter_adjusted[filter].append(adjusted_image)
-adjusted_cubes = []
-for filter in filter_adjusted:
-    adjusted_cubes += filter_adjusted[filter]
-
-# bundle adjust the network and update the pointing on the copied cubes
-adjusted_net = os.path.join(network_dir, 'adjusted.net')
-reference_filter_images = filter_adjusted[args.reference_filter]
-if not reference_filter_images:
-    print('No images for reference filter [{}]'.format(args.reference_filter))
-    exit()
-held_image = reference_filter_images[len(reference_filter_images)/2]
-status = cassis_process.bundle_network(combined_net,
-                                       adjusted_net,
-                                       adjusted_cubes,
-                                       held_image,
-                                       os.path.join(log_dir, 'bundle'),
-                                       1.0,
-                                       True)
-if status != 0:
-    print('Failed to bundle adjust network')
-    exit()
-
-# map project the adjusted images
-map_file = os.path.join(args.working_directory, 'adjusted_equi.map')
-cassis_process.make_map_file(adjusted_cubes, map_file)
-filter_projected = {}
-for filter in filter_adjusted:
-    if filter_adjusted[filter]:
-        filter_projected[filter] = cassis_process.project_observation(filter_adjusted[filter],
-                                                                      projected_dir,
-                                                                      map_file)
-
-# create the filter mosaics
-filter_mosaics = {}
-for filter in filter_projected:
-    mosaic_file = os.path.join(mosaic_dir, '{}_equi.cub'.format(filter))
-    cassis_process.mosaic_filter(filter_projected[filter], mosaic_file, map_file)
-    filter_mosaics[filter] = mosaic_file
-
-# register each mosaic to the reference mosaic
-registered_mosaics = []
-for filter in filter_mosaics:
-    if filter != args.reference_filter:
-        registered_mosaic = os.path.splitext(filter_mosaics[filter])[0] + '_reg.cub'
-        registration_net = os.path.join(network_dir, '{}_reg_to_{}.net'.format(filter, args.reference_filter))
-        cassis_process.coreg_image(filter_mosaics[filter],
-                                   registered_mosaic,
-                                   filter_mosaics[args.reference_filter],
-                                   registration_net)
-        registered_mosaics.append(registered_mosaic)
+parser.add_argument('-j', '--max-workers', type=int,
+                    default=int(os.environ.get('CASSIS_MAX_WORKERS', 0)) or os.cpu_count(),
+                    help="""The maximum number of framelets to process at the
+                            same time. Defaults to the CASSIS_MAX_WORKERS
+                            environment variable, or the number of CPUs if it
+                            is not set. Projection is further limited by the
+                            available memory.""")
+parser.add_argument('--skip-failed-pairs', action='store_true',
+                    help="""Leave framelet pairs that fail to match out of the
+                            filter networks instead of failing the filter.""")
+parser.add_argument('--no-cache', action='store_true',
+                    help="""Run every step, even if it is up to date with a
+                            previous run in the same working directory.""")
+parser.add_argument('--report',
+                    help="""The JSON file to write the resource usage of every
+                            command to. Defaults to usage_report.json in the
+                            working directory, or next to the manifest.""")
+parser.add_argument('--manifest',
+                    help="""A file listing many observations to process on one
+                            shared pool of workers instead of the positional
+                            arguments. Each line has the input list, working
+                            directory, definition file and reference filter of
+                            an observation, separated by white space. Blank
+                            lines and lines starting with # are ignored.""")
+parser.add_argument('--shard', default='1/1',
+                    help="""Process only part of the manifest, given as i/N for
+                            the i-th of N parts, counting from 1. Observation k
+                            of the manifest, counting from 0, is in part
+                            k %% N + 1, so separate machines can split a
+                            manifest without talking to each other.""")
+parser.add_argument('--executor', choices=['inline', 'local', 'queue'], default='inline',
+                    help="""Where the ISIS commands run. inline runs each one
+                            from the thread of its step, local runs them in a
+                            pool of --max-workers local processes and queue
+                            puts them in the --queue-dir job queue for
+                            cassis_worker.py workers on any machine that
+                            shares it. Defaults to inline.""")
+parser.add_argument('--queue-dir',
+                    help='The job queue directory for --executor queue.')
+parser.add_argument('--stream', action='store_true',
+                    help="""Match each pair of neighboring framelets as soon as
+                            both are ingested, instead of after every framelet
+                            is ingested. The filter of each framelet is taken
+                            from its file name.""")
+parser.add_argument('--watch', type=float, metavar='SECONDS',
+                    help="""Treat the input list as a directory and process the
+                            XML labels that appear in it as they arrive, in
+                            streaming mode, once they and their data files
+                            have stopped growing, until nothing new has
+                            arrived for this many seconds.""")
+parser.add_argument('--poll-interval', type=float, default=5.0,
+                    help='Seconds between checks for new labels with --watch. Defaults to 5.')
+parser.add_argument('--pairs', choices=['sequential', 'overlap'], default='sequential',
+                    help="""How the framelet pairs to match are chosen.
+                            sequential matches each framelet with the next one
+                            of its filter. overlap computes the ground
+                            footprint of each framelet and matches the
+                            framelets that overlap, within and across filters,
+                            largest overlaps first. Defaults to sequential.""")
+parser.add_argument('--max-pairs', type=int, default=4,
+                    help="""With --pairs overlap, the number of pairs each
+                            framelet is matched in at most, apart from the
+                            pairs needed to keep the network connected.
+                            Defaults to 4.""")
+parser.add_argument('--staging', choices=['auto'] + isis_cube.staging_methods, default='auto',
+                    help="""How the ingested cubes are staged for the bundle
+                            adjustment to update. reflink clones them on
+                            filesystems that support it, detached writes
+                            detached labels that point at their pixels and
+                            copy copies them. Defaults to auto, the first of
+                            these that works.""")
+parser.add_argument('--mosaic', choices=['automos', 'tiled'], default='automos',
+                    help="""How each filter is mosaicked. automos runs the ISIS
+                            application, tiled mosaics the projected framelets
+                            in Python a block of tiles at a time, with a
+                            thread pool and bounded memory. Defaults to
+                            automos.""")
+parser.add_argument('--batch-shards', type=int, default=0, metavar='N',
+                    help="""Ingest and project the framelets with the
+                            -batchlist option of the ISIS applications, split
+                            into N batches that run at the same time, so each
+                            application starts once per batch instead of once
+                            per framelet. Cannot be used with --stream or
+                            --watch. Defaults to 0, one command per framelet.""")
+parser.add_argument('--max-commands', type=int,
+                    help="""The maximum number of ISIS commands to run at the
+                            same time, across every observation and executor.
+                            Defaults to no limit beyond --max-workers.""")
+parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                    help="""Kill any ISIS command that runs for longer than
+                            this. Defaults to no limit.""")
+parser.add_argument('--stage-timeout', action='append', default=[], metavar='STAGE=SECONDS',
+                    help="""Kill the commands of a stage, such as bundle or
+                            project, that run for longer than this, instead of
+                            after --timeout. Can be given more than once.""")
+parser.add_argument('--no-command-logs', action='store_true',
+                    help="""Leave the output of the ISIS commands on the
+                            terminal instead of writing the output of each
+                            command to its own file in command_logs in the
+                            working directory, or next to the manifest.""")
+
+# the main code is guarded so the worker processes of the local executor
+# can import this script without running it
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    stage_timeouts = {}
+    for stage_timeout in args.stage_timeout:
+        try:
+            stage, seconds = stage_timeout.split('=')
+            stage_timeouts[stage] = float(seconds)
+        except ValueError:
+            parser.error('--stage-timeout must be given as STAGE=SECONDS')
+
+    if args.pairs == 'overlap' and (args.stream or args.watch):
+        parser.error('--pairs overlap cannot be used with --stream or --watch')
+    if args.batch_shards and (args.stream or args.watch):
+        parser.error('--batch-shards cannot be used with --stream or --watch')
+    if args.batch_shards < 0:
+        parser.error('--batch-shards cannot be negative')
+
+    # ensure that a valid filter was entered for the reference filter
+    valid_filters = ['RED', 'PAN', 'NIR', 'BLU']
+
+    if args.manifest:
+        if args.input_list:
+            parser.error('the positional arguments cannot be used with --manifest')
+        if args.watch:
+            parser.error('--watch cannot be used with --manifest')
+        try:
+            shard_index, shard_count = [int(part) for part in args.shard.split('/')]
+        except ValueError:
+            parser.error('--shard must be given as i/N')
+        if not 1 <= shard_index <= shard_count:
+            parser.error('--shard i/N needs 1 <= i <= N')
+
+        observations = cassis_pipeline.read_manifest(args.manifest)
+        observations = observations[shard_index - 1::shard_count]
+        batch_directory = os.path.dirname(os.path.abspath(args.manifest))
+        if shard_count > 1:
+            report_name = 'usage_report_{}_of_{}.json'.format(shard_index, shard_count)
+        else:
+            report_name = 'usage_report.json'
     else:
-        registered_mosaics.append(filter_mosaics[filter])
+        if not args.reference_filter:
+            parser.error('the input list, working directory, definition file and reference filter are required')
+        observations = [(args.input_list, args.working_directory, args.def_file, args.reference_filter)]
+        batch_directory = args.working_directory
+        report_name = 'usage_report.json'
+
+    for input_list, working_directory, def_file, reference_filter in observations:
+        if reference_filter not in valid_filters:
+            print('Invalid reference filter [{}] entered for [{}].'.format(reference_filter, input_list))
+            exit()
+
+    # choose where the commands run
+    if args.executor == 'local':
+        cassis_executor.backend = cassis_executor.LocalPoolBackend(args.max_workers)
+    elif args.executor == 'queue':
+        if not args.queue_dir:
+            parser.error('--executor queue needs --queue-dir')
+        cassis_executor.backend = cassis_executor.QueueBackend(args.queue_dir)
+
+    # set the temp directory to be in the working directory, or next to the manifest
+    cassis_process.temp_dir = os.path.join(batch_directory, 'cassis_temp')
+
+    # run the commands without a shell, each with its own log file
+    cassis_executor.max_commands = args.max_commands
+    cassis_process.command_timeout = args.timeout
+    cassis_process.stage_timeouts = stage_timeouts
+    if not args.no_command_logs:
+        cassis_process.command_log_dir = os.path.join(batch_directory, 'command_logs')
+
+    cassis_pipeline.staging_method = args.staging
+    cassis_pipeline.mosaic_engine = args.mosaic
+    cassis_pipeline.batch_shards = args.batch_shards
+
+    # record each step so a rerun can skip the steps that are still up to date
+    if not args.no_cache:
+        cassis_cache.cache_dir = os.path.join(batch_directory, 'cache')
+
+    # run every step of every observation as soon as its inputs are ready, with
+    # the earlier observations in the manifest going first
+    graph = cassis_scheduler.TaskGraph(args.max_workers)
+    prefixes = []
+    for index, (input_list, working_directory, def_file, reference_filter) in enumerate(observations):
+        prefix = '{}:'.format(working_directory) if args.manifest else ''
+        prefixes.append((prefix, input_list))
+
+        if args.watch:
+            # the watch is a task itself, so the graph keeps running until it
+            # has finished adding framelets, on a thread of its own so that it
+            # does not hold one of the workers
+            observation = cassis_pipeline.Observation(graph,
+                                                      working_directory,
+                                                      def_file,
+                                                      reference_filter,
+                                                      args.skip_failed_pairs,
+                                                      args.max_workers,
+                                                      prefix,
+                                                      index,
+                                                      streaming=True)
+            graph.add(prefix + 'watch', cassis_pipeline.watch_directory,
+                      observation, input_list, args.watch, args.poll_interval,
+                      thread=True)
+            continue
+
+        # open the input file
+        with open(input_list, 'r') as f:
+            input_files = f.read().splitlines()
 
+        cassis_pipeline.add_observation(graph,
+                                        input_files,
+                                        working_directory,
+                                        def_file,
+                                        reference_filter,
+                                        args.skip_failed_pairs,
+                                        args.max_workers,
+                                        prefix,
+                                        index,
+                                        args.stream,
+                                        args.pairs,
+                                        args.max_pairs)
+    success = graph.run()
+    cassis_executor.backend.shutdown()
 
-# stack the mosaics
-color_mosaic = os.path.join(mosaic_dir, 'COLOR_equi.cub')
-cassis_process.stack_mosaics(registered_mosaics, color_mosaic)
+    # report where the time and memory went
+    report_file = args.report or os.path.join(batch_directory, report_name)
+    cassis_usage.write_report(report_file)
+    print(cassis_usage.format_summary())
+    print('Wrote the resource usage of each command to {}'.format(report_file))
 
-# export the color mosaic
-exported = os.path.join(mosaic_dir, 'COLOR_equi.img')
-cassis_process.export_mosaic(color_mosaic, exported)
+    if not success:
+        failures = graph.failures()
+        for prefix, input_list in prefixes:
+            observation_failures = [task for task in failures if task.name.startswith(prefix)]
+            if not observation_failures:
+                continue
+            print('Failed to process the observation [{}]:'.format(input_list))
+            for task in observation_failures:
+                print('  {} {}: {}'.format(task.name[len(prefix):], task.state, task.error))
+        exit(1)
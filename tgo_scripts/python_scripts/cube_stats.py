@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+import argparse, isis_cube
+
+parser = argparse.ArgumentParser(description='''This script prints statistics of
+    the pixels in each band of ISIS cubes, like the ISIS stats application,
+    by mapping the cubes into memory instead of running ISIS.''')
+parser.add_argument('cubes', nargs='+',
+                    help='The cubes to compute statistics for.')
+args = parser.parse_args()
+
+for filename in args.cubes:
+    cube = isis_cube.Cube(filename)
+    print('{} ({} samples, {} lines, {} bands, {})'.format(filename, cube.samples, cube.lines,
+                                                          cube.bands, cube.pixel_type))
+    for band in range(cube.bands):
+        statistics = cube.statistics(band)
+        print('  Band {}'.format(band + 1))
+        for name, value in statistics.items():
+            print('    {:<20} {}'.format(name.replace('_', ' '), value))
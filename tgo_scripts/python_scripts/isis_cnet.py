@@ -0,0 +1,874 @@
+"""
+This module reads and writes ISIS binary control networks directly, without
+running cnetbin2pvl, cnetstats or other ISIS applications, so networks can be
+inspected, merged and filtered in Python.
+
+A network is held as two NumPy structured arrays, one record per point and
+one record per measure, so the memory used grows with the number of measures
+without a Python object for each of them. Strings that repeat across
+measures, such as serial numbers, chooser names and dates, are stored once in
+a table and referred to by their index.
+
+Networks are read in the version 2 and 5 formats and written in the version 5
+format, a PVL label followed by a header and the points as protocol buffer
+messages. The point and measure logs, other than the registration results of
+each measure, are not kept.
+"""
+
+import os, mmap, struct
+import numpy as np
+import isis_label
+
+# the start of the binary data, after the space reserved for the label
+_label_bytes = 65536
+
+# the number of points encoded at a time
+_write_chunk = 4096
+
+# point types
+FREE, CONSTRAINED, FIXED = 2, 3, 4
+
+# measure types
+CANDIDATE, MANUAL, REGISTERED_PIXEL, REGISTERED_SUBPIXEL = 0, 1, 2, 3
+
+# (column, NumPy type, default) for each point, other than its id, and each
+# measure. String columns hold an index into the strings of the network, or
+# -1 for none, and missing numbers are NaN.
+_point_columns = [('type', 'u1', FREE),
+                  ('chooser', 'i4', -1),
+                  ('datetime', 'i4', -1),
+                  ('edit_lock', '?', False),
+                  ('ignore', '?', False),
+                  ('jigsaw_rejected', '?', False),
+                  # the row of the reference measure in the measures array
+                  ('reference', 'i8', -1),
+                  ('apriori_surface_source', 'u1', 0),
+                  ('apriori_surface_file', 'i4', -1),
+                  ('apriori_radius_source', 'u1', 0),
+                  ('apriori_radius_file', 'i4', -1),
+                  ('latitude_constrained', '?', True),
+                  ('longitude_constrained', '?', True),
+                  ('radius_constrained', '?', True),
+                  ('apriori', ('f8', 3), np.nan),
+                  ('apriori_covariance', ('f8', 6), np.nan),
+                  ('adjusted', ('f8', 3), np.nan),
+                  ('adjusted_covariance', ('f8', 6), np.nan)]
+
+_measure_columns = [('point', 'i4', 0),
+                    ('serial', 'i4', 0),
+                    ('type', 'u1', CANDIDATE),
+                    ('sample', 'f8', np.nan),
+                    ('line', 'f8', np.nan),
+                    ('chooser', 'i4', -1),
+                    ('datetime', 'i4', -1),
+                    ('edit_lock', '?', False),
+                    ('ignore', '?', False),
+                    ('jigsaw_rejected', '?', False),
+                    ('diameter', 'f8', np.nan),
+                    ('apriori_sample', 'f8', np.nan),
+                    ('apriori_line', 'f8', np.nan),
+                    ('sample_sigma', 'f8', np.nan),
+                    ('line_sigma', 'f8', np.nan),
+                    ('sample_residual', 'f8', np.nan),
+                    ('line_residual', 'f8', np.nan),
+                    ('goodness_of_fit', 'f8', np.nan),
+                    ('minimum_pixel_zscore', 'f8', np.nan),
+                    ('maximum_pixel_zscore', 'f8', np.nan),
+                    ('pixel_shift', 'f8', np.nan),
+                    ('whole_pixel_correlation', 'f8', np.nan),
+                    ('subpixel_correlation', 'f8', np.nan)]
+
+# the measure log data types kept as columns
+_log_columns = {2 : 'goodness_of_fit',
+                3 : 'minimum_pixel_zscore',
+                4 : 'maximum_pixel_zscore',
+                5 : 'pixel_shift',
+                6 : 'whole_pixel_correlation',
+                7 : 'subpixel_correlation'}
+
+# struct codes for the NumPy types, to pack records straight into the
+# memory of a structured array
+_struct_codes = {'u1' : 'B', 'i4' : 'i', 'i8' : 'q', '?' : '?', 'f8' : 'd'}
+
+
+def _record_layout(columns):
+    # the dtype, struct, default row and row slot of each column
+    fields = []
+    codes = '<'
+    defaults = []
+    slots = {}
+    for name, column_type, default in columns:
+        slots[name] = len(defaults)
+        if isinstance(column_type, tuple):
+            column_type, size = column_type
+            fields.append((name, '<' + column_type, (size,)))
+            codes += '{}{}'.format(size, _struct_codes[column_type])
+            defaults += [default] * size
+        else:
+            fields.append((name, '<' + column_type))
+            codes += _struct_codes[column_type]
+            defaults.append(default)
+    return np.dtype(fields), struct.Struct(codes), defaults, slots
+
+
+_point_dtype, _point_struct, _point_defaults, _point_slots = _record_layout(_point_columns)
+measure_dtype, _measure_struct, _measure_defaults, _measure_slots = _record_layout(_measure_columns)
+_double = struct.Struct('<d')
+
+
+def point_dtype(id_length=1):
+    """
+    Get the NumPy record type of the points of a network.
+
+    Parameters
+    ----------
+    id_length : int
+                The length of the longest point id
+
+    Returns
+    -------
+    dtype : numpy.dtype
+            The structured type of one point, its id followed by the point
+            columns
+    """
+    return np.dtype([('id', 'S{}'.format(max(1, id_length)))] + _point_dtype.descr)
+
+
+class ControlNetwork(object):
+    """
+    An ISIS control network held in NumPy arrays.
+
+    Parameters
+    ----------
+    network_id : str
+                 The id of the network
+
+    target_name : str
+                  The name of the target body
+
+    description : str
+                  The description of the network
+
+    user_name : str
+                The user that made the network
+
+    created : str
+              When the network was created
+
+    last_modified : str
+                    When the network was last changed
+
+    Attributes
+    ----------
+    points : numpy.ndarray
+             One record for each point, see point_dtype
+
+    measures : numpy.ndarray
+               One record for each measure, see measure_dtype, in the order of
+               their points. The point column is the row of the measure's
+               point and the serial column is the index of its serial number.
+
+    serials : list
+              The serial numbers of the images the measures are on
+
+    strings : list
+              The chooser names, dates and file names the other string
+              columns refer to
+    """
+    def __init__(self, network_id='', target_name='', description='',
+                 user_name='', created='', last_modified=''):
+        self.network_id = network_id
+        self.target_name = target_name
+        self.description = description
+        self.user_name = user_name
+        self.created = created
+        self.last_modified = last_modified
+        self.points = np.zeros(0, point_dtype())
+        self.measures = np.zeros(0, measure_dtype)
+        self.serials = []
+        self.strings = []
+
+    def _header(self):
+        # a network with the same header and string tables but no points
+        network = ControlNetwork(self.network_id, self.target_name, self.description,
+                                 self.user_name, self.created, self.last_modified)
+        network.serials = self.serials
+        network.strings = self.strings
+        return network
+
+    def measure_counts(self):
+        """
+        Count the measures of each point.
+
+        Returns
+        -------
+        counts : numpy.ndarray
+                 The number of measures of each point
+        """
+        return np.bincount(self.measures['point'], minlength=len(self.points))
+
+    def image_measure_counts(self):
+        """
+        Count the measures on each image.
+
+        Returns
+        -------
+        counts : dict
+                 The number of measures for each serial number
+        """
+        counts = np.bincount(self.measures['serial'], minlength=len(self.serials))
+        return dict((serial, int(count)) for serial, count in zip(self.serials, counts) if count)
+
+    def summary(self):
+        """
+        Count the points and measures of the network, like cnetstats.
+
+        Returns
+        -------
+        summary : dict
+                  The number of points, ignored points, fixed and constrained
+                  points, measures, ignored measures, registered measures,
+                  measures rejected by jigsaw and images
+        """
+        points = self.points
+        measures = self.measures
+        return {'points' : len(points),
+                'ignored_points' : int(np.count_nonzero(points['ignore'])),
+                'fixed_points' : int(np.count_nonzero(points['type'] == FIXED)),
+                'constrained_points' : int(np.count_nonzero(points['type'] == CONSTRAINED)),
+                'measures' : len(measures),
+                'ignored_measures' : int(np.count_nonzero(measures['ignore'])),
+                'registered_measures' : int(np.count_nonzero(measures['type'] >= REGISTERED_PIXEL)),
+                'rejected_measures' : int(np.count_nonzero(measures['jigsaw_rejected'])),
+                'images' : int(np.count_nonzero(np.bincount(measures['serial'],
+                                                            minlength=len(self.serials))))}
+
+    def select(self, points=None, measures=None, min_measures=0):
+        """
+        Make a network from some of the points and measures of this one.
+
+        Parameters
+        ----------
+        points : numpy.ndarray
+                 Optional boolean mask of the points to keep
+
+        measures : numpy.ndarray
+                   Optional boolean mask of the measures to keep. The
+                   measures of points that are not kept are always left out.
+
+        min_measures : int
+                       Also leave out the points with fewer measures than this
+                       after the measures are selected, for example 2 to leave
+                       out points that no longer tie images together
+
+        Returns
+        -------
+        network : ControlNetwork
+                  The selected points and measures
+        """
+        keep_points = np.ones(len(self.points), bool) if points is None else np.asarray(points, bool)
+        keep_measures = np.ones(len(self.measures), bool) if measures is None else np.asarray(measures, bool)
+        keep_measures = keep_measures & keep_points[self.measures['point']]
+        if min_measures:
+            counts = np.bincount(self.measures['point'][keep_measures], minlength=len(self.points))
+            keep_points = keep_points & (counts >= min_measures)
+            keep_measures &= keep_points[self.measures['point']]
+
+        point_rows = np.flatnonzero(keep_points)
+        point_map = np.full(len(self.points), -1, np.int64)
+        point_map[point_rows] = np.arange(len(point_rows))
+        return self._take(point_rows, point_map, np.flatnonzero(keep_measures))
+
+    def _take(self, point_rows, point_map, measure_rows):
+        # point_rows are the points to keep in their new order, point_map the
+        # new row of every old point and measure_rows the measures to keep,
+        # already in the order of their new points
+        network = self._header()
+        measure_map = np.full(len(self.measures) + 1, -1, np.int64)
+        measure_map[measure_rows] = np.arange(len(measure_rows))
+        network.points = self.points[point_rows]
+        # -1 references map to the extra -1 at the end of measure_map
+        network.points['reference'] = measure_map[network.points['reference']]
+        network.measures = self.measures[measure_rows]
+        network.measures['point'] = point_map[network.measures['point']]
+        return network
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _read_fields(data, position, end):
+    # the field number, wire type and value of each field of a message, with
+    # the start and end of the bytes for length delimited fields
+    while position < end:
+        key, position = _read_varint(data, position)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, position = _read_varint(data, position)
+            if value >= 1 << 63:
+                value -= 1 << 64
+        elif wire_type == 1:
+            value = _double.unpack_from(data, position)[0]
+            position += 8
+        elif wire_type == 2:
+            length, position = _read_varint(data, position)
+            value = (position, position + length)
+            position += length
+        elif wire_type == 5:
+            value = struct.unpack_from('<f', data, position)[0]
+            position += 4
+        else:
+            raise ValueError('Unsupported protocol buffer wire type [{}]'.format(wire_type))
+        yield key >> 3, wire_type, value
+
+
+def _read_doubles(data, wire_type, value):
+    if wire_type == 1:
+        return [value]
+    start, end = value
+    return list(struct.unpack_from('<{}d'.format((end - start) // 8), data, start))
+
+
+class _StringTable(object):
+    # interns strings as indices into a list
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self.indices = dict((string, index) for index, string in enumerate(self.strings))
+
+    def index(self, string):
+        # encoded strings are looked up without decoding them
+        index = self.indices.get(string)
+        if index is None:
+            index = self.indices[string] = len(self.strings)
+            if isinstance(string, bytes):
+                string = string.decode('utf-8', 'replace')
+            self.strings.append(string)
+        return index
+
+
+# point fields that are a string, a number, or a flag, by field number
+_point_string_fields = {3 : 'chooser', 4 : 'datetime', 10 : 'apriori_surface_file',
+                        12 : 'apriori_radius_file'}
+_point_number_fields = {2 : 'type', 5 : 'edit_lock', 6 : 'ignore', 7 : 'jigsaw_rejected',
+                        8 : 'reference', 9 : 'apriori_surface_source',
+                        11 : 'apriori_radius_source', 13 : 'latitude_constrained',
+                        14 : 'longitude_constrained', 15 : 'radius_constrained'}
+_point_vector_fields = {16 : ('apriori', 0), 17 : ('apriori', 1), 18 : ('apriori', 2),
+                        20 : ('adjusted', 0), 21 : ('adjusted', 1), 22 : ('adjusted', 2)}
+_point_covariance_fields = {19 : 'apriori_covariance', 23 : 'adjusted_covariance'}
+
+_measure_string_fields = {5 : 'chooser', 6 : 'datetime'}
+_measure_number_fields = {2 : 'type', 7 : 'edit_lock', 8 : 'ignore', 9 : 'jigsaw_rejected'}
+_measure_double_fields = {3 : 'sample', 4 : 'line', 10 : 'diameter', 11 : 'apriori_sample',
+                          12 : 'apriori_line', 13 : 'sample_sigma', 14 : 'line_sigma',
+                          15 : 'sample_residual', 16 : 'line_residual'}
+
+
+def _slots(slots, fields):
+    return dict((number, slots[name]) for number, name in fields.items())
+
+
+_point_string_slots = _slots(_point_slots, _point_string_fields)
+_point_number_slots = _slots(_point_slots, _point_number_fields)
+_point_vector_slots = dict((number, _point_slots[name] + index)
+                           for number, (name, index) in _point_vector_fields.items())
+_point_covariance_slots = _slots(_point_slots, _point_covariance_fields)
+_measure_string_slots = _slots(_measure_slots, _measure_string_fields)
+_measure_number_slots = _slots(_measure_slots, _measure_number_fields)
+_measure_double_slots = _slots(_measure_slots, _measure_double_fields)
+_measure_log_slots = dict((data_type, _measure_slots[name]) for data_type, name in _log_columns.items())
+
+
+class _NetworkReader(object):
+    # decodes point messages into packed point and measure records
+    def __init__(self):
+        self.ids = []
+        self.points = bytearray()
+        self.measures = bytearray()
+        self.measure_count = 0
+        self.serials = _StringTable()
+        self.strings = _StringTable()
+
+    def read_point(self, data, position, end):
+        row = list(_point_defaults)
+        point_index = len(self.ids)
+        first_measure = self.measure_count
+        point_id = b''
+        for number, wire_type, value in _read_fields(data, position, end):
+            if number == 25:
+                self.read_measure(data, value[0], value[1], point_index)
+            elif number == 1:
+                point_id = bytes(data[value[0]:value[1]])
+            elif number in _point_number_slots:
+                row[_point_number_slots[number]] = value
+            elif number in _point_vector_slots:
+                row[_point_vector_slots[number]] = value
+            elif number in _point_string_slots:
+                row[_point_string_slots[number]] = self.strings.index(data[value[0]:value[1]])
+            elif number in _point_covariance_slots:
+                covariance = _read_doubles(data, wire_type, value)[:6]
+                slot = _point_covariance_slots[number]
+                row[slot:slot + len(covariance)] = covariance
+        reference = _point_slots['reference']
+        if row[reference] >= 0:
+            row[reference] += first_measure
+        self.ids.append(point_id)
+        self.points += _point_struct.pack(*row)
+
+    def read_measure(self, data, position, end, point_index):
+        # the common one byte keys and lengths are decoded inline
+        row = list(_measure_defaults)
+        row[0] = point_index
+        while position < end:
+            key = data[position]
+            if key < 0x80:
+                position += 1
+            else:
+                key, position = _read_varint(data, position)
+            number = key >> 3
+            wire_type = key & 7
+            if wire_type == 1:
+                slot = _measure_double_slots.get(number)
+                if slot is not None:
+                    row[slot] = _double.unpack_from(data, position)[0]
+                position += 8
+            elif wire_type == 0:
+                value = data[position]
+                if value < 0x80:
+                    position += 1
+                else:
+                    value, position = _read_varint(data, position)
+                slot = _measure_number_slots.get(number)
+                if slot is not None:
+                    row[slot] = value
+            elif wire_type == 2:
+                length = data[position]
+                if length < 0x80:
+                    position += 1
+                else:
+                    length, position = _read_varint(data, position)
+                field_end = position + length
+                if number == 1:
+                    row[1] = self.serials.index(data[position:field_end])
+                elif number in _measure_string_slots:
+                    row[_measure_string_slots[number]] = self.strings.index(data[position:field_end])
+                elif number == 17:
+                    self.read_log(data, position, field_end, row)
+                position = field_end
+            elif wire_type == 5:
+                position += 4
+            else:
+                raise ValueError('Unsupported protocol buffer wire type [{}]'.format(wire_type))
+        self.measure_count += 1
+        self.measures += _measure_struct.pack(*row)
+
+    def read_log(self, data, position, end, row):
+        log_type = log_value = None
+        for number, wire_type, value in _read_fields(data, position, end):
+            if number == 1:
+                log_type = value
+            elif number == 2:
+                log_value = value
+        if log_type in _measure_log_slots and log_value is not None:
+            row[_measure_log_slots[log_type]] = log_value
+
+    def network(self, header):
+        network = header
+        network.serials = self.serials.strings
+        network.strings = self.strings.strings
+        ids = np.array(self.ids, dtype='S') if self.ids else np.zeros(0, 'S1')
+        network.points = np.empty(len(self.ids), point_dtype(ids.dtype.itemsize))
+        network.points['id'] = ids
+        packed = np.frombuffer(self.points, _point_dtype)
+        for name in _point_dtype.names:
+            network.points[name] = packed[name]
+        network.measures = np.frombuffer(self.measures, measure_dtype).copy()
+        return network
+
+
+_header_fields = {1 : 'network_id', 2 : 'target_name', 3 : 'created',
+                  4 : 'last_modified', 5 : 'description', 6 : 'user_name'}
+
+
+def read_network(filename):
+    """
+    Read an ISIS binary control network.
+
+    Parameters
+    ----------
+    filename : str
+               The control network file
+
+    Returns
+    -------
+    network : ControlNetwork
+              The points and measures of the network
+
+    Raises
+    ------
+    ValueError
+               If the file is not a binary control network of version 2 or 5
+    """
+    label = isis_label.parse_label(isis_label.read_label_text(filename))
+    protobuf = label.find_all('Object', 'ProtoBuffer')
+    if not protobuf:
+        raise ValueError('[{}] is not a binary control network'.format(filename))
+    core = protobuf[0].find('Object', 'Core')
+    info = protobuf[0].find_all('Group', 'ControlNetworkInfo')
+    version = int(info[0].get('Version', 1)) if info else 1
+    if version not in [2, 5]:
+        raise ValueError('Control network [{}] has version {}, only versions 2 and 5 can be read'.format(
+                filename, version))
+
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return _read_data(data, core, version)
+
+
+def _read_data(data, core, version):
+    header_start = int(core['HeaderStartByte'])
+    header_end = header_start + int(core['HeaderBytes'])
+    header = ControlNetwork()
+    point_sizes = []
+    for number, wire_type, value in _read_fields(data, header_start, header_end):
+        if number in _header_fields:
+            setattr(header, _header_fields[number], data[value[0]:value[1]].decode('utf-8', 'replace'))
+        elif number == 7 and wire_type == 2:
+            position, end = value
+            while position < end:
+                size, position = _read_varint(data, position)
+                point_sizes.append(size)
+        elif number == 7:
+            point_sizes.append(value)
+
+    reader = _NetworkReader()
+    position = int(core['PointsStartByte'])
+    points_end = position + int(core['PointsBytes'])
+    if version == 2:
+        for size in point_sizes:
+            reader.read_point(data, position, position + size)
+            position += size
+    else:
+        while position < points_end:
+            size, position = _read_varint(data, position)
+            reader.read_point(data, position, position + size)
+            position += size
+    return reader.network(header)
+
+
+def _encode_varint(value):
+    if value < 0:
+        value += 1 << 64
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _key(number, wire_type):
+    return _encode_varint(number << 3 | wire_type)
+
+
+def _encode_bytes(number, value):
+    return _key(number, 2) + _encode_varint(len(value)) + value
+
+
+def _encode_string(number, value):
+    return _encode_bytes(number, value.encode('utf-8'))
+
+
+def _encode_header(network):
+    message = b''
+    for number in sorted(_header_fields):
+        value = getattr(network, _header_fields[number])
+        if value or number <= 2:
+            message += _encode_string(number, value)
+    return message
+
+
+def _encode_fields(row, slots, fields, strings, defaults):
+    # encode the numbers and strings of a record that differ from the defaults
+    encoded = []
+    for number, slot in slots:
+        value = row[slot]
+        if value == defaults[slot]:
+            continue
+        if number in fields:
+            encoded.append((number, _encode_string(number, strings[value])))
+        else:
+            encoded.append((number, _key(number, 0) + _encode_varint(int(value))))
+    return encoded
+
+
+_point_number_items = sorted(_point_number_slots.items())
+_point_string_items = sorted(_point_string_slots.items())
+_measure_number_items = sorted(_measure_number_slots.items())
+_measure_string_items = sorted(_measure_string_slots.items())
+_measure_double_items = sorted(_measure_double_slots.items())
+_measure_log_items = sorted(_measure_log_slots.items())
+
+
+def _measure_encoder(network):
+    # a function that encodes a measure record, with the encoded serial
+    # numbers, strings and field keys worked out once for the network
+    serials = [_encode_string(1, serial) for serial in network.serials]
+    choosers = [_encode_string(5, string) for string in network.strings]
+    datetimes = [_encode_string(6, string) for string in network.strings]
+    types = [_key(2, 0) + _encode_varint(value) for value in range(256)]
+    sample_key = _key(3, 1)
+    line_key = _key(4, 1)
+    flags = [(slot, _key(number, 0) + b'\x01') for number, slot in _measure_number_items[1:]]
+    doubles = [(slot, _key(number, 1)) for number, slot in _measure_double_items if number > 4]
+    logs = []
+    for data_type, slot in _measure_log_items:
+        log = _key(1, 0) + _encode_varint(data_type) + _key(2, 1)
+        logs.append((slot, _key(17, 2) + _encode_varint(len(log) + 8) + log))
+    sample, line, chooser, datetime = [_measure_slots[name] for name in
+                                       ['sample', 'line', 'chooser', 'datetime']]
+    pack = _double.pack
+
+    def encode(row):
+        # the fields in field number order, leaving out the defaults
+        parts = [serials[row[1]], types[row[2]]]
+        if row[sample] == row[sample]:
+            parts.append(sample_key + pack(row[sample]))
+        if row[line] == row[line]:
+            parts.append(line_key + pack(row[line]))
+        if row[chooser] >= 0:
+            parts.append(choosers[row[chooser]])
+        if row[datetime] >= 0:
+            parts.append(datetimes[row[datetime]])
+        for slot, encoded in flags:
+            if row[slot]:
+                parts.append(encoded)
+        for slot, key in doubles:
+            value = row[slot]
+            if value == value:
+                parts.append(key + pack(value))
+        for slot, prefix in logs:
+            value = row[slot]
+            if value == value:
+                parts.append(prefix + pack(value))
+        return b''.join(parts)
+    return encode
+
+
+def _encode_point(row, measures, network):
+    fields = [(1, _encode_string(1, row[0].decode('utf-8', 'replace')))]
+    fields.append((2, _key(2, 0) + _encode_varint(row[1])))
+    # the point row has the id first, so its slots are one further on
+    values = row[1:]
+    fields += _encode_fields(values, _point_number_items[1:], (), None, _point_defaults)
+    fields += _encode_fields(values, _point_string_items, _point_string_slots,
+                             network.strings, _point_defaults)
+    for number, slot in sorted(_point_vector_slots.items()):
+        if values[slot] == values[slot]:
+            fields.append((number, _key(number, 1) + _double.pack(values[slot])))
+    for number, slot in sorted(_point_covariance_slots.items()):
+        covariance = values[slot:slot + 6]
+        if all(value == value for value in covariance):
+            fields.append((number, _encode_bytes(number, struct.pack('<6d', *covariance))))
+    for measure in measures:
+        fields.append((25, _encode_bytes(25, measure)))
+    fields.sort(key=lambda field: field[0])
+    return b''.join(field for number, field in fields)
+
+
+def _flatten(record):
+    # a record as a flat tuple, with the values of array fields in line
+    flat = []
+    for value in record:
+        if isinstance(value, np.ndarray):
+            flat.extend(value.tolist())
+        elif isinstance(value, (tuple, list)):
+            flat.extend(value)
+        else:
+            flat.append(value)
+    return flat
+
+
+def write_network(network, filename):
+    """
+    Write a network as an ISIS version 5 binary control network.
+
+    Parameters
+    ----------
+    network : ControlNetwork
+              The network to write
+
+    filename : str
+               The control network file to write
+    """
+    measures = network.measures
+    if len(measures) and np.any(np.diff(measures['point']) < 0):
+        order = np.argsort(measures['point'], kind='stable')
+        point_map = np.arange(len(network.points))
+        network = network._take(point_map, point_map, order)
+        measures = network.measures
+    starts = np.concatenate([[0], np.cumsum(network.measure_counts())]).tolist()
+    encode_measure = _measure_encoder(network)
+    reference = 1 + _point_slots['reference']
+
+    header = _encode_header(network)
+    points_bytes = 0
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(b'\0' * _label_bytes)
+        f.write(header)
+        # convert the records to Python values a chunk of points at a time
+        for first in range(0, len(network.points), _write_chunk):
+            last = min(first + _write_chunk, len(network.points))
+            offset = starts[first]
+            encoded = [encode_measure(measure) for measure in
+                       measures[offset:starts[last]].tolist()]
+            chunk = []
+            for index, point in enumerate(network.points[first:last].tolist(), first):
+                start, end = starts[index], starts[index + 1]
+                row = list(point[:1]) + _flatten(point[1:])
+                # the reference is written as the position in the point's measures
+                if row[reference] >= 0:
+                    row[reference] -= start
+                message = _encode_point(row, encoded[start - offset:end - offset], network)
+                chunk.append(_encode_varint(len(message)))
+                chunk.append(message)
+            chunk = b''.join(chunk)
+            f.write(chunk)
+            points_bytes += len(chunk)
+
+        label = isis_label.PvlBlock('Root', '')
+        protobuf = isis_label.PvlBlock('Object', 'ProtoBuffer')
+        core = isis_label.PvlBlock('Object', 'Core')
+        core.keywords = [('HeaderStartByte', str(_label_bytes)),
+                         ('HeaderBytes', str(len(header))),
+                         ('PointsStartByte', str(_label_bytes + len(header))),
+                         ('PointsBytes', str(points_bytes))]
+        info = isis_label.PvlBlock('Group', 'ControlNetworkInfo')
+        info.keywords = [('NetworkId', network.network_id),
+                         ('TargetName', network.target_name),
+                         ('UserName', network.user_name),
+                         ('Created', network.created),
+                         ('LastModified', network.last_modified),
+                         ('Description', network.description),
+                         ('NumberOfPoints', str(len(network.points))),
+                         ('NumberOfMeasures', str(len(measures))),
+                         ('Version', '5')]
+        protobuf.blocks = [core, info]
+        label.blocks = [protobuf]
+        f.seek(0)
+        f.write(isis_label.format_label(label).encode())
+    os.rename(filename + '.tmp', filename)
+    isis_label.clear_cache()
+
+
+def _remap_strings(array, columns, mapping):
+    for column in columns:
+        values = array[column]
+        array[column] = np.where(values >= 0, mapping[np.maximum(values, 0)], -1)
+
+
+def merge_networks(networks, network_id=None, description=None, duplicates='error'):
+    """
+    Merge control networks into one, like cnetmerge.
+
+    Parameters
+    ----------
+    networks : list
+               The ControlNetwork objects to merge. The header of the merged
+               network is taken from the first one.
+
+    network_id : str
+                 Optional id for the merged network
+
+    description : str
+                  Optional description for the merged network
+
+    duplicates : str
+                 What to do with points that have the same id in more than one
+                 network. error raises a ValueError, merge keeps the first
+                 point and adds the measures of the later ones on images it
+                 does not have a measure on yet.
+
+    Returns
+    -------
+    network : ControlNetwork
+              The merged network
+
+    Raises
+    ------
+    ValueError
+               If duplicates is error and a point id is in more than one
+               network
+    """
+    if not networks:
+        raise ValueError('No networks to merge')
+    merged = ControlNetwork(networks[0].network_id, networks[0].target_name,
+                            networks[0].description, networks[0].user_name,
+                            networks[0].created, networks[0].last_modified)
+    if network_id is not None:
+        merged.network_id = network_id
+    if description is not None:
+        merged.description = description
+
+    serials = _StringTable()
+    strings = _StringTable()
+    id_length = max(network.points.dtype['id'].itemsize for network in networks)
+    all_points = []
+    all_measures = []
+    point_offset = 0
+    measure_offset = 0
+    for network in networks:
+        serial_map = np.array([serials.index(serial) for serial in network.serials] + [-1], np.int32)
+        string_map = np.array([strings.index(string) for string in network.strings] + [-1], np.int32)
+
+        points = network.points.astype(point_dtype(id_length))
+        _remap_strings(points, ['chooser', 'datetime', 'apriori_surface_file',
+                                'apriori_radius_file'], string_map)
+        points['reference'] = np.where(points['reference'] >= 0,
+                                       points['reference'] + measure_offset, -1)
+        measures = network.measures.copy()
+        measures['serial'] = serial_map[measures['serial']]
+        _remap_strings(measures, ['chooser', 'datetime'], string_map)
+        measures['point'] += point_offset
+
+        all_points.append(points)
+        all_measures.append(measures)
+        point_offset += len(points)
+        measure_offset += len(measures)
+
+    merged.serials = serials.strings
+    merged.strings = strings.strings
+    merged.points = np.concatenate(all_points)
+    merged.measures = np.concatenate(all_measures)
+
+    ids, first, inverse = np.unique(merged.points['id'], return_index=True, return_inverse=True)
+    if len(ids) == len(merged.points):
+        return merged
+    if duplicates == 'error':
+        counts = np.bincount(inverse)
+        raise ValueError('Point [{}] is in more than one network'.format(
+                ids[np.argmax(counts > 1)].decode('utf-8', 'replace')))
+    elif duplicates != 'merge':
+        raise ValueError('Unknown duplicates option [{}]'.format(duplicates))
+
+    # keep the first of each duplicated point, in the order they came in
+    point_rows = np.sort(first)
+    new_rows = np.empty(len(ids), np.int64)
+    new_rows[np.argsort(first)] = np.arange(len(ids))
+    point_map = new_rows[inverse]
+
+    # keep the first measure of each merged point on each image
+    new_points = point_map[merged.measures['point']]
+    keys = new_points * max(1, len(merged.serials)) + merged.measures['serial']
+    unique_keys, first_measures = np.unique(keys, return_index=True)
+    measure_rows = np.sort(first_measures)
+    measure_rows = measure_rows[np.argsort(new_points[measure_rows], kind='stable')]
+    return merged._take(point_rows, point_map, measure_rows)
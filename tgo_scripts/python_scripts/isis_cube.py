@@ -0,0 +1,773 @@
+"""
+This module reads and writes the binary data in ISIS cubes directly, without
+running any ISIS applications.
+
+Tables, such as the SPICE tables attached by spiceinit, are read into NumPy
+structured arrays using the record layout declared by the Field groups in
+their Table object, and written back the same way. This replaces a round trip
+through tabledump, a CSV file and csv2table.
+
+The pixels of a cube can be read through a Cube, which maps the pixel data
+into memory with numpy.memmap instead of reading it, so only the parts of the
+cube that are used are read from disk. BandSequential and Tile cubes, with
+attached or detached labels, are supported, and ISIS special pixels can be
+masked. New cubes can be created with create_cube and their pixels written
+through a Cube.
+
+Cubes can also be staged for applications that modify them in place, such as
+jigsaw update=true, without copying their pixel data, see stage_cube.
+"""
+
+import os, fcntl, shutil
+import numpy as np
+import isis_label
+
+# NumPy types for the ISIS table field types
+_field_types = {'DOUBLE' : 'f8', 'INTEGER' : 'i4', 'REAL' : 'f4', 'TEXT' : 'S'}
+
+_byte_orders = {'LSB' : '<', 'MSB' : '>'}
+
+# NumPy types for the ISIS pixel types
+_pixel_types = {'UNSIGNEDBYTE' : 'u1', 'SIGNEDWORD' : 'i2', 'UNSIGNEDWORD' : 'u2', 'REAL' : 'f4'}
+
+# the ISIS special pixel values of each pixel type, Null, low representation
+# saturation, low instrument saturation, high instrument saturation and high
+# representation saturation. Real special pixels are given by their bits.
+# 8 bit cubes only have Null and high representation saturation pixels.
+special_pixels = ['Null', 'Lrs', 'Lis', 'His', 'Hrs']
+_special_values = {'u1' : (0, None, None, None, 255),
+                   'i2' : (-32768, -32767, -32766, -32765, -32764),
+                   'u2' : (0, 1, 2, 65534, 65535),
+                   'f4' : (0xFF7FFFFB, 0xFF7FFFFC, 0xFF7FFFFD, 0xFF7FFFFE, 0xFF7FFFFF)}
+
+# the range of valid stored pixels of each integer pixel type
+_valid_ranges = {'u1' : (1, 254), 'i2' : (-32752, 32767), 'u2' : (3, 65522)}
+
+# Real pixels with these bits or higher are special, this includes the
+# negative NaNs
+_valid_max_bits = 0xFF7FFFFA
+
+# the Linux ioctl that makes a copy on write clone of a file
+_ficlone = 0x40049409
+
+# the number of pixels statistics reads at a time from cubes that are not
+# tiled, whose bands would otherwise be read whole
+statistics_block_pixels = 1024 * 1024
+
+# the ways stage_cube can stage a cube, in the order auto tries them
+staging_methods = ['reflink', 'detached', 'copy']
+
+
+def _find_table(label, name):
+    for table in label.blocks:
+        if table.kind == 'Object' and table.name.lower() == 'table' \
+                and table.get('Name', '').lower() == name.lower():
+            return table
+    return None
+
+
+def table_dtype(table):
+    """
+    Get the NumPy record type of a table from its label.
+
+    Parameters
+    ----------
+    table : PvlBlock
+            The Table object from the cube label
+
+    Returns
+    -------
+    dtype : numpy.dtype
+            The structured type of one record in the table
+    """
+    byte_order = _byte_orders[table.get('ByteOrder', 'Lsb').upper()]
+    fields = []
+    for field in table.find_all('Group', 'Field'):
+        field_type = field['Type'].upper()
+        if field_type not in _field_types:
+            raise ValueError('Unsupported type [{}] for field [{}] in table [{}]'.format(
+                    field['Type'], field['Name'], table['Name']))
+        size = int(field.get('Size', 1))
+        if field_type == 'TEXT':
+            fields.append((field['Name'], 'S{}'.format(size)))
+        elif size == 1:
+            fields.append((field['Name'], byte_order + _field_types[field_type]))
+        else:
+            fields.append((field['Name'], byte_order + _field_types[field_type], (size,)))
+    return np.dtype(fields)
+
+
+def read_table(cube, name):
+    """
+    Read a table from a cube, or from the file a detached label points at.
+
+    Parameters
+    ----------
+    cube : str
+           The cube to read the table from
+
+    name : str
+           The name of the table
+
+    Returns
+    -------
+    records : numpy.ndarray
+              The records of the table, as a structured array with a field
+              for each field in the table
+
+    Raises
+    ------
+    KeyError
+             If the cube does not have a table with the name
+    """
+    table = _find_table(isis_label.read_label(cube), name)
+    if table is None:
+        raise KeyError('Table [{}] not found in cube [{}]'.format(name, cube))
+    dtype = table_dtype(table)
+    count = int(table['Records'])
+    data_file = cube
+    if '^Table' in table:
+        data_file = os.path.join(os.path.dirname(cube), table['^Table'])
+    with open(data_file, 'rb') as f:
+        f.seek(int(table['StartByte']) - 1)
+        records = np.fromfile(f, dtype, count)
+    if len(records) != count:
+        raise ValueError('Table [{}] in cube [{}] has {} records, expected {}'.format(
+                name, cube, len(records), count))
+    return records
+
+
+def _table_fields(dtype):
+    # the ISIS fields and the little endian packed record type to write
+    fields = []
+    packed = []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        base = field.base
+        size = int(np.prod(field.shape))
+        if base.kind == 'S':
+            fields.append((name, 'Text', base.itemsize * size))
+            packed.append((name, base))
+            continue
+        for field_type, code in _field_types.items():
+            if field_type != 'TEXT' and np.dtype(code) == base.newbyteorder('='):
+                break
+        else:
+            raise ValueError('Unsupported type [{}] for field [{}]'.format(base, name))
+        fields.append((name, field_type.capitalize(), size))
+        packed.append((name, '<' + code, field.shape))
+    return fields, np.dtype(packed)
+
+
+def write_table(cube, name, records, keywords=()):
+    """
+    Write a table to a cube, replacing any table with the same name. Like
+    csv2table, the keywords of the replaced table are not kept.
+
+    The records are written over the old table if they fit in its space,
+    otherwise they are added to the end of the cube. The cube label is
+    updated in place, so it has to fit in the label space of the cube.
+
+    If the cube has a detached label, see write_detached_label, the records
+    are written to a file of their own next to the label instead, named after
+    the label and the table, such as out_InstrumentPointing.tbl for out.lbl,
+    so the file the label points at is not changed.
+
+    Parameters
+    ----------
+    cube : str
+           The cube, or detached label, to write the table to
+
+    name : str
+           The name of the table
+
+    records : numpy.ndarray
+              The records to write, as a structured array. Fields can be
+              8 or 4 byte floats, 4 byte integers or byte strings.
+
+    keywords : list
+               Optional (name, value) tuples to add to the Table object
+    """
+    fields, dtype = _table_fields(records.dtype)
+    data = np.array(records, dtype=dtype).tobytes()
+
+    label = isis_label.parse_label(isis_label.read_label_text(cube))
+    old_table = _find_table(label, name)
+    detached = '^Core' in label.find('Object', 'Core')
+    if detached:
+        data_file = '{}_{}.tbl'.format(os.path.splitext(cube)[0], name)
+        start_byte = 1
+    else:
+        label_bytes = int(label.find('Object', 'Label')['Bytes'])
+        if old_table is not None and len(data) <= int(old_table['Bytes']):
+            start_byte = int(old_table['StartByte'])
+        else:
+            start_byte = max(os.path.getsize(cube), label_bytes) + 1
+
+    table = isis_label.PvlBlock('Object', 'Table')
+    table.keywords = [('Name', name),
+                      ('StartByte', str(start_byte)),
+                      ('Bytes', str(len(data))),
+                      ('Records', str(len(records))),
+                      ('ByteOrder', 'Lsb')]
+    table.keywords += list(keywords)
+    if detached:
+        table.keywords.insert(0, ('^Table', os.path.basename(data_file)))
+    for field_name, field_type, size in fields:
+        field = isis_label.PvlBlock('Group', 'Field')
+        field.keywords = [('Name', field_name), ('Type', field_type), ('Size', str(size))]
+        table.blocks.append(field)
+    if old_table is not None:
+        label.blocks[label.blocks.index(old_table)] = table
+    else:
+        label.blocks.append(table)
+
+    if detached:
+        for filename, text in [(data_file, data), (cube, isis_label.format_label(label).encode())]:
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(text)
+            os.rename(filename + '.tmp', filename)
+        isis_label.clear_cache()
+        return
+
+    text = isis_label.format_label(label).encode()
+    if len(text) > label_bytes:
+        raise ValueError('Label of cube [{}] would be {} bytes, more than the {} bytes reserved for it'.format(
+                cube, len(text), label_bytes))
+    with open(cube, 'r+b') as f:
+        f.seek(start_byte - 1)
+        f.write(data)
+        f.seek(0)
+        f.write(text.ljust(label_bytes, b'\0'))
+    isis_label.clear_cache()
+
+
+def clone_file(source, destination):
+    """
+    Make a copy on write clone of a file, a reflink, which shares the data
+    of the source until either file is changed. This needs a filesystem that
+    supports it, such as Btrfs or XFS.
+
+    Parameters
+    ----------
+    source : str
+             The file to clone
+
+    destination : str
+                  The clone to make, replacing any existing file
+
+    Raises
+    ------
+    OSError
+             If the filesystem cannot clone the file
+    """
+    temporary = destination + '.tmp'
+    try:
+        with open(source, 'rb') as src, open(temporary, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _ficlone, src.fileno())
+        os.rename(temporary, destination)
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def write_detached_label(cube, label_file):
+    """
+    Write a detached label for a cube. The label file has a copy of the cube
+    label whose Core and binary objects, such as tables, point at the data in
+    the cube, so it can be opened like the cube itself without copying any
+    data. ISIS applications that write a table to a cube with a detached
+    label write it to a file of its own next to the label, as does
+    write_table, so the original cube is not changed.
+
+    Parameters
+    ----------
+    cube : str
+           The cube with an attached label
+
+    label_file : str
+                 The detached label file to write, replacing any existing file
+    """
+    label = isis_label.parse_label(isis_label.read_label_text(cube))
+    pointer = os.path.relpath(os.path.abspath(cube),
+                              os.path.dirname(os.path.abspath(label_file)))
+    label.find('Object', 'Core').keywords.insert(0, ('^Core', pointer))
+    for block in list(label.blocks):
+        if block.kind != 'Object':
+            continue
+        if block.name.lower() == 'label':
+            label.blocks.remove(block)
+        elif 'StartByte' in block:
+            block.keywords.insert(0, ('^' + block.name, pointer))
+
+    with open(label_file + '.tmp', 'w') as f:
+        f.write(isis_label.format_label(label))
+    os.rename(label_file + '.tmp', label_file)
+
+
+def stage_cube(cube, output_file, method='auto'):
+    """
+    Stage a cube for an application that will modify it in place, such as
+    jigsaw update=true, sharing its pixel data instead of copying it where
+    possible. Hard links are never used, since the application would then
+    modify the original cube as well.
+
+    Parameters
+    ----------
+    cube : str
+           The cube to stage
+
+    output_file : str
+                  The staged cube
+
+    method : str
+             How to stage the cube:
+             reflink, a copy on write clone of the whole cube;
+             detached, a detached label that points at the pixels and tables
+             of the cube, see write_detached_label;
+             copy, a full copy;
+             or auto, the first of these that works. Defaults to auto.
+
+    Returns
+    -------
+    method : str
+             The method that was used
+
+    Raises
+    ------
+    OSError
+             If the method is reflink and the filesystem cannot clone files
+    """
+    if method in ['auto', 'reflink']:
+        try:
+            clone_file(cube, output_file)
+            return 'reflink'
+        except OSError:
+            if method == 'reflink':
+                raise
+    if method in ['auto', 'detached']:
+        try:
+            write_detached_label(cube, output_file)
+            return 'detached'
+        except (KeyError, ValueError):
+            # not an ISIS cube label that can be detached
+            if method == 'detached':
+                raise
+    if method not in ['auto', 'copy']:
+        raise ValueError('Unknown staging method [{}]'.format(method))
+    shutil.copyfile(cube, output_file)
+    return 'copy'
+
+
+def create_cube(filename, samples, lines, bands, groups=(), tile_size=128,
+                label_bytes=65536, fill=True):
+    """
+    Create a Tile cube of Real pixels with an attached label, like the cubes
+    ISIS applications write, and map it into memory to write its pixels.
+
+    Parameters
+    ----------
+    filename : str
+               The cube to create, replacing any existing file
+
+    samples, lines, bands : int
+                            The dimensions of the cube
+
+    groups : list
+             Optional PvlBlock groups to add to the IsisCube object after the
+             Core, such as Mapping and BandBin
+
+    tile_size : int
+                The samples and lines of the tiles. Defaults to 128, like ISIS.
+
+    label_bytes : int
+                  The space reserved for the label
+
+    fill : bool
+           Set every pixel to Null. Without this the pixels are 0 until
+           they are written, which saves writing the cube twice when every
+           pixel will be written anyway.
+
+    Returns
+    -------
+    cube : Cube
+           The new cube, opened with mode r+
+    """
+    tile_samples = min(tile_size, samples)
+    tile_lines = min(tile_size, lines)
+    core = isis_label.PvlBlock('Object', 'Core')
+    core.keywords = [('StartByte', str(label_bytes + 1)),
+                     ('Format', 'Tile'),
+                     ('TileSamples', str(tile_samples)),
+                     ('TileLines', str(tile_lines))]
+    dimensions = isis_label.PvlBlock('Group', 'Dimensions')
+    dimensions.keywords = [('Samples', str(samples)), ('Lines', str(lines)), ('Bands', str(bands))]
+    pixels = isis_label.PvlBlock('Group', 'Pixels')
+    pixels.keywords = [('Type', 'Real'), ('ByteOrder', 'Lsb'), ('Base', '0.0'), ('Multiplier', '1.0')]
+    core.blocks = [dimensions, pixels]
+    isis_cube = isis_label.PvlBlock('Object', 'IsisCube')
+    isis_cube.blocks = [core] + list(groups)
+    label_object = isis_label.PvlBlock('Object', 'Label')
+    label_object.keywords = [('Bytes', str(label_bytes))]
+    label = isis_label.PvlBlock('Root', '')
+    label.blocks = [isis_cube, label_object]
+
+    text = isis_label.format_label(label).encode()
+    if len(text) > label_bytes:
+        raise ValueError('Label of cube [{}] would be {} bytes, more than the {} bytes reserved for it'.format(
+                filename, len(text), label_bytes))
+    tiles = bands * -(-lines // tile_lines) * -(-samples // tile_samples)
+    with open(filename, 'wb') as f:
+        f.write(text.ljust(label_bytes, b'\0'))
+        f.truncate(label_bytes + tiles * tile_lines * tile_samples * 4)
+    isis_label.clear_cache()
+
+    cube = Cube(filename, 'r+')
+    if fill:
+        pixels = cube.memmap()
+        for band in range(bands):
+            for row in range(cube.tile_rows):
+                pixels[band, row] = cube.null
+    return cube
+
+
+class Cube(object):
+    """
+    The pixels of an ISIS cube, mapped into memory.
+
+    Parameters
+    ----------
+    filename : str
+               The cube, or its detached label
+
+    mode : str
+           The numpy.memmap mode, r to read the pixels or r+ to also change
+           them. Defaults to r.
+
+    Attributes
+    ----------
+    samples, lines, bands : int
+                            The dimensions of the cube
+
+    pixel_type : str
+                 The ISIS pixel type, UnsignedByte, SignedWord, UnsignedWord
+                 or Real
+
+    base, multiplier : float
+                       The scaling from stored pixels to DN values
+
+    format : str
+             Tile or BandSequential
+
+    tile_samples, tile_lines : int
+                               The size of the tiles of a Tile cube
+
+    data_file : str
+                The file with the pixel data
+
+    Raises
+    ------
+    ValueError
+               If the pixel type or format is not supported
+    """
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.mode = mode
+        label = isis_label.read_label(filename)
+        core = label.find('Object', 'Core')
+        dimensions = core.find('Group', 'Dimensions')
+        pixels = core.find('Group', 'Pixels')
+        self.samples = int(dimensions['Samples'])
+        self.lines = int(dimensions['Lines'])
+        self.bands = int(dimensions['Bands'])
+        self.pixel_type = pixels['Type']
+        if self.pixel_type.upper() not in _pixel_types:
+            raise ValueError('Unsupported pixel type [{}] in cube [{}]'.format(self.pixel_type, filename))
+        self.type_code = _pixel_types[self.pixel_type.upper()]
+        self.dtype = np.dtype(_byte_orders[pixels.get('ByteOrder', 'Lsb').upper()] + self.type_code)
+        self.base = float(pixels.get('Base', 0.0))
+        self.multiplier = float(pixels.get('Multiplier', 1.0))
+        self.format = core.get('Format', 'Tile')
+        if self.format.upper() not in ['TILE', 'BANDSEQUENTIAL']:
+            raise ValueError('Unsupported format [{}] in cube [{}]'.format(self.format, filename))
+        self.tiled = self.format.upper() == 'TILE'
+        self.tile_samples = int(core.get('TileSamples', self.samples)) if self.tiled else self.samples
+        self.tile_lines = int(core.get('TileLines', self.lines)) if self.tiled else self.lines
+        self.start_byte = int(core['StartByte'])
+        self.data_file = filename
+        if '^Core' in core:
+            self.data_file = os.path.join(os.path.dirname(filename), core['^Core'])
+        self._memmap = None
+
+    @property
+    def tile_rows(self):
+        return -(-self.lines // self.tile_lines)
+
+    @property
+    def tile_columns(self):
+        return -(-self.samples // self.tile_samples)
+
+    @property
+    def null(self):
+        # the stored Null pixel of the cube
+        value = _special_values[self.type_code][0]
+        if self.type_code == 'f4':
+            return np.array(value, np.uint32).view(np.float32).astype(self.dtype)
+        return np.array(value, self.dtype)
+
+    def memmap(self):
+        """
+        Map the stored pixels of the cube into memory, without reading them.
+
+        Returns
+        -------
+        pixels : numpy.memmap
+                 The stored pixels, before scaling. For BandSequential cubes
+                 the shape is (bands, lines, samples). For Tile cubes it is
+                 (bands, tile rows, tile columns, tile lines, tile samples),
+                 where the tiles at the right and bottom edges are padded
+                 past the edge of the cube, see read for a window of pixels.
+        """
+        if self._memmap is None:
+            if self.tiled:
+                shape = (self.bands, self.tile_rows, self.tile_columns,
+                         self.tile_lines, self.tile_samples)
+            else:
+                shape = (self.bands, self.lines, self.samples)
+            self._memmap = np.memmap(self.data_file, self.dtype, self.mode,
+                                     self.start_byte - 1, shape)
+        return self._memmap
+
+    def read(self, lines=None, samples=None, bands=None):
+        """
+        Read the stored pixels of a window of the cube. Only the tiles that
+        overlap the window are read.
+
+        Parameters
+        ----------
+        lines : tuple
+                Optional (first, last) lines of the window, counting from 0,
+                with the last line not included, like a slice. Defaults to
+                every line.
+
+        samples : tuple
+                  Optional (first, last) samples of the window. Defaults to
+                  every sample.
+
+        bands : int or list
+                Optional band or bands, counting from 0. Defaults to every
+                band.
+
+        Returns
+        -------
+        pixels : numpy.ndarray
+                 The stored pixels of the window, before scaling, with the
+                 shape (bands, lines, samples), or (lines, samples) if a
+                 single band was given. For a BandSequential cube this is a
+                 view of the memory map, not a copy.
+        """
+        first_line, last_line = lines or (0, self.lines)
+        first_sample, last_sample = samples or (0, self.samples)
+        band_index = slice(None) if bands is None else bands
+        pixels = self.memmap()
+        if not self.tiled:
+            return pixels[band_index, first_line:last_line, first_sample:last_sample]
+
+        first_row = first_line // self.tile_lines
+        last_row = -(-last_line // self.tile_lines)
+        first_column = first_sample // self.tile_samples
+        last_column = -(-last_sample // self.tile_samples)
+        tiles = pixels[band_index, first_row:last_row, first_column:last_column]
+        # put the lines of each row of tiles next to each other
+        window = np.moveaxis(tiles, -2, -3)
+        window = window.reshape(window.shape[:-4] + (window.shape[-4] * window.shape[-3],
+                                                     window.shape[-2] * window.shape[-1]))
+        line_offset = first_row * self.tile_lines
+        sample_offset = first_column * self.tile_samples
+        return window[..., first_line - line_offset:last_line - line_offset,
+                      first_sample - sample_offset:last_sample - sample_offset]
+
+    def write(self, pixels, lines=None, samples=None, band=0):
+        """
+        Write stored pixels to a window of one band of the cube, which has to
+        be opened with mode r+. For a Tile cube, tiles that the window only
+        partly covers are read first, so the rest of the tile is kept.
+
+        Parameters
+        ----------
+        pixels : numpy.ndarray
+                 The stored pixels, with the shape (lines, samples) of the
+                 window
+
+        lines : tuple
+                Optional (first, last) lines of the window, see read
+
+        samples : tuple
+                  Optional (first, last) samples of the window
+
+        band : int
+               The band, counting from 0
+        """
+        first_line, last_line = lines or (0, self.lines)
+        first_sample, last_sample = samples or (0, self.samples)
+        memmap = self.memmap()
+        if not self.tiled:
+            memmap[band, first_line:last_line, first_sample:last_sample] = pixels
+            return
+
+        first_row = first_line // self.tile_lines
+        last_row = -(-last_line // self.tile_lines)
+        first_column = first_sample // self.tile_samples
+        last_column = -(-last_sample // self.tile_samples)
+        line_offset = first_row * self.tile_lines
+        sample_offset = first_column * self.tile_samples
+        height = (last_row - first_row) * self.tile_lines
+        width = (last_column - first_column) * self.tile_samples
+        covered = (first_line == line_offset and first_sample == sample_offset and
+                   last_line in (line_offset + height, self.lines) and
+                   last_sample in (sample_offset + width, self.samples))
+        if covered:
+            window = np.full((height, width), self.null, self.dtype)
+        else:
+            window = np.array(self.read((line_offset, line_offset + height),
+                                        (sample_offset, sample_offset + width), band))
+            if window.shape != (height, width):
+                # the edge of the cube, pad to whole tiles
+                window = np.pad(window, ((0, height - window.shape[0]), (0, width - window.shape[1])),
+                                constant_values=self.null)
+        window[first_line - line_offset:last_line - line_offset,
+               first_sample - sample_offset:last_sample - sample_offset] = pixels
+        tiles = window.reshape(last_row - first_row, self.tile_lines,
+                               last_column - first_column, self.tile_samples)
+        memmap[band, first_row:last_row, first_column:last_column] = tiles.transpose(0, 2, 1, 3)
+
+    def special_mask(self, pixels):
+        """
+        Find the special pixels, such as Null and saturated pixels.
+
+        Parameters
+        ----------
+        pixels : numpy.ndarray
+                 Stored pixels read from the cube
+
+        Returns
+        -------
+        mask : numpy.ndarray
+               True where the pixels are special
+        """
+        if self.type_code == 'f4':
+            return self._bits(pixels) > _valid_max_bits
+        minimum, maximum = _valid_ranges[self.type_code]
+        return (pixels < minimum) | (pixels > maximum)
+
+    def _bits(self, pixels):
+        # the bits of Real pixels, to compare with the special pixel values
+        return pixels.view(self.dtype.byteorder.replace('=', '') + 'u4')
+
+    def special_masks(self, pixels, names=None):
+        """
+        Find each kind of special pixel.
+
+        Parameters
+        ----------
+        pixels : numpy.ndarray
+                 Stored pixels read from the cube
+
+        names : list
+                Optional special pixel names, see special_pixels. Defaults
+                to all of them.
+
+        Returns
+        -------
+        masks : numpy.ndarray
+                A mask for each name, stacked along the first axis
+        """
+        names = names or special_pixels
+        values = _special_values[self.type_code]
+        if self.type_code == 'f4':
+            pixels = self._bits(pixels)
+        masks = []
+        for name in names:
+            value = values[special_pixels.index(name)]
+            if value is None:
+                masks.append(np.zeros(pixels.shape, bool))
+            else:
+                masks.append(pixels == value)
+        return np.stack(masks)
+
+    def dn(self, pixels, fill=np.nan):
+        """
+        Scale stored pixels to DN values with the base and multiplier of the
+        cube, replacing the special pixels.
+
+        Parameters
+        ----------
+        pixels : numpy.ndarray
+                 Stored pixels read from the cube
+
+        fill : float
+               The value for the special pixels. Defaults to NaN.
+
+        Returns
+        -------
+        values : numpy.ndarray
+                 The DN values, as 32 bit floats
+        """
+        values = pixels.astype(np.float32)
+        if self.base != 0.0 or self.multiplier != 1.0:
+            values = np.float32(self.base) + np.float32(self.multiplier) * values
+        values[self.special_mask(pixels)] = fill
+        return values
+
+    def statistics(self, band=0):
+        """
+        Compute statistics of one band, like the ISIS stats application,
+        reading one row of tiles at a time, or for cubes that are not tiled,
+        about statistics_block_pixels pixels at a time.
+
+        Parameters
+        ----------
+        band : int
+               The band, counting from 0
+
+        Returns
+        -------
+        statistics : dict
+                     The number of valid pixels, their minimum, maximum,
+                     average and standard deviation, and the number of each
+                     kind of special pixel
+        """
+        counts = dict((name, 0) for name in special_pixels)
+        valid = 0
+        total = 0.0
+        total_squares = 0.0
+        minimum = np.inf
+        maximum = -np.inf
+        if self.tiled:
+            block_lines = self.tile_lines
+        else:
+            block_lines = max(1, statistics_block_pixels // self.samples)
+        for first_line in range(0, self.lines, block_lines):
+            pixels = self.read((first_line, min(first_line + block_lines, self.lines)), bands=band)
+            for name, mask in zip(special_pixels, self.special_masks(pixels)):
+                counts[name] += int(np.count_nonzero(mask))
+            values = self.dn(pixels)
+            values = values[~np.isnan(values)].astype(np.float64)
+            if values.size:
+                valid += values.size
+                total += values.sum()
+                total_squares += np.square(values).sum()
+                minimum = min(minimum, values.min())
+                maximum = max(maximum, values.max())
+
+        statistics = {'valid' : valid}
+        if valid:
+            average = total / valid
+            variance = max(0.0, total_squares / valid - average * average)
+            statistics.update({'minimum' : float(minimum),
+                               'maximum' : float(maximum),
+                               'average' : float(average),
+                               'standard_deviation' : float(np.sqrt(variance))})
+        statistics.update(counts)
+        return statistics
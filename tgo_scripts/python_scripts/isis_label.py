@@ -0,0 +1,356 @@
+"""
+This module reads the PVL labels of ISIS cubes and PVL files, such as map
+files, without running any ISIS applications. Labels can also be formatted
+back into PVL text, for example after a table has been added to a cube.
+
+Only the label is read from a cube, not its pixel data, and parsed labels are
+kept in a least recently used cache keyed by the file path and its size and
+modification time. Reading several keywords from the same file, or reading
+the same template cube over and over, only parses it once. If the file
+changes, for example after spiceinit, it is parsed again.
+"""
+
+import os, re
+from functools import lru_cache
+
+# the number of parsed labels kept in memory
+cache_size = 1024
+
+# labels are read in chunks of this size until the End statement is found
+chunk_size = 64 * 1024
+
+_token_pattern = re.compile(r'''
+      (?P<comment>/\*.*?\*/|\#[^\n]*)
+    | (?P<string>"[^"]*"|'[^']*')
+    | (?P<unit><[^>]*>)
+    | (?P<symbol>[=(){},])
+    | (?P<word>[^\s=(){},"'<>]+)
+    | (?P<space>\s+)
+    ''', re.VERBOSE | re.DOTALL)
+
+_end_pattern = re.compile(br'(^|\n)[ \t]*End[ \t]*\r?\n')
+
+_begin_statements = {'OBJECT' : 'Object', 'BEGIN_OBJECT' : 'Object',
+                     'GROUP' : 'Group', 'BEGIN_GROUP' : 'Group'}
+_end_statements = ['END_OBJECT', 'END_GROUP', 'ENDOBJECT', 'ENDGROUP']
+
+_word_pattern = re.compile(r'[^\s=(){},"\'<>#]+')
+
+
+class _Keyword(tuple):
+    # a (name, value) keyword that remembers its text in the label, so
+    # keywords that are not changed are written back exactly as they were read
+    def __new__(cls, name, value, text):
+        keyword = tuple.__new__(cls, (name, value))
+        keyword.text = text
+        return keyword
+
+
+class PvlBlock(object):
+    """
+    An object or group in a PVL label, or the label itself.
+
+    Attributes
+    ----------
+    kind : str
+           Object, Group, or Root for the whole label
+
+    name : str
+           The name of the object or group
+
+    keywords : list
+               (name, value) tuples for the keywords directly in the block,
+               in label order. Values are strings, or lists of strings for
+               arrays. Units are dropped from the values, but are kept when
+               the label is formatted unless the keyword is changed.
+
+    blocks : list
+             The objects and groups directly in the block, in label order
+    """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.keywords = []
+        self.blocks = []
+
+    def __contains__(self, keyword):
+        return any(name.lower() == keyword.lower() for name, value in self.keywords)
+
+    def __getitem__(self, keyword):
+        for name, value in self.keywords:
+            if name.lower() == keyword.lower():
+                return value
+        raise KeyError('Keyword [{}] not found in {} [{}]'.format(keyword, self.kind, self.name))
+
+    def __setitem__(self, keyword, value):
+        for index, (name, old_value) in enumerate(self.keywords):
+            if name.lower() == keyword.lower():
+                self.keywords[index] = (name, value)
+                return
+        self.keywords.append((keyword, value))
+
+    def get(self, keyword, default=None):
+        """
+        Get the value of the first keyword in the block with a name,
+        ignoring case, or a default value if it is not in the block.
+        """
+        try:
+            return self[keyword]
+        except KeyError:
+            return default
+
+    def find_all(self, kind, name=None):
+        """
+        Find all of the objects or groups in this block, at any depth,
+        with a given kind and, optionally, name, in label order.
+        """
+        found = []
+        for block in self.blocks:
+            if block.kind == kind and (name is None or block.name.lower() == name.lower()):
+                found.append(block)
+            found += block.find_all(kind, name)
+        return found
+
+    def find(self, kind, name):
+        """
+        Find the first object or group in this block, at any depth,
+        with a given kind and name.
+        """
+        found = self.find_all(kind, name)
+        if not found:
+            raise KeyError('{} [{}] not found in {} [{}]'.format(kind, name, self.kind, self.name))
+        return found[0]
+
+
+def read_label_text(filename):
+    """
+    Read the label text from the start of a cube or PVL file. For cubes, only
+    the bytes up to the End statement are read, not the pixel data.
+
+    Parameters
+    ----------
+    filename : str
+               The cube or PVL file
+
+    Returns
+    -------
+    text : str
+           The label text
+    """
+    data = b''
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # search from a little before the new chunk in case End was split
+            search_start = max(0, len(data) - 64)
+            data += chunk
+            match = _end_pattern.search(data, search_start)
+            if match:
+                data = data[:match.end()]
+                break
+    return data.decode('utf-8', 'replace')
+
+
+def _tokens(text):
+    for match in _token_pattern.finditer(text):
+        kind = match.lastgroup
+        if kind in ['comment', 'space']:
+            continue
+        token = match.group()
+        if kind == 'string':
+            # strings can be wrapped over several lines, with or without a
+            # trailing dash
+            token = re.sub(r'-\s*\n\s*', '', token[1:-1])
+            token = re.sub(r'\s*\n\s*', ' ', token)
+        yield kind, token, match.start(), match.end()
+
+
+def _is_symbol(tokens, index, symbol):
+    return index < len(tokens) and tokens[index][:2] == ('symbol', symbol)
+
+
+def _parse_value(tokens, index):
+    kind, token = tokens[index][:2]
+    index += 1
+    if kind == 'symbol' and token in '({':
+        close = ')' if token == '(' else '}'
+        values = []
+        while index < len(tokens) and not _is_symbol(tokens, index, close):
+            if _is_symbol(tokens, index, ','):
+                index += 1
+                continue
+            value, index = _parse_value(tokens, index)
+            values.append(value)
+        index += 1
+        value = values
+    else:
+        value = token
+    # drop any units
+    if index < len(tokens) and tokens[index][0] == 'unit':
+        index += 1
+    return value, index
+
+
+def parse_label(text):
+    """
+    Parse PVL label text.
+
+    Parameters
+    ----------
+    text : str
+           The label text
+
+    Returns
+    -------
+    label : PvlBlock
+            The root block of the label
+    """
+    tokens = list(_tokens(text))
+    root = PvlBlock('Root', '')
+    stack = [root]
+    index = 0
+    while index < len(tokens):
+        kind, name = tokens[index][:2]
+        index += 1
+        value = None
+        text_start = text_end = None
+        if _is_symbol(tokens, index, '='):
+            text_start = tokens[index + 1][2] if index + 1 < len(tokens) else None
+            value, index = _parse_value(tokens, index + 1)
+            text_end = tokens[index - 1][3]
+
+        statement = name.upper()
+        if statement in _begin_statements:
+            block = PvlBlock(_begin_statements[statement], value)
+            stack[-1].blocks.append(block)
+            stack.append(block)
+        elif statement in _end_statements:
+            if len(stack) > 1:
+                stack.pop()
+        elif statement == 'END':
+            break
+        else:
+            raw = text[text_start:text_end] if text_start is not None else None
+            stack[-1].keywords.append(_Keyword(name, value, raw))
+    return root
+
+
+def _format_value(value):
+    if isinstance(value, (list, tuple)):
+        return '({})'.format(', '.join(_format_value(item) for item in value))
+    value = str(value)
+    if _word_pattern.fullmatch(value) and not value.startswith('/*'):
+        return value
+    if '"' in value:
+        return "'{}'".format(value)
+    return '"{}"'.format(value)
+
+
+def _format_block(block, indent):
+    lines = []
+    width = max([len(name) for name, value in block.keywords] + [0])
+    for keyword in block.keywords:
+        name, value = keyword
+        text = getattr(keyword, 'text', None)
+        if text is None:
+            text = 'Null' if value is None else _format_value(value)
+        lines.append('{}{} = {}'.format(' ' * indent, name.ljust(width), text))
+    for child in block.blocks:
+        if lines:
+            lines.append('')
+        lines.append('{}{} = {}'.format(' ' * indent, child.kind, _format_value(child.name)))
+        lines += _format_block(child, indent + 2)
+        lines.append('{}End_{}'.format(' ' * indent, child.kind))
+    return lines
+
+
+@lru_cache(maxsize=cache_size)
+def _cached_label(filename, size, mtime):
+    return parse_label(read_label_text(filename))
+
+
+def format_label(label):
+    """
+    Format a label as PVL text. Keywords that have not been changed since the
+    label was parsed keep their original text, including any units.
+
+    Parameters
+    ----------
+    label : PvlBlock
+            The root block of the label
+
+    Returns
+    -------
+    text : str
+           The label text, ending with the End statement
+    """
+    return '\n'.join(_format_block(label, 0) + ['End', ''])
+
+
+def read_label(filename):
+    """
+    Read and parse the label of a cube or PVL file, using the cache if the
+    file has not changed since it was last parsed. The returned label is
+    shared with the cache, so use parse_label and read_label_text to get a
+    copy that can be changed.
+
+    Parameters
+    ----------
+    filename : str
+               The cube or PVL file
+
+    Returns
+    -------
+    label : PvlBlock
+            The root block of the label
+    """
+    stat = os.stat(filename)
+    return _cached_label(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+def clear_cache():
+    """
+    Remove all of the parsed labels from the cache.
+    """
+    _cached_label.cache_clear()
+
+
+def get_key(filename, keyword, object=None, group=None):
+    """
+    Get the value of a keyword from the label of an ISIS cube or PVL file.
+    Objects and groups are searched for at any depth, like the getkey
+    application.
+
+    Parameters
+    ----------
+    filename : str
+               The cube or PVL file to read the keyword from
+
+    keyword : str
+              The name of the keyword
+
+    object : str
+             The optional name of the object containing the keyword
+
+    group : str
+            The optional name of the group containing the keyword
+
+    Returns
+    -------
+    value : str or list
+            The value of the keyword, without units. Arrays are returned as
+            lists of strings.
+
+    Raises
+    ------
+    KeyError
+             If the object, group or keyword is not in the label
+    """
+    block = read_label(filename)
+    if object:
+        block = block.find('Object', object)
+    if group:
+        block = block.find('Group', group)
+    return block[keyword]
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+import cassis_mosaic, isis_cube, isis_label
+
+RESOLUTION = 4.5
+# the stored Real Null pixel, by its bits
+NULL = np.array(0xFF7FFFFB, np.uint32).view(np.float32)
+
+
+def mapping(**keywords):
+    group = isis_label.PvlBlock('Group', 'Mapping')
+    group.keywords = [('ProjectionName', 'Equirectangular'),
+                      ('EquatorialRadius', '3396190.0'),
+                      ('LatitudeType', 'Planetocentric'),
+                      ('LongitudeDirection', 'PositiveEast'),
+                      ('CenterLongitude', '0.0'),
+                      ('CenterLatitude', '0.0'),
+                      ('PixelResolution', repr(RESOLUTION))]
+    group.keywords += [(name, str(value)) for name, value in keywords.items()]
+    return group
+
+
+def projected(filename, pixels, line, sample, resolution=RESOLUTION):
+    # a projected framelet with its upper left corner at a line and sample
+    # of the mosaic grid, whose corner is at 0, 0
+    group = mapping(UpperLeftCornerX=sample * RESOLUTION, UpperLeftCornerY=-line * RESOLUTION)
+    group['PixelResolution'] = repr(resolution)
+    cube = isis_cube.create_cube(filename, pixels.shape[1], pixels.shape[0], 1, [group], tile_size=16)
+    cube.write(np.where(np.isnan(pixels), NULL, pixels).astype(np.float32))
+    cube.memmap().flush()
+    return filename
+
+
+@pytest.fixture
+def framelets(tmp_path):
+    rng = np.random.default_rng(7)
+    first = rng.random((40, 50))
+    second = rng.random((30, 60))
+    # Null pixels do not cover the framelets under them
+    second[:5, :5] = np.nan
+    return [(projected(str(tmp_path / 'first.cub'), first, 0, 0), first, 0, 0),
+            (projected(str(tmp_path / 'second.cub'), second, 20, 30), second, 20, 30)]
+
+
+def expected_mosaic(framelets, priority):
+    # the mosaic of the framelets, worked out pixel by pixel
+    lines = max(line + pixels.shape[0] for filename, pixels, line, sample in framelets)
+    samples = max(sample + pixels.shape[1] for filename, pixels, line, sample in framelets)
+    total = np.zeros((lines, samples))
+    count = np.zeros((lines, samples))
+    result = np.full((lines, samples), np.nan)
+    order = framelets if priority != 'beneath' else framelets[::-1]
+    for filename, pixels, line, sample in order:
+        window = (slice(line, line + pixels.shape[0]), slice(sample, sample + pixels.shape[1]))
+        valid = ~np.isnan(pixels)
+        result[window][valid] = pixels[valid]
+        total[window][valid] += pixels[valid]
+        count[window] += valid
+    if priority == 'average':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
+    return result
+
+
+@pytest.mark.parametrize('priority', cassis_mosaic.priorities)
+def test_mosaic_cubes(tmp_path, framelets, priority):
+    output_file = str(tmp_path / 'mosaics' / 'RED_equi.cub')
+    # small blocks, so the framelets span several blocks and blocks share tiles
+    output = cassis_mosaic.mosaic_cubes([[filename for filename, pixels, line, sample in framelets]],
+                                        output_file, priority=priority, band_names=['RED'],
+                                        block_size=20, max_workers=3)
+    assert (output.samples, output.lines, output.bands) == (90, 50, 1)
+    mosaic = isis_cube.Cube(output_file)
+    values = mosaic.dn(mosaic.read(bands=0))
+    np.testing.assert_allclose(values, expected_mosaic(framelets, priority).astype(np.float32), rtol=1e-6)
+
+    label = isis_label.read_label(output_file)
+    assert label.find('Group', 'BandBin')['FilterName'] == ['RED']
+    assert float(label.find('Group', 'Mapping')['UpperLeftCornerX']) == 0.0
+    assert float(label.find('Group', 'Mapping')['UpperLeftCornerY']) == 0.0
+
+
+def test_mosaic_map_extent(tmp_path, framelets):
+    # a map that starts 10 lines and samples into the framelets, 30 by 40 pixels
+    radius = 3396190.0
+    map_group = mapping(MinimumLongitude=np.degrees(10 * RESOLUTION / radius),
+                        MaximumLongitude=np.degrees(50 * RESOLUTION / radius),
+                        MinimumLatitude=np.degrees(-40 * RESOLUTION / radius),
+                        MaximumLatitude=np.degrees(-10 * RESOLUTION / radius))
+    map_file = tmp_path / 'equi.map'
+    label = isis_label.PvlBlock('Root', '')
+    label.blocks = [map_group]
+    map_file.write_text(isis_label.format_label(label))
+    assert cassis_mosaic.map_extent(map_group) == pytest.approx(
+        (10 * RESOLUTION, 50 * RESOLUTION, -40 * RESOLUTION, -10 * RESOLUTION))
+
+    output_file = str(tmp_path / 'mosaic.cub')
+    output = cassis_mosaic.mosaic_cubes([[framelets[0][0]], [framelets[1][0]]], output_file, str(map_file),
+                                        block_size=16)
+    assert (output.samples, output.lines, output.bands) == (40, 30, 2)
+    mosaic = isis_cube.Cube(output_file)
+    for band, (filename, pixels, line, sample) in enumerate(framelets):
+        expected = expected_mosaic([(filename, pixels, line, sample)], 'ontop')
+        np.testing.assert_allclose(mosaic.dn(mosaic.read(bands=band)),
+                                   expected[10:40, 10:50].astype(np.float32), rtol=1e-6)
+
+
+def test_map_extent_needs_an_equirectangular_map():
+    assert cassis_mosaic.map_extent(mapping()) is None
+    ranges = dict(MinimumLatitude=0, MaximumLatitude=1, MinimumLongitude=0, MaximumLongitude=1)
+    assert cassis_mosaic.map_extent(mapping(**ranges)) is not None
+    for name in ['EquatorialRadius', 'CenterLongitude']:
+        group = mapping(**ranges)
+        group.keywords = [keyword for keyword in group.keywords if keyword[0] != name]
+        assert cassis_mosaic.map_extent(group) is None
+    group = mapping(**ranges)
+    group['ProjectionName'] = 'Sinusoidal'
+    assert cassis_mosaic.map_extent(group) is None
+
+
+def test_mosaic_different_projections(tmp_path):
+    pixels = np.ones((10, 10))
+    first = projected(str(tmp_path / 'first.cub'), pixels, 0, 0)
+    second = projected(str(tmp_path / 'second.cub'), pixels, 0, 0, resolution=9.0)
+    with pytest.raises(ValueError):
+        cassis_mosaic.mosaic_cubes([[first, second]], str(tmp_path / 'mosaic.cub'))
+    with pytest.raises(ValueError):
+        cassis_mosaic.mosaic_cubes([[first]], str(tmp_path / 'mosaic.cub'), priority='median')
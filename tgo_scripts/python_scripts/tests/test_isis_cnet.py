@@ -0,0 +1,304 @@
+import struct
+import numpy as np
+import pytest
+import isis_cnet
+
+SERIALS = ['TGO/CaSSIS/2018-05-01T10:00:00.000/PAN', 'TGO/CaSSIS/2018-05-01T10:00:01.000/PAN',
+           'TGO/CaSSIS/2018-05-01T10:00:02.000/RED']
+
+
+def make_network(points, measures, serials=SERIALS, strings=(), **header):
+    # a network from lists of column values, the rest left at their defaults
+    network = isis_cnet.ControlNetwork(**header)
+    network.serials = list(serials)
+    network.strings = list(strings)
+    network.points = np.zeros(len(points), isis_cnet.point_dtype(16))
+    for name, column_type, default in isis_cnet._point_columns:
+        network.points[name] = default
+    for row, values in enumerate(points):
+        for name, value in values.items():
+            network.points[name][row] = value
+    network.measures = np.zeros(len(measures), isis_cnet.measure_dtype)
+    for name, column_type, default in isis_cnet._measure_columns:
+        network.measures[name] = default
+    for row, values in enumerate(measures):
+        for name, value in values.items():
+            network.measures[name][row] = value
+    return network
+
+
+def resolved(network):
+    # the points and measures with the strings and serials they refer to,
+    # which do not depend on the order of the string tables
+    def strings(values):
+        return [network.strings[value] if value >= 0 else None for value in values]
+    points = dict((name, network.points[name]) for name in network.points.dtype.names)
+    points['id'] = network.points['id'].tolist()
+    for name in ['chooser', 'datetime', 'apriori_surface_file', 'apriori_radius_file']:
+        points[name] = strings(points[name])
+    measures = dict((name, network.measures[name]) for name in network.measures.dtype.names)
+    measures['serial'] = [network.serials[value] for value in measures['serial']]
+    for name in ['chooser', 'datetime']:
+        measures[name] = strings(measures[name])
+    return points, measures
+
+
+def assert_same_network(network, other):
+    for name in ['network_id', 'target_name', 'description', 'user_name', 'created', 'last_modified']:
+        assert getattr(network, name) == getattr(other, name)
+    for values, other_values in zip(resolved(network), resolved(other)):
+        assert sorted(values) == sorted(other_values)
+        for name in values:
+            # NaN compares equal here
+            np.testing.assert_array_equal(values[name], other_values[name], err_msg=name)
+
+
+def full_network():
+    # every column has a value other than its default somewhere
+    points = [{'id' : 'tgo_0001', 'type' : isis_cnet.FIXED, 'chooser' : 0, 'datetime' : 1,
+               'edit_lock' : True, 'ignore' : True, 'jigsaw_rejected' : True, 'reference' : 1,
+               'apriori_surface_source' : 3, 'apriori_surface_file' : 2,
+               'apriori_radius_source' : 5, 'apriori_radius_file' : 3,
+               'latitude_constrained' : False, 'longitude_constrained' : False,
+               'radius_constrained' : False, 'apriori' : [3396190.0, -12.5, 4.25e-3],
+               'apriori_covariance' : [1, 2, 3, 4, 5, 6], 'adjusted' : [3396000.5, 7.0, -1e-9],
+               'adjusted_covariance' : [-1, 0.5, 1e-12, 1e12, 0, 7]},
+              {'id' : 'tgo_0002', 'type' : isis_cnet.CONSTRAINED, 'reference' : 2},
+              {'id' : 'tgo_0003_longer'}]
+    measure = {'point' : 0, 'serial' : 0, 'type' : isis_cnet.REGISTERED_SUBPIXEL,
+               'sample' : 1024.25, 'line' : 128.75, 'chooser' : 4, 'datetime' : 1,
+               'edit_lock' : True, 'ignore' : True, 'jigsaw_rejected' : True,
+               'diameter' : 0.5, 'apriori_sample' : 1023.0, 'apriori_line' : 129.5,
+               'sample_sigma' : 0.25, 'line_sigma' : 0.125, 'sample_residual' : -0.5,
+               'line_residual' : 1e-3, 'goodness_of_fit' : 0.1,
+               'minimum_pixel_zscore' : -3.5, 'maximum_pixel_zscore' : 4.5,
+               'pixel_shift' : 0.75, 'whole_pixel_correlation' : 0.9,
+               'subpixel_correlation' : 0.95}
+    measures = [measure,
+                {'point' : 0, 'serial' : 1, 'type' : isis_cnet.MANUAL, 'sample' : 1.0, 'line' : 2.0},
+                {'point' : 1, 'serial' : 0, 'type' : isis_cnet.REGISTERED_PIXEL, 'sample' : 3.0},
+                {'point' : 1, 'serial' : 2, 'line' : 4.0},
+                {'point' : 1, 'serial' : 1, 'sample' : 5.0, 'line' : 6.0, 'ignore' : True}]
+    strings = ['pointreg', '2018-06-01T12:00:00', 'MOLA.cub', 'Dem.cub', 'qnet']
+    return make_network(points, measures, strings=strings, network_id='CaSSIS',
+                        target_name='Mars', description='a test network', user_name='tester',
+                        created='2018-06-01T12:00:00', last_modified='2018-06-02T12:00:00')
+
+
+def test_write_read_every_column(tmp_path):
+    network = full_network()
+    filename = str(tmp_path / 'network.net')
+    isis_cnet.write_network(network, filename)
+    again = isis_cnet.read_network(filename)
+    assert_same_network(network, again)
+    assert again.points['reference'].tolist() == [1, 2, -1]
+
+    # writing what was read gives the same file
+    isis_cnet.write_network(again, str(tmp_path / 'again.net'))
+    with open(filename, 'rb') as f, open(str(tmp_path / 'again.net'), 'rb') as g:
+        assert f.read() == g.read()
+
+
+def test_write_unordered_measures(tmp_path):
+    # measures of different points mixed together are written by point,
+    # keeping their order within each point
+    network = full_network()
+    order = [2, 0, 3, 1, 4]
+    network.points['reference'] = [order.index(1), order.index(2), -1]
+    network.measures = network.measures[order]
+    filename = str(tmp_path / 'network.net')
+    isis_cnet.write_network(network, filename)
+    assert_same_network(full_network(), isis_cnet.read_network(filename))
+
+
+# An encoder for the fixtures, written from the ISIS ControlNetFileHeaderV0002,
+# ControlPointFileEntryV0002 and ControlNetFileHeaderV0005 messages rather than
+# from isis_cnet, so the reader is not only tested against its own writer.
+def varint(value):
+    value &= (1 << 64) - 1
+    encoded = b''
+    while True:
+        if value < 0x80:
+            return encoded + bytes([value])
+        encoded += bytes([value & 0x7f | 0x80])
+        value >>= 7
+
+
+def field(number, value):
+    if isinstance(value, float):
+        return varint(number << 3 | 1) + struct.pack('<d', value)
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def packed_doubles(number, values):
+    return field(number, struct.pack('<{}d'.format(len(values)), *values))
+
+
+FIXTURE_POINTS = [
+    field(1, 'cassis_1') + field(2, 4) + field(3, 'jigsaw') + field(4, '2019-01-01T00:00:00')
+    + field(5, 1) + field(8, 1) + field(9, 3) + field(10, 'MOLA.cub') + field(13, 0)
+    + field(16, 3390000.0) + field(17, 100.0) + field(18, -200.0)
+    + packed_doubles(19, [1.0, 0.0, 0.0, 2.0, 0.0, 3.0])
+    + field(25, field(1, SERIALS[0]) + field(2, 0) + field(3, 10.5) + field(4, 20.5)
+            + field(7, 1) + field(11, 10.0) + field(12, 21.0) + field(13, 0.5) + field(14, 0.5)
+            + field(17, field(1, 2) + field(2, 0.125))
+            + field(17, field(1, 7) + field(2, 0.875))
+            + field(17, field(3, 1) + field(4, 1)))
+    + field(25, field(1, SERIALS[1]) + field(2, 3) + field(3, 30.25) + field(4, 40.25)
+            + field(5, 'pointreg') + field(6, '2019-01-01T00:00:00') + field(9, 1)),
+    field(1, 'cassis_2') + field(2, 2) + field(6, 1)
+    + field(25, field(1, SERIALS[2]) + field(2, 1) + field(3, 1.0) + field(4, 2.0) + field(8, 1))
+    + field(25, field(1, SERIALS[1]) + field(2, 2) + field(3, 3.0) + field(4, 4.0)
+            + field(15, -0.25) + field(16, 0.75))]
+
+FIXTURE_HEADER = (field(1, 'fixture') + field(2, 'Mars') + field(3, '2019-01-01T00:00:00')
+                  + field(4, '2019-01-02T00:00:00') + field(5, 'hand encoded') + field(6, 'isis'))
+
+
+def fixture_file(filename, version):
+    if version == 2:
+        header = FIXTURE_HEADER + field(7, b''.join(varint(len(point)) for point in FIXTURE_POINTS))
+        points = b''.join(FIXTURE_POINTS)
+    else:
+        header = FIXTURE_HEADER
+        points = b''.join(varint(len(point)) + point for point in FIXTURE_POINTS)
+    label = '''Object = ControlNetwork
+  Object = ProtoBuffer
+    Object = Core
+      HeaderStartByte = 65536
+      HeaderBytes     = {}
+      PointsStartByte = {}
+      PointsBytes     = {}
+    End_Object
+
+    Group = ControlNetworkInfo
+      NetworkId    = fixture
+      TargetName   = Mars
+      Version      = {}
+    End_Group
+  End_Object
+End_Object
+End
+'''.format(len(header), 65536 + len(header), len(points), version)
+    with open(filename, 'wb') as f:
+        f.write(label.encode().ljust(65536, b'\0') + header + points)
+    return filename
+
+
+@pytest.mark.parametrize('version', [2, 5])
+def test_read_fixture(tmp_path, version):
+    network = isis_cnet.read_network(fixture_file(str(tmp_path / 'fixture.net'), version))
+    assert (network.network_id, network.target_name, network.created, network.last_modified,
+            network.description, network.user_name) == \
+        ('fixture', 'Mars', '2019-01-01T00:00:00', '2019-01-02T00:00:00', 'hand encoded', 'isis')
+    points, measures = resolved(network)
+    assert points['id'] == [b'cassis_1', b'cassis_2']
+    assert points['type'].tolist() == [isis_cnet.FIXED, isis_cnet.FREE]
+    assert points['chooser'] == ['jigsaw', None]
+    assert points['datetime'] == ['2019-01-01T00:00:00', None]
+    assert points['edit_lock'].tolist() == [True, False]
+    assert points['ignore'].tolist() == [False, True]
+    assert points['reference'].tolist() == [1, -1]
+    assert points['apriori_surface_source'].tolist() == [3, 0]
+    assert points['apriori_surface_file'] == ['MOLA.cub', None]
+    assert points['latitude_constrained'].tolist() == [False, True]
+    np.testing.assert_array_equal(points['apriori'], [[3390000.0, 100.0, -200.0], [np.nan] * 3])
+    np.testing.assert_array_equal(points['apriori_covariance'],
+                                  [[1.0, 0.0, 0.0, 2.0, 0.0, 3.0], [np.nan] * 6])
+    assert np.isnan(points['adjusted']).all()
+
+    assert network.measures['point'].tolist() == [0, 0, 1, 1]
+    assert measures['serial'] == [SERIALS[0], SERIALS[1], SERIALS[2], SERIALS[1]]
+    assert measures['type'].tolist() == [0, 3, 1, 2]
+    assert measures['sample'].tolist() == [10.5, 30.25, 1.0, 3.0]
+    assert measures['line'].tolist() == [20.5, 40.25, 2.0, 4.0]
+    assert measures['chooser'] == [None, 'pointreg', None, None]
+    assert measures['datetime'] == [None, '2019-01-01T00:00:00', None, None]
+    assert measures['edit_lock'].tolist() == [True, False, False, False]
+    assert measures['ignore'].tolist() == [False, False, True, False]
+    assert measures['jigsaw_rejected'].tolist() == [False, True, False, False]
+    np.testing.assert_array_equal(measures['apriori_sample'], [10.0, np.nan, np.nan, np.nan])
+    np.testing.assert_array_equal(measures['line_sigma'], [0.5, np.nan, np.nan, np.nan])
+    np.testing.assert_array_equal(measures['sample_residual'], [np.nan, np.nan, np.nan, -0.25])
+    np.testing.assert_array_equal(measures['line_residual'], [np.nan, np.nan, np.nan, 0.75])
+    np.testing.assert_array_equal(measures['goodness_of_fit'], [0.125, np.nan, np.nan, np.nan])
+    np.testing.assert_array_equal(measures['subpixel_correlation'], [0.875, np.nan, np.nan, np.nan])
+    assert np.isnan(measures['diameter']).all()
+
+    # and it is written back as version 5 without losing anything
+    isis_cnet.write_network(network, str(tmp_path / 'again.net'))
+    assert_same_network(network, isis_cnet.read_network(str(tmp_path / 'again.net')))
+
+
+def test_read_not_a_network(tmp_path):
+    filename = tmp_path / 'cube.cub'
+    filename.write_bytes(b'Object = IsisCube\nEnd_Object\nEnd\n')
+    with pytest.raises(ValueError):
+        isis_cnet.read_network(str(filename))
+
+
+def test_select():
+    network = full_network()
+    # drop the reference measure of the second point but keep the first's
+    selected = network.select(measures=np.array([True, True, False, True, True]))
+    assert selected.points['reference'].tolist() == [1, -1, -1]
+    assert selected.measures['point'].tolist() == [0, 0, 1, 1]
+    assert selected.measures['sample'][1] == 1.0
+    assert selected.serials is network.serials and selected.strings is network.strings
+
+    # a kept reference moves with the measures before it
+    selected = network.select(points=np.array([False, True, True]))
+    assert selected.points['id'].tolist() == [b'tgo_0002', b'tgo_0003_longer']
+    assert selected.points['reference'].tolist() == [0, -1]
+    assert selected.measures['point'].tolist() == [0, 0, 0]
+    assert selected.measures['sample'][selected.points['reference'][0]] == 3.0
+
+    # points left with too few measures are dropped with their measures
+    selected = network.select(measures=network.measures['serial'] != 1, min_measures=2)
+    assert selected.points['id'].tolist() == [b'tgo_0002']
+    assert selected.points['reference'].tolist() == [0]
+    assert selected.measures['serial'].tolist() == [0, 2]
+    assert selected.summary()['images'] == 2
+
+
+def test_merge_networks():
+    first = make_network([{'id' : 'a', 'chooser' : 0, 'reference' : 1},
+                          {'id' : 'shared', 'type' : isis_cnet.CONSTRAINED, 'reference' : 3}],
+                         [{'point' : 0, 'serial' : 0, 'sample' : 1.0},
+                          {'point' : 0, 'serial' : 1, 'sample' : 2.0},
+                          {'point' : 1, 'serial' : 0, 'sample' : 3.0},
+                          {'point' : 1, 'serial' : 2, 'sample' : 4.0}],
+                         strings=['first'], network_id='first', target_name='Mars')
+    # the second network has its serials and strings in another order
+    second = make_network([{'id' : 'shared', 'type' : isis_cnet.FIXED, 'reference' : 0},
+                           {'id' : 'b', 'chooser' : 1, 'reference' : 3}],
+                          [{'point' : 0, 'serial' : 0, 'sample' : 5.0, 'chooser' : 1},
+                           {'point' : 0, 'serial' : 1, 'sample' : 6.0, 'chooser' : 0},
+                           {'point' : 1, 'serial' : 1, 'sample' : 7.0},
+                           {'point' : 1, 'serial' : 0, 'sample' : 8.0}],
+                          serials=[SERIALS[2], 'TGO/CaSSIS/other'], strings=['other', 'first'],
+                          network_id='second')
+
+    with pytest.raises(ValueError):
+        isis_cnet.merge_networks([first, second])
+
+    merged = isis_cnet.merge_networks([first, second], network_id='merged', duplicates='merge')
+    assert (merged.network_id, merged.target_name) == ('merged', 'Mars')
+    points, measures = resolved(merged)
+    assert points['id'] == [b'a', b'shared', b'b']
+    # the first of the duplicated points is kept
+    assert merged.points['type'].tolist() == [isis_cnet.FREE, isis_cnet.CONSTRAINED, isis_cnet.FREE]
+    assert points['chooser'] == ['first', None, 'first']
+    assert merged.measures['point'].tolist() == [0, 0, 1, 1, 1, 2, 2]
+    # the second network's measure on an image the point already has is dropped
+    assert merged.measures['sample'].tolist() == [1.0, 2.0, 3.0, 4.0, 6.0, 7.0, 8.0]
+    assert measures['serial'] == [SERIALS[0], SERIALS[1], SERIALS[0], SERIALS[2],
+                                  'TGO/CaSSIS/other', 'TGO/CaSSIS/other', SERIALS[2]]
+    assert measures['chooser'] == [None, None, None, None, 'other', None, None]
+    assert merged.points['reference'].tolist() == [1, 3, 6]
+    assert merged.image_measure_counts() == {SERIALS[0] : 2, SERIALS[1] : 1, SERIALS[2] : 2,
+                                             'TGO/CaSSIS/other' : 2}
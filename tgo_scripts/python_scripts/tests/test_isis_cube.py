@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import isis_cube, isis_label
+
+# the stored Real special pixels, by their bits
+NULL = np.array(0xFF7FFFFB, np.uint32).view(np.float32)
+HRS = np.array(0xFF7FFFFF, np.uint32).view(np.float32)
+
+
+def band_sequential_cube(filename, pixels, pixel_type='SignedWord', base=0.0, multiplier=1.0):
+    # write a BandSequential cube with an attached label, like ISIS does
+    label_bytes = 4096
+    core = isis_label.PvlBlock('Object', 'Core')
+    core.keywords = [('StartByte', str(label_bytes + 1)), ('Format', 'BandSequential')]
+    dimensions = isis_label.PvlBlock('Group', 'Dimensions')
+    bands, lines, samples = pixels.shape
+    dimensions.keywords = [('Samples', str(samples)), ('Lines', str(lines)), ('Bands', str(bands))]
+    pixel_group = isis_label.PvlBlock('Group', 'Pixels')
+    pixel_group.keywords = [('Type', pixel_type), ('ByteOrder', 'Lsb'),
+                            ('Base', repr(base)), ('Multiplier', repr(multiplier))]
+    core.blocks = [dimensions, pixel_group]
+    cube = isis_label.PvlBlock('Object', 'IsisCube')
+    cube.blocks = [core]
+    label_object = isis_label.PvlBlock('Object', 'Label')
+    label_object.keywords = [('Bytes', str(label_bytes))]
+    label = isis_label.PvlBlock('Root', '')
+    label.blocks = [cube, label_object]
+    with open(filename, 'wb') as f:
+        f.write(isis_label.format_label(label).encode().ljust(label_bytes, b'\0'))
+        f.write(pixels.astype(pixels.dtype.newbyteorder('<')).tobytes())
+    isis_label.clear_cache()
+    return filename
+
+
+def test_create_write_read(tmp_path):
+    filename = str(tmp_path / 'new.cub')
+    rng = np.random.default_rng(3)
+    cube = isis_cube.create_cube(filename, 300, 200, 2, tile_size=128)
+    assert cube.tiled and (cube.samples, cube.lines, cube.bands) == (300, 200, 2)
+    assert np.all(cube.special_masks(cube.read(), ['Null']))
+
+    pixels = rng.random((200, 300)).astype(np.float32)
+    cube.write(pixels, band=1)
+    # a window that only partly covers its tiles keeps the rest of them
+    patch = rng.random((50, 70)).astype(np.float32)
+    cube.write(patch, (100, 150), (120, 190), band=1)
+    pixels[100:150, 120:190] = patch
+    cube.memmap().flush()
+
+    cube = isis_cube.Cube(filename)
+    assert np.array_equal(cube.read(bands=1), pixels)
+    assert np.array_equal(cube.read((90, 170), (5, 299), 1), pixels[90:170, 5:299])
+    assert np.all(cube.special_masks(cube.read(bands=0), ['Null']))
+
+
+def test_read_band_sequential(tmp_path):
+    pixels = np.arange(3 * 7 * 5, dtype=np.int16).reshape(3, 7, 5)
+    cube = isis_cube.Cube(band_sequential_cube(str(tmp_path / 'bsq.cub'), pixels))
+    assert not cube.tiled and (cube.samples, cube.lines, cube.bands) == (5, 7, 3)
+    assert np.array_equal(cube.read(), pixels)
+    assert np.array_equal(cube.read((2, 6), (1, 4), 2), pixels[2, 2:6, 1:4])
+    assert np.array_equal(cube.read(bands=[0, 2]), pixels[[0, 2]])
+
+
+def test_special_pixels_and_dn(tmp_path):
+    pixels = np.array([[[-32768, -32767, 5, 32767, -32765], [10, 20, 30, -32752, 50]]], np.int16)
+    cube = isis_cube.Cube(band_sequential_cube(str(tmp_path / 'word.cub'), pixels,
+                                               base=100.0, multiplier=0.5))
+    stored = cube.read(bands=0)
+    names = isis_cube.special_pixels
+    masks = dict(zip(names, cube.special_masks(stored)))
+    assert masks['Null'].sum() == 1 and masks['Null'][0, 0]
+    assert masks['Lrs'].sum() == 1 and masks['Lrs'][0, 1]
+    assert masks['His'].sum() == 1 and masks['His'][0, 4]
+    assert masks['Lis'].sum() == 0 and masks['Hrs'].sum() == 0
+    # the lowest valid value and the highest are not special
+    assert cube.special_mask(stored).sum() == 3
+
+    values = cube.dn(stored)
+    assert np.isnan(values[0, [0, 1, 4]]).all()
+    assert values[0, 2] == 100.0 + 0.5 * 5 and values[0, 3] == 100.0 + 0.5 * 32767
+    assert np.array_equal(values[1], 100.0 + 0.5 * pixels[0, 1])
+
+
+def test_real_special_pixels(tmp_path):
+    cube = isis_cube.create_cube(str(tmp_path / 'real.cub'), 4, 1, 1)
+    cube.write(np.array([[1.5, NULL, HRS, -2.0]], np.float32))
+    stored = cube.read(bands=0)
+    assert np.array_equal(cube.special_mask(stored), [[False, True, True, False]])
+    masks = dict(zip(isis_cube.special_pixels, cube.special_masks(stored)))
+    assert masks['Null'][0, 1] and masks['Hrs'][0, 2]
+    assert np.array_equal(np.isnan(cube.dn(stored)), [[False, True, True, False]])
+
+
+@pytest.mark.parametrize('tiled', [True, False])
+def test_statistics(tmp_path, tiled):
+    rng = np.random.default_rng(5)
+    values = rng.integers(-1000, 1000, (1, 300, 70)).astype(np.int16)
+    values[0, rng.random((300, 70)) < 0.1] = -32768
+    if tiled:
+        cube = isis_cube.create_cube(str(tmp_path / 'stats.cub'), 70, 300, 1, tile_size=64)
+        stored = np.where(values[0] == -32768, NULL, values[0]).astype(np.float32)
+        cube.write(stored)
+        cube.memmap().flush()
+    else:
+        cube = isis_cube.Cube(band_sequential_cube(str(tmp_path / 'stats.cub'), values))
+    valid = values[0][values[0] != -32768].astype(np.float64)
+
+    block_pixels = isis_cube.statistics_block_pixels
+    isis_cube.statistics_block_pixels = 1000
+    try:
+        statistics = isis_cube.Cube(cube.filename).statistics()
+    finally:
+        isis_cube.statistics_block_pixels = block_pixels
+    assert statistics['valid'] == valid.size
+    assert statistics['Null'] == 300 * 70 - valid.size
+    assert statistics['minimum'] == valid.min() and statistics['maximum'] == valid.max()
+    assert statistics['average'] == pytest.approx(valid.mean())
+    assert statistics['standard_deviation'] == pytest.approx(valid.std())
@@ -0,0 +1,97 @@
+import os
+import pytest
+import isis_label
+
+LABEL = '''Object = IsisCube
+  Object = Core
+    StartByte   = 65537
+    Format      = Tile
+    TileSamples = 128
+    TileLines   = 128
+
+    Group = Dimensions
+      Samples = 2048
+      Lines   = 256
+      Bands   = 1
+    End_Group
+  End_Object
+
+  Group = Instrument
+    SpacecraftName = "TRACE GAS ORBITER"
+    ExposureDuration = 1.152e-003 <seconds>
+    Filter           = (PAN, RED)
+    Comment          = "a string that is wrapped
+                        over two lines"
+  End_Group
+End_Object
+
+/* a comment */
+Object = Label
+  Bytes = 65536
+End_Object
+End
+'''
+
+
+def test_parse_label():
+    label = isis_label.parse_label(LABEL)
+    assert [block.name for block in label.blocks] == ['IsisCube', 'Label']
+    dimensions = label.find('Group', 'Dimensions')
+    assert dimensions['samples'] == '2048'
+    instrument = label.find('Group', 'Instrument')
+    assert instrument['SpacecraftName'] == 'TRACE GAS ORBITER'
+    # units are dropped from the values
+    assert instrument['ExposureDuration'] == '1.152e-003'
+    assert instrument['Filter'] == ['PAN', 'RED']
+    assert instrument['Comment'] == 'a string that is wrapped over two lines'
+    assert label.find('Object', 'Label')['Bytes'] == '65536'
+
+
+def test_find_and_get():
+    label = isis_label.parse_label(LABEL)
+    assert [block.name for block in label.find_all('Object')] == ['IsisCube', 'Core', 'Label']
+    assert label.find('Object', 'Core').get('Format') == 'Tile'
+    assert label.find('Object', 'Core').get('Missing', 'default') == 'default'
+    with pytest.raises(KeyError):
+        label.find('Group', 'Mapping')
+    with pytest.raises(KeyError):
+        label.find('Group', 'Dimensions')['Missing']
+
+
+def test_format_round_trip():
+    label = isis_label.parse_label(LABEL)
+    text = isis_label.format_label(label)
+    # unchanged keywords keep their text, including units
+    assert 'ExposureDuration = 1.152e-003 <seconds>' in text
+    again = isis_label.parse_label(text)
+    assert isis_label.format_label(again) == text
+    for block, other in zip(label.find_all('Group'), again.find_all('Group')):
+        assert list(block.keywords) == list(other.keywords)
+
+
+def test_changed_keywords():
+    label = isis_label.parse_label(LABEL)
+    instrument = label.find('Group', 'Instrument')
+    instrument['ExposureDuration'] = '2.0'
+    instrument['Target'] = 'Mars Express'
+    instrument['Filter'] = ['NIR', 'BLU']
+    again = isis_label.parse_label(isis_label.format_label(label)).find('Group', 'Instrument')
+    assert again['ExposureDuration'] == '2.0'
+    assert again['Target'] == 'Mars Express'
+    assert again['Filter'] == ['NIR', 'BLU']
+    assert again.keywords[-1][0] == 'Target'
+
+
+def test_read_label(tmp_path):
+    cube = tmp_path / 'test.cub'
+    cube.write_bytes(LABEL.encode().ljust(65536, b'\0') + b'\xff' * 1024)
+    assert isis_label.read_label_text(str(cube)).rstrip() == LABEL.rstrip()
+    assert isis_label.read_label(str(cube)).find('Group', 'Dimensions')['Lines'] == '256'
+    assert isis_label.get_key(str(cube), 'Lines', group='Dimensions') == '256'
+    assert isis_label.get_key(str(cube), 'Bytes', object='Label') == '65536'
+
+    # the cache notices the file changing, even at the same size
+    mtime = os.stat(cube).st_mtime_ns
+    cube.write_bytes(LABEL.replace('Lines   = 256', 'Lines   = 512').encode().ljust(65536, b'\0'))
+    os.utime(cube, ns=(mtime + 10**9, mtime + 10**9))
+    assert isis_label.read_label(str(cube)).find('Group', 'Dimensions')['Lines'] == '512'
@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import pytest
+import isis_cube, isis_label
+
+
+@pytest.fixture
+def cube(tmp_path):
+    # a cube with pixels and a table, like an ingested framelet
+    filename = str(tmp_path / 'ingested' / 'framelet.cub')
+    os.makedirs(os.path.dirname(filename))
+    cube = isis_cube.create_cube(filename, 40, 30, 1, tile_size=16)
+    cube.write(np.arange(1200, dtype=np.float32).reshape(30, 40))
+    cube.memmap().flush()
+    records = np.zeros(3, [('J2000Q0', 'f8'), ('AV1', 'f8')])
+    records['J2000Q0'] = [0.5, 0.25, 0.125]
+    isis_cube.write_table(filename, 'InstrumentPointing', records)
+    return filename
+
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def test_stage_copy(tmp_path, cube):
+    staged = str(tmp_path / 'staged.cub')
+    assert isis_cube.stage_cube(cube, staged, 'copy') == 'copy'
+    assert read_file(staged) == read_file(cube)
+
+
+def test_stage_detached(tmp_path, cube):
+    original = read_file(cube)
+    staged = str(tmp_path / 'adjusted' / 'framelet.cub')
+    os.makedirs(os.path.dirname(staged))
+    assert isis_cube.stage_cube(cube, staged, 'detached') == 'detached'
+
+    # the label points at the cube, relative to the label, and has no Label object
+    label = isis_label.read_label(staged)
+    assert label.find('Object', 'Core')['^Core'] == os.path.join('..', 'ingested', 'framelet.cub')
+    assert label.find('Object', 'Table')['^Table'] == os.path.join('..', 'ingested', 'framelet.cub')
+    assert not label.find_all('Object', 'Label')
+    assert os.path.getsize(staged) < 65536
+
+    # it reads the same pixels and tables as the cube
+    assert np.array_equal(isis_cube.Cube(staged).read(), isis_cube.Cube(cube).read())
+    assert np.array_equal(isis_cube.read_table(staged, 'InstrumentPointing'),
+                          isis_cube.read_table(cube, 'InstrumentPointing'))
+    assert read_file(cube) == original
+
+
+def test_stage_reflink(tmp_path, cube):
+    staged = str(tmp_path / 'staged.cub')
+    try:
+        isis_cube.stage_cube(cube, staged, 'reflink')
+    except OSError:
+        # the filesystem cannot clone files, and nothing is left behind
+        assert not os.path.exists(staged + '.tmp')
+        pytest.skip('reflinks are not supported here')
+    assert read_file(staged) == read_file(cube)
+
+
+def test_stage_auto(tmp_path, cube):
+    staged = str(tmp_path / 'staged.cub')
+    method = isis_cube.stage_cube(cube, staged)
+    assert method in ['reflink', 'detached']
+    assert np.array_equal(isis_cube.Cube(staged).read(), isis_cube.Cube(cube).read())
+
+    # files that are not cubes are copied when they cannot be cloned
+    text = tmp_path / 'list.lis'
+    text.write_text('not a cube\n')
+    assert isis_cube.stage_cube(str(text), str(tmp_path / 'staged.lis')) in ['reflink', 'copy']
+    assert (tmp_path / 'staged.lis').read_text() == 'not a cube\n'
+
+    with pytest.raises(ValueError):
+        isis_cube.stage_cube(cube, staged, 'hardlink')
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pytest
+import isis_cube, isis_label
+
+
+@pytest.fixture
+def table_records():
+    dtype = np.dtype([('J2000Q0', 'f8'), ('Quaternion', 'f8', (3,)), ('Rate', 'f4'),
+                      ('Count', 'i4'), ('Frame', 'S8')])
+    records = np.zeros(5, dtype)
+    records['J2000Q0'] = np.linspace(0, 1, 5)
+    records['Quaternion'] = np.arange(15).reshape(5, 3) / 7
+    records['Rate'] = [0.5, -1.25, 3.0, 1e-3, 2e6]
+    records['Count'] = [-2, 0, 7, 2**31 - 1, -2**31]
+    records['Frame'] = [b'J2000', b'MARSIAU', b'IAU_MARS', b'', b'TGO']
+    return records
+
+
+def test_table_round_trip(tmp_path, table_records):
+    filename = str(tmp_path / 'table.cub')
+    isis_cube.create_cube(filename, 8, 8, 1)
+    isis_cube.write_table(filename, 'InstrumentPointing', table_records,
+                          keywords=[('TimeDependentFrames', ['-143400', '1'])])
+    table = isis_label.read_label(filename).find('Object', 'Table')
+    assert table['TimeDependentFrames'] == ['-143400', '1']
+    assert [(field['Name'], field['Type'], field['Size']) for field in table.find_all('Group', 'Field')] == \
+        [('J2000Q0', 'Double', '1'), ('Quaternion', 'Double', '3'), ('Rate', 'Real', '1'),
+         ('Count', 'Integer', '1'), ('Frame', 'Text', '8')]
+
+    records = isis_cube.read_table(filename, 'InstrumentPointing')
+    assert records.dtype.names == table_records.dtype.names
+    for name in table_records.dtype.names:
+        assert np.array_equal(records[name], table_records[name])
+
+    # the pixels are not touched by the table
+    assert np.all(isis_cube.Cube(filename).special_masks(isis_cube.Cube(filename).read(), ['Null']))
+    with pytest.raises(KeyError):
+        isis_cube.read_table(filename, 'BodyRotation')
+
+
+def test_table_replace(tmp_path, table_records):
+    filename = str(tmp_path / 'table.cub')
+    isis_cube.create_cube(filename, 8, 8, 1)
+    isis_cube.write_table(filename, 'InstrumentPointing', table_records[:2])
+    isis_cube.write_table(filename, 'BodyRotation', table_records[2:])
+    size = os.path.getsize(filename)
+
+    # a smaller table is written over the old one, a larger one at the end
+    isis_cube.write_table(filename, 'InstrumentPointing', table_records[:1])
+    assert os.path.getsize(filename) == size
+    isis_cube.write_table(filename, 'BodyRotation', table_records)
+    assert os.path.getsize(filename) > size
+
+    label = isis_label.read_label(filename)
+    assert len(label.find_all('Object', 'Table')) == 2
+    assert np.array_equal(isis_cube.read_table(filename, 'InstrumentPointing'), table_records[:1])
+    assert np.array_equal(isis_cube.read_table(filename, 'BodyRotation'), table_records)
+
+
+def test_detached_label_table(tmp_path, table_records):
+    filename = str(tmp_path / 'template.cub')
+    isis_cube.create_cube(filename, 8, 8, 1)
+    isis_cube.write_table(filename, 'InstrumentPointing', table_records)
+    with open(filename, 'rb') as f:
+        original = f.read()
+
+    detached = str(tmp_path / 'out.lbl')
+    isis_cube.write_detached_label(filename, detached)
+    assert np.array_equal(isis_cube.read_table(detached, 'InstrumentPointing'), table_records)
+    assert isis_cube.Cube(detached).read().shape == (1, 8, 8)
+
+    isis_cube.write_table(detached, 'InstrumentPointing', table_records[::-1])
+    assert os.path.exists(str(tmp_path / 'out_InstrumentPointing.tbl'))
+    assert np.array_equal(isis_cube.read_table(detached, 'InstrumentPointing'), table_records[::-1])
+    # the cube the label points at is not changed
+    with open(filename, 'rb') as f:
+        assert f.read() == original